@@ -3,24 +3,27 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 
-import pickle as pickle
 
 from trajectory_compute import *
+from advtraj.trajectory_io import save_trajectory_family, \
+                                   load_trajectory_family
 from trajectory_plot import *
+from advtraj.traj_logging import configure_logging
+
+# Progress output at most once a minute; use "DEBUG" for per-step detail.
+configure_logging("INFO", progress_interval=60.0)
 
 dn = 5
 #runtest=True
 runtest=False
 #dir = 'C:/Users/paclk/OneDrive - University of Reading/traj_data/r{:02d}/'.format(dn)
 dir = '/storage/silver/wxproc/xm904103/traj/BOMEX/r6n/'
-#   Set to True to calculate trajectory family,False to read pre-calculated from pickle file.
+#   Set to True to calculate trajectory family,False to read pre-calculated from family file.
 get_traj = False
 #get_traj = True
 
-debug_unsplit = False
-debug_label = False  
-debug_mean = False 
-debug = False
+traj_config = Traj_Config(debug_unsplit = False, debug_label = False, \
+                          debug_mean = False, debug = False)
     
 files = glob.glob(dir+"diagnostics_3d_ts_*.nc")
 files.sort(key=file_key)
@@ -91,17 +94,16 @@ def main():
                  'quintic', \
                  ] 
 
-    interp_order = 1
-    iorder = '_'+order_labs[interp_order-1]
+    iorder = '_'+order_labs[traj_config.interp_order-1]
     fn = os.path.basename(files[0])[:-3]
     fn = ''.join(fn)+iorder
     fn = dir + fn
     
     ref_prof_file = glob.glob(dir+'diagnostics_ts_*.nc')[0]
-    test_pickle = 'traj_family_{:03d}_{:03d}_{:03d}_{:03d}_v2'.\
+    family_file = 'traj_family_{:03d}_{:03d}_{:03d}_{:03d}_v2.nc'.\
         format(first_ref_time//dt-1 ,last_ref_time//dt-1, \
                tr_back_len//dt, tr_forward_len//dt)
-    print(test_pickle)
+    print(family_file)
     var_list = { \
       "u":r"$u$ m s$^{-1}$", \
       "v":r"$v$ m s$^{-1}$", \
@@ -120,17 +122,13 @@ def main():
                      first_ref_time, last_ref_time, \
                      tr_back_len, tr_forward_len, \
                      100.0, 100.0, 40.0, trajectory_cloud_ref, in_cloud, \
-                     kwargs=kwa, variable_list=var_list)
-        outfile = open(dir+test_pickle,'wb')
-        print('Pickling ',dir+test_pickle)
-        pickle.dump(tfm, outfile)
-        outfile.close()
+                     kwargs=kwa, variable_list=var_list, config=traj_config)
+        print('Saving ',dir+family_file)
+        save_trajectory_family(tfm, dir+family_file)
     else :
-        infile = open(dir+test_pickle,'rb')
-        print('Un-pickling ',dir+test_pickle)
-        tfm = pickle.load(infile)
+        print('Loading ',dir+family_file)
+        tfm = load_trajectory_family(dir+family_file)
 #        print(tfm)
-        infile.close()
                 
     traj_list = tfm.family
     
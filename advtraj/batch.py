@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Batch computation of trajectory families from a configuration file.
+
+Usage::
+
+    python -m advtraj.batch config.json [--workers N] [--run NAME] [--list]
+
+The configuration file may be JSON, TOML (.toml; requires tomli before
+Python 3.11) or YAML (.yaml, .yml; requires PyYAML). It declares an output
+directory, the number of local worker processes and a list of runs::
+
+    {
+      "output_dir" : "/storage/traj/BOMEX/r6n/families",
+      "workers" : 4,
+      "runs" : [
+        {
+          "name" : "r6n",
+          "files" : "/storage/traj/BOMEX/r6n/diagnostics_3d_ts_*.nc",
+          "ref_prof_file" : "/storage/traj/BOMEX/r6n/diagnostics_ts_*.nc",
+          "first_ref_time" : 10800, "last_ref_time" : 86340,
+          "job_length" : 3600, "ref_interval" : 60,
+          "back_len" : 2400, "forward_len" : 1800,
+          "deltax" : 100.0, "deltay" : 100.0, "deltaz" : 40.0,
+          "ref_func" : "advtraj.compute_trajectories:trajectory_cloud_ref",
+          "in_obj_func" : "advtraj.compute_trajectories:in_cloud",
+          "kwargs" : {"thresh" : 1.0E-5},
+          "variables" : {"w" : "$w$ m s$^{-1}$", "th" : "$\\\\theta$ K"},
+          "config" : {"interp_order" : 1},
+          "nproc" : 1,
+          "checkpoint_interval" : 10,
+          "log_level" : "INFO", "progress_interval" : 60
+        }
+      ]
+    }
+
+Each run is split into jobs of job_length in reference time (default the
+whole range); ref_interval is the spacing of reference times (the time
+step of the input files), so a job's last reference time is
+ref_interval before the next job's first. Job name_first_last computes a
+Trajectory_Family and saves it to output_dir/name_first_last.nc (see
+trajectory_io). Jobs are run through a pool of local worker processes,
+and several nodes sharing the output directory may run the same
+configuration at once:
+
+* A job whose output file exists is done and is skipped.
+* A job is claimed by creating output_dir/locks/<job>.lock exclusively;
+  jobs locked by another worker are skipped. A lock left by a process
+  which has died on the same host is removed.
+* Completed family members are kept in output_dir/<job>_members (see
+  Trajectory_Family checkpoint_dir) so an interrupted job restarts from
+  its last member.
+* Output of each job is written to output_dir/logs/<job>.log, through
+  the advtraj loggers at log_level, with progress messages at most every
+  progress_interval seconds (see advtraj.traj_logging).
+* If "instrumentation" names a file, stage timings and counters of all
+  workers are appended to it (see advtraj.instrumentation).
+
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import glob
+import importlib
+import json
+import logging
+import os
+import socket
+import time
+
+import numpy as np
+
+from advtraj.compute_trajectories import Trajectory_Family, Traj_Config, \
+                                         file_key, _init_family_worker
+from advtraj.trajectory_io import save_trajectory_family, write_atomic
+from advtraj.instrumentation import enable_instrumentation
+from advtraj.traj_logging import batch_logger, Rate_Limit_Filter
+
+# Defaults for items of each run.
+run_defaults = {
+    "job_length" : None,
+    "ref_interval" : 60.0,
+    "deltax" : 100.0,
+    "deltay" : 100.0,
+    "deltaz" : 40.0,
+    "ref_func" : "advtraj.compute_trajectories:trajectory_cloud_ref",
+    "in_obj_func" : "advtraj.compute_trajectories:in_cloud",
+    "kwargs" : {},
+    "variables" : None,
+    "config" : {},
+    "nproc" : 1,
+    "max_open" : 8,
+    "checkpoint_interval" : 10,
+    "log_level" : "INFO",
+    "progress_interval" : 60.0,
+    }
+
+def read_config(filename) :
+    """
+    Function to read a batch configuration file.
+
+    Args:
+        filename : name of JSON, TOML (.toml) or YAML (.yaml, .yml) file.
+
+    Returns:
+        dict
+
+    """
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".toml" :
+        try :
+            import tomllib
+        except ImportError :
+            # Python < 3.11.
+            try :
+                import tomli as tomllib
+            except ImportError :
+                raise ImportError("tomli is needed to read {} with Python "
+                                  "< 3.11.".format(filename))
+        with open(filename, "rb") as f :
+            return tomllib.load(f)
+    with open(filename) as f :
+        if ext in (".yaml", ".yml") :
+            try :
+                import yaml
+            except ImportError :
+                raise ImportError("PyYAML is needed to read {}.".\
+                                  format(filename))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def _function(name) :
+    # Function from "module:name" or "module.name".
+    module, sep, qualname = name.rpartition(":")
+    if not sep :
+        module, sep, qualname = name.rpartition(".")
+    func = importlib.import_module(module)
+    for part in qualname.split(".") :
+        func = getattr(func, part)
+    return func
+
+def batch_jobs(config) :
+    """
+    Function to list the jobs declared by a batch configuration.
+
+    Args:
+        config : dict as returned by read_config.
+
+    Returns:
+        List of dicts, one per job, with the items of its run plus
+        job (name), first_ref_time, last_ref_time, output, log, lock and
+        checkpoint_dir.
+
+    """
+
+    output_dir = config["output_dir"]
+    jobs = list([])
+    for run in config["runs"] :
+        run = dict(run_defaults, **run)
+        first = run["first_ref_time"]
+        last = run["last_ref_time"]
+        length = run["job_length"]
+        if length is None : length = last - first + run["ref_interval"]
+        for start in np.arange(first, last + 1, length) :
+            job = dict(run)
+            job["first_ref_time"] = start
+            job["last_ref_time"] = min(start + length - run["ref_interval"], \
+                                       last)
+            name = "{}_{:06.0f}_{:06.0f}".format(run["name"], \
+                    job["first_ref_time"], job["last_ref_time"])
+            job["job"] = name
+            job["output"] = os.path.join(output_dir, name + ".nc")
+            job["log"] = os.path.join(output_dir, "logs", name + ".log")
+            job["lock"] = os.path.join(output_dir, "locks", name + ".lock")
+            job["checkpoint_dir"] = os.path.join(output_dir, \
+                                                 name + "_members")
+            jobs.append(job)
+    return jobs
+
+def _lock_owner_dead(lock) :
+    # True if lock was made by a process on this host which has exited.
+    try :
+        with open(lock) as f :
+            host, pid = f.read().split()
+        if host != socket.gethostname() : return False
+        os.kill(int(pid), 0)
+    except ProcessLookupError :
+        return True
+    except (OSError, ValueError) :
+        return False
+    return False
+
+def _take_over_lock(lock) :
+    # Moves a lock made by a dead process out of the way. The lock is
+    # renamed to a name unique to this process, so only one process can
+    # take it, then checked again in case it was replaced by a live lock
+    # after the first check; a live lock is put back. Returns True if the
+    # lock has gone, so creating it may be tried again.
+    if not _lock_owner_dead(lock) : return False
+    taken = "{}.{}.{}".format(lock, socket.gethostname(), os.getpid())
+    try :
+        os.rename(lock, taken)
+    except FileNotFoundError :
+        # Taken over by another process.
+        return True
+    if _lock_owner_dead(taken) :
+        os.remove(taken)
+        return True
+    try :
+        os.link(taken, lock)
+    except FileExistsError :
+        pass
+    os.remove(taken)
+    return False
+
+def acquire_lock(lock) :
+    """
+    Function to claim a job by creating its lock file exclusively.
+    Creation is atomic on a shared file system, so only one process
+    succeeds. A lock made by a process which has died on this host is
+    replaced (by one process only, see _take_over_lock).
+
+    Args:
+        lock : name of lock file.
+
+    Returns:
+        True if the lock was acquired.
+
+    """
+
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    for attempt in range(2) :
+        try :
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError :
+            if attempt == 0 and _take_over_lock(lock) :
+                continue
+            return False
+        with os.fdopen(fd, "w") as f :
+            f.write("{} {}\n".format(socket.gethostname(), os.getpid()))
+        return True
+    return False
+
+def release_lock(lock) :
+    """
+    Function to release a lock made by acquire_lock.
+
+    """
+
+    if os.path.exists(lock) : os.remove(lock)
+    return
+
+def run_job(job) :
+    """
+    Function to compute and save the Trajectory_Family for one job
+    unless it is done or locked by another worker.
+
+    Args:
+        job : dict from batch_jobs.
+
+    Returns:
+        (job name, status) where status is "done", "locked", "completed"
+        or "failed".
+
+    """
+
+    if os.path.exists(job["output"]) : return job["job"], "done"
+    if not acquire_lock(job["lock"]) : return job["job"], "locked"
+    try :
+        if os.path.exists(job["output"]) : return job["job"], "done"
+        os.makedirs(os.path.dirname(job["log"]), exist_ok=True)
+        logger = logging.getLogger("advtraj")
+        level = logger.level
+        handler = logging.FileHandler(job["log"])
+        handler.setFormatter(logging.Formatter( \
+            "%(asctime)s %(name)s %(levelname)s %(message)s"))
+        handler.addFilter(Rate_Limit_Filter(job["progress_interval"]))
+        logger.addHandler(handler)
+        logger.setLevel(job["log_level"])
+        try :
+            with open(job["log"], "a") as log, \
+                contextlib.redirect_stdout(log), \
+                contextlib.redirect_stderr(log) :
+                batch_logger.info("Job %s started on %s at %s", job["job"], \
+                                  socket.gethostname(), time.ctime())
+                try :
+                    _compute_family(job)
+                except Exception :
+                    batch_logger.exception("Job %s failed", job["job"])
+                    return job["job"], "failed"
+                batch_logger.info("Job %s completed at %s", job["job"], \
+                                  time.ctime())
+        finally :
+            logger.removeHandler(handler)
+            handler.close()
+            logger.setLevel(level)
+        return job["job"], "completed"
+    finally :
+        release_lock(job["lock"])
+
+def _compute_family(job) :
+    files = sorted(glob.glob(job["files"]), key=file_key)
+    if len(files) == 0 :
+        raise FileNotFoundError("No files match {}".format(job["files"]))
+    ref_prof_file = sorted(glob.glob(job["ref_prof_file"]))[0]
+    tfm = Trajectory_Family(files, ref_prof_file, \
+                            job["first_ref_time"], job["last_ref_time"], \
+                            job["back_len"], job["forward_len"], \
+                            job["deltax"], job["deltay"], job["deltaz"], \
+                            _function(job["ref_func"]), \
+                            _function(job["in_obj_func"]), \
+                            kwargs=job["kwargs"], \
+                            variable_list=job["variables"], \
+                            nproc=job["nproc"], max_open=job["max_open"], \
+                            config=Traj_Config(**job["config"]), \
+                            checkpoint_dir=job["checkpoint_dir"], \
+                            checkpoint_interval=job["checkpoint_interval"])
+    # The output exists only if complete.
+    write_atomic(job["output"], lambda tmp : save_trajectory_family(tfm, tmp))
+    return
+
+def run_batch(config, workers=None, runs=None) :
+    """
+    Function to run the jobs of a batch configuration through a pool of
+    local worker processes. Each worker keeps its input files open
+    between jobs (see Dataset_Pool).
+
+    Args:
+        config       : dict as returned by read_config.
+        workers=None : number of worker processes. Default is
+                       config["workers"] or 1.
+        runs=None    : list of names of runs to do. Default is all.
+
+    Returns:
+        List of (job name, status) in job order (see run_job).
+
+    """
+
+    jobs = [job for job in batch_jobs(config) \
+            if runs is None or job["name"] in runs]
+    if workers is None : workers = config.get("workers", 1)
+    if config.get("instrumentation") is not None :
+        enable_instrumentation(config["instrumentation"])
+    if workers <= 1 :
+        return [run_job(job) for job in jobs]
+    # Jobs may use worker processes themselves, which a
+    # multiprocessing.Pool worker cannot.
+    with ProcessPoolExecutor(workers, initializer=_init_family_worker, \
+                             initargs=(run_defaults["max_open"],)) as pool :
+        return list(pool.map(run_job, jobs))
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(prog="python -m advtraj.batch", \
+                description="Compute trajectory families from a "
+                            "configuration file.")
+    parser.add_argument("config", help="JSON, TOML or YAML configuration.")
+    parser.add_argument("--workers", type=int, default=None, \
+                        help="Number of local worker processes.")
+    parser.add_argument("--run", action="append", default=None, \
+                        help="Name of run to do (may be repeated).")
+    parser.add_argument("--list", action="store_true", \
+                        help="List jobs and whether they are done.")
+    args = parser.parse_args(argv)
+    config = read_config(args.config)
+    if args.list :
+        for job in batch_jobs(config) :
+            if args.run is None or job["name"] in args.run :
+                status = "done" if os.path.exists(job["output"]) else \
+                    "locked" if os.path.exists(job["lock"]) else "to do"
+                print("{} {}".format(job["job"], status))
+        return 0
+    results = run_batch(config, workers=args.workers, runs=args.run)
+    for name, status in results :
+        print("{} {}".format(name, status))
+    return int(any(status == "failed" for name, status in results))
+
+if __name__ == "__main__" :
+    raise SystemExit(main())
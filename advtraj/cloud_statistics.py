@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming aggregation of cloud statistics over trajectory families.
+
+Cloud statistics for each family member (lifetime, base, top, cloud base
+area and variables, entrainment rates) are found as in
+source/process_clouds.py, then reduced into fixed size accumulators
+(histograms, heat maps, running moments and binned moments), so memory use does not
+grow with the number of families processed. Accumulators combine by
+addition, so families can be processed in any number of worker
+processes and the results merged.
+
+Each family's statistics may be written to a partial result file; an
+interrupted aggregation then only repeats families not yet done, and
+partial results can be merged later (see load_cloud_statistics).
+
+"""
+import multiprocessing
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from advtraj.compute_trajectories import set_cloud_class, cloud_properties, \
+                                         Cloud_Properties
+from advtraj.trajectory_io import load_trajectories, close_files, \
+                                  member_group, write_atomic
+from advtraj.traj_logging import analysis_logger
+
+class Histogram :
+    """
+    Class accumulating counts of samples in fixed bins in one or more
+    dimensions.
+
+    Args:
+        bins : list of arrays of bin edges, one per dimension.
+
+    Attributes:
+        counts : array of counts, shape (len(bins[i])-1, ...).
+
+    """
+
+    def __init__(self, bins) :
+        self.bins = [np.asarray(b, dtype=float) for b in bins]
+        self.counts = np.zeros([len(b) - 1 for b in self.bins], dtype=int)
+
+    def add(self, *samples) :
+        """
+        Method to add samples, one array per dimension.
+
+        """
+
+        if np.size(samples[0]) == 0 : return
+        counts, edges = np.histogramdd(np.column_stack(samples), \
+                                       bins=self.bins)
+        self.counts += counts.astype(int)
+        return
+
+    def merge(self, other) :
+        """
+        Method to add the counts of another Histogram with the same bins.
+
+        """
+
+        if len(self.bins) != len(other.bins) or \
+            not all(np.array_equal(a, b) for a, b in \
+                    zip(self.bins, other.bins)) :
+            raise ValueError("Histograms have different bins.")
+        self.counts += other.counts
+        return
+
+    def centres(self, dim=0) :
+        return 0.5 * (self.bins[dim][:-1] + self.bins[dim][1:])
+
+    def state(self) :
+        state = dict([("bins_{}".format(i), b) \
+                      for i, b in enumerate(self.bins)])
+        state["counts"] = self.counts
+        return state
+
+    @classmethod
+    def from_state(cls, state) :
+        nbins = len([k for k in state if k.startswith("bins_")])
+        hist = cls([state["bins_{}".format(i)] for i in range(nbins)])
+        hist.counts = np.array(state["counts"])
+        return hist
+
+class Running_Moments :
+    """
+    Class accumulating count, sum and sum of squares of one or more
+    variables.
+
+    Args:
+        nvars=None : number of variables. Default is set by first add.
+
+    """
+
+    def __init__(self, nvars=None) :
+        self.count = 0
+        self.sum = None if nvars is None else np.zeros(nvars)
+        self.sumsq = None if nvars is None else np.zeros(nvars)
+
+    def add(self, values) :
+        """
+        Method to add samples.
+
+        Args:
+            values : array[n, nvars] (or [n] for one variable).
+
+        """
+
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1 : values = values[:, np.newaxis]
+        if self.sum is None :
+            self.sum = np.zeros(values.shape[1])
+            self.sumsq = np.zeros(values.shape[1])
+        self.count += values.shape[0]
+        self.sum += np.sum(values, axis=0)
+        self.sumsq += np.sum(values * values, axis=0)
+        return
+
+    def merge(self, other) :
+        if other.sum is None : return
+        if self.sum is None :
+            self.sum = np.zeros_like(other.sum)
+            self.sumsq = np.zeros_like(other.sumsq)
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return
+
+    def mean(self) :
+        return self.sum / max(self.count, 1)
+
+    def std(self) :
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.sumsq / max(self.count, 1) - \
+                                  mean * mean, 0.0))
+
+    def state(self) :
+        state = {"count" : np.array(self.count)}
+        if self.sum is not None :
+            state["sum"] = self.sum
+            state["sumsq"] = self.sumsq
+        return state
+
+    @classmethod
+    def from_state(cls, state) :
+        moments = cls()
+        moments.count = int(state["count"])
+        if "sum" in state :
+            moments.sum = np.array(state["sum"])
+            moments.sumsq = np.array(state["sumsq"])
+        return moments
+
+class Binned_Moments :
+    """
+    Class accumulating count, sum and sum of squares of one or more
+    variables in fixed bins of a coordinate (e.g. height). Samples outside
+    the bins are ignored.
+
+    Args:
+        bins       : array of bin edges.
+        nvars=None : number of variables. Default is set by first add.
+
+    """
+
+    def __init__(self, bins, nvars=None) :
+        self.bins = np.asarray(bins, dtype=float)
+        nb = len(self.bins) - 1
+        self.count = np.zeros(nb, dtype=int)
+        self.sum = None if nvars is None else np.zeros((nb, nvars))
+        self.sumsq = None if nvars is None else np.zeros((nb, nvars))
+
+    def add(self, x, values) :
+        """
+        Method to add samples.
+
+        Args:
+            x      : array[n] of coordinate.
+            values : array[n, nvars] (or [n] for one variable).
+
+        """
+
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1 : values = values[:, np.newaxis]
+        nb = len(self.count)
+        if self.sum is None :
+            self.sum = np.zeros((nb, values.shape[1]))
+            self.sumsq = np.zeros((nb, values.shape[1]))
+        ib = np.searchsorted(self.bins, x, side='right') - 1
+        # Include upper edge in last bin, as np.histogram.
+        ib[np.asarray(x) == self.bins[-1]] = nb - 1
+        inside = np.logical_and(ib >= 0, ib < nb)
+        ib = ib[inside]
+        values = values[inside]
+        self.count += np.bincount(ib, minlength=nb)
+        for j in range(values.shape[1]) :
+            self.sum[:, j] += np.bincount(ib, weights=values[:, j], \
+                                          minlength=nb)
+            self.sumsq[:, j] += np.bincount(ib, weights=values[:, j]**2, \
+                                            minlength=nb)
+        return
+
+    def merge(self, other) :
+        if not np.array_equal(self.bins, other.bins) :
+            raise ValueError("Binned_Moments have different bins.")
+        self.count += other.count
+        if other.sum is None : return
+        if self.sum is None :
+            self.sum = np.zeros_like(other.sum)
+            self.sumsq = np.zeros_like(other.sumsq)
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return
+
+    def centres(self) :
+        return 0.5 * (self.bins[:-1] + self.bins[1:])
+
+    def mean(self) :
+        return self.sum / np.maximum(self.count, 1)[:, np.newaxis]
+
+    def std(self) :
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.sumsq / \
+                       np.maximum(self.count, 1)[:, np.newaxis] - \
+                       mean * mean, 0.0))
+
+    def state(self) :
+        state = {"bins" : self.bins, "count" : self.count}
+        if self.sum is not None :
+            state["sum"] = self.sum
+            state["sumsq"] = self.sumsq
+        return state
+
+    @classmethod
+    def from_state(cls, state) :
+        moments = cls(state["bins"])
+        moments.count = np.array(state["count"])
+        if "sum" in state :
+            moments.sum = np.array(state["sum"])
+            moments.sumsq = np.array(state["sumsq"])
+        return moments
+
+class Heat_Map :
+    """
+    Class accumulating binned statistics of samples (x, z) in fixed 2D
+    bins: the count, and the sum and sum of squares of a value (by
+    default x), in each (x, z) bin. Samples outside the bins are ignored.
+    This replaces a 2D histogram of all samples (e.g. ax.hist2d) with
+    mean and standard deviation profiles; plotting needs only the
+    accumulated arrays.
+
+    Args:
+        xbins : array of bin edges in x.
+        zbins : array of bin edges in z.
+
+    Attributes:
+        counts : array[nx, nz] of counts.
+        sum    : array[nx, nz] of sums of values.
+        sumsq  : array[nx, nz] of sums of squares of values.
+
+    """
+
+    def __init__(self, xbins, zbins) :
+        self.bins = [np.asarray(xbins, dtype=float), \
+                     np.asarray(zbins, dtype=float)]
+        shape = (len(self.bins[0]) - 1, len(self.bins[1]) - 1)
+        self.counts = np.zeros(shape, dtype=int)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+
+    def _index(self, coord, edges) :
+        # Bin index, with upper edge in last bin, as np.histogram.
+        nb = len(edges) - 1
+        ib = np.searchsorted(edges, coord, side='right') - 1
+        ib[coord == edges[-1]] = nb - 1
+        return ib, np.logical_and(ib >= 0, ib < nb)
+
+    def add(self, x, z, values=None) :
+        """
+        Method to add samples.
+
+        Args:
+            x           : array[n] of x.
+            z           : array[n] of z.
+            values=None : array[n] of values. Default is x.
+
+        """
+
+        x = np.asarray(x, dtype=float).ravel()
+        z = np.asarray(z, dtype=float).ravel()
+        values = x if values is None else \
+            np.asarray(values, dtype=float).ravel()
+        ix, xin = self._index(x, self.bins[0])
+        iz, zin = self._index(z, self.bins[1])
+        inside = np.logical_and(xin, zin)
+        shape = self.counts.shape
+        ib = np.ravel_multi_index((ix[inside], iz[inside]), shape)
+        values = values[inside]
+        n = shape[0] * shape[1]
+        self.counts += np.bincount(ib, minlength=n).reshape(shape)
+        self.sum += np.bincount(ib, weights=values, \
+                                minlength=n).reshape(shape)
+        self.sumsq += np.bincount(ib, weights=values * values, \
+                                  minlength=n).reshape(shape)
+        return
+
+    def merge(self, other) :
+        if not all(np.array_equal(a, b) for a, b in \
+                   zip(self.bins, other.bins)) :
+            raise ValueError("Heat_Maps have different bins.")
+        self.counts += other.counts
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        return
+
+    def centres(self, dim=0) :
+        return 0.5 * (self.bins[dim][:-1] + self.bins[dim][1:])
+
+    def profile(self) :
+        """
+        Method to find the mean and standard deviation of values in each
+        z bin.
+
+        Returns:
+            z bin centres, mean, standard deviation.
+
+        """
+
+        n = np.maximum(np.sum(self.counts, axis=0), 1)
+        mean = np.sum(self.sum, axis=0) / n
+        std = np.sqrt(np.maximum(np.sum(self.sumsq, axis=0) / n - \
+                                 mean * mean, 0.0))
+        return self.centres(1), mean, std
+
+    def state(self) :
+        return {"xbins" : self.bins[0], "zbins" : self.bins[1], \
+                "counts" : self.counts, "sum" : self.sum, \
+                "sumsq" : self.sumsq}
+
+    @classmethod
+    def from_state(cls, state) :
+        hmap = cls(state["xbins"], state["zbins"])
+        hmap.counts = np.array(state["counts"])
+        hmap.sum = np.array(state["sum"])
+        hmap.sumsq = np.array(state["sumsq"])
+        return hmap
+
+accumulator_classes = dict([(c.__name__, c) for c in \
+                            (Histogram, Heat_Map, Running_Moments, \
+                             Binned_Moments)])
+
+# Default bins, as used for plots in process_clouds.py.
+default_bins = {
+    "lifetime" : np.arange(0, 75, 10),
+    "radius" : np.arange(0, 550, 50),
+    "radius_heat" : np.arange(50, 500, 50),
+    "lifetime_heat" : np.arange(0, 75, 5),
+    "depth_heat" : np.arange(0, 950, 50),
+    "entrainment" : np.arange(0, 0.0055, 0.0005),
+    "height" : np.arange(600, 1550, 50),
+    }
+
+# Format of files written by Cloud_Statistics.save. Saved partial results
+# are only reused if their format, bins and version match.
+stats_format = 2
+
+# Columns of cloud_summary and entrainment in member_cloud_statistics.
+summary_names = ["lifetime", "base", "top", "base_area", "depth"]
+entrainment_names = ["cloud_base_entr", "cloud_base_entr_z", \
+                     "side_entr", "side_entr_z"]
+
+def member_cloud_statistics(traj, version=1) :
+    """
+    Function to find statistics of the clouds in traj.max_at_ref (see
+    set_cloud_class and cloud_properties), as in process_clouds.py.
+
+    Args:
+        traj      : Trajectories object.
+        version=1 : version of set_cloud_class.
+
+    Returns:
+        dict::
+
+            "time"          : reference time.
+            "cloud_summary" : array[nclouds, 5] of lifetime, minimum cloud
+                              base, cloud top, maximum cloud base area
+                              and depth.
+            "cloud_base_variables" : array[nclouds, n] (see
+                              cloud_properties).
+            "entrainment"   : array[m, 5] of height and cloud base and
+                              side entrainment rates (per s and per m)
+                              while each cloud is growing.
+            "n_entr_clouds" : number of clouds with entrainment data.
+            "derived_variable_list" : as cloud_properties.
+
+    """
+
+    traj_cl = set_cloud_class(traj, version=version)
+    mean_prop = cloud_properties(traj, traj_cl, \
+                    outputs = ["cloud", "cloud_properties", "entrainment", \
+                               "max_cloud_base_area", \
+                               "cloud_base_variables", \
+                               "derived_variable_list"], \
+                    objects = traj.max_at_ref, lazy = True)
+    npts_ptr = mean_prop.column("npts")
+    select = traj.max_at_ref
+    trigger = traj_cl['cloud_trigger_time']
+    dissipate = traj_cl['cloud_dissipate_time']
+
+    base = traj_cl['min_cloud_base'][select]
+    top = traj_cl['cloud_top'][select]
+    summary = np.column_stack([dissipate[select] - trigger[select], \
+                               base, top, \
+                               mean_prop['max_cloud_base_area'][select], \
+                               top - base]).astype(float)
+
+    entr = list([])
+    n_entr_clouds = 0
+    for iobj in select :
+        npts = mean_prop['cloud'][:, iobj, npts_ptr]
+        index_points = np.arange(len(npts), dtype=int)
+        # Times between trigger and dissipation with cloud present.
+        incloud = np.logical_and(index_points >= trigger[iobj], \
+                                 index_points < dissipate[iobj])
+        incloud = np.logical_and(npts > 0, incloud)
+        vol = mean_prop['cloud_properties'][:, iobj, \
+                                            Cloud_Properties.CLOUD_VOLUME]
+        max_cloud_index = np.where(vol == np.max(vol))[0][0]
+        # Rates are computed by finite difference so have 1 fewer items.
+        growing = np.logical_and(index_points <= max_cloud_index, \
+                                 incloud)[1:]
+        z_entr = mean_prop['cloud_properties'][1:, iobj, \
+                                Cloud_Properties.CLOUD_HEIGHT][growing]
+        rates = mean_prop["entrainment"][:, iobj, :][growing]
+        if len(z_entr) > 0 : n_entr_clouds += 1
+        entr.append(np.column_stack([z_entr, \
+                    rates[:, Cloud_Properties.CB_ENTR], \
+                    rates[:, Cloud_Properties.CB_ENTR_Z], \
+                    rates[:, Cloud_Properties.SIDE_ENTR], \
+                    rates[:, Cloud_Properties.SIDE_ENTR_Z]]))
+
+    return {"time" : traj.times[traj.ref], \
+            "cloud_summary" : summary, \
+            "cloud_base_variables" : \
+                np.asarray(mean_prop['cloud_base_variables'][select, :]), \
+            "entrainment" : np.vstack(entr) if len(entr) > 0 else \
+                np.zeros((0, 1 + len(entrainment_names))), \
+            "n_entr_clouds" : n_entr_clouds, \
+            "derived_variable_list" : mean_prop["derived_variable_list"]}
+
+class Cloud_Statistics :
+    """
+    Class reducing member_cloud_statistics into fixed size accumulators.
+
+    Args:
+        bins=None : dict overriding items of default_bins.
+        version=1 : version of set_cloud_class used.
+
+    Attributes:
+        bins         : dict of bins used.
+        version      : version of set_cloud_class used.
+        accumulators : dict of named accumulators::
+
+            "n"                 : Running_Moments of number of members,
+                                  clouds and clouds with entrainment.
+            "cloud_summary"     : Running_Moments of summary_names.
+            "lifetime"          : Histogram of lifetime.
+            "radius_lifetime"   : Heat_Map of cloud base radius and
+                                  lifetime for clouds with area and
+                                  depth > 0.
+            "radius_depth"      : Heat_Map of cloud base radius and depth.
+            "base_variables"    : Binned_Moments of cloud base variables
+                                  by cloud base radius.
+            "entrainment_height": Binned_Moments of entrainment rates by
+                                  height.
+            "entrainment_<i>"   : Heat_Map of rate i and height.
+
+    """
+
+    def __init__(self, bins=None, version=1) :
+        b = dict(default_bins)
+        if bins is not None : b.update(bins)
+        self.bins = b
+        self.version = version
+        self.accumulators = dict([ \
+            ("n", Running_Moments(3)), \
+            ("cloud_summary", Running_Moments(len(summary_names))), \
+            ("lifetime", Histogram([b["lifetime"]])), \
+            ("radius_lifetime", Heat_Map(b["radius_heat"], \
+                                          b["lifetime_heat"])), \
+            ("radius_depth", Heat_Map(b["radius_heat"], b["depth_heat"])), \
+            ("base_variables", Binned_Moments(b["radius"])), \
+            ("entrainment_height", Binned_Moments(b["height"], \
+                                                  len(entrainment_names))), \
+            ] + [("entrainment_{}".format(i), \
+                  Heat_Map(b["entrainment"], b["height"])) \
+                 for i in range(len(entrainment_names))])
+
+    def __getitem__(self, name) :
+        return self.accumulators[name]
+
+    def add(self, stats) :
+        """
+        Method to add the statistics of one member.
+
+        Args:
+            stats : dict from member_cloud_statistics.
+
+        """
+
+        acc = self.accumulators
+        summary = stats["cloud_summary"]
+        acc["n"].add([[1, np.shape(summary)[0], stats["n_entr_clouds"]]])
+        acc["cloud_summary"].add(summary)
+        life, area, depth = summary[:, 0], summary[:, 3], summary[:, 4]
+        acc["lifetime"].add(life)
+        sel = np.logical_and(area > 0, depth > 0)
+        radius = np.sqrt(area[sel] / np.pi)
+        acc["radius_lifetime"].add(radius, life[sel])
+        acc["radius_depth"].add(radius, depth[sel])
+        acc["base_variables"].add(radius, \
+                                  stats["cloud_base_variables"][sel, :])
+        entr = stats["entrainment"]
+        acc["entrainment_height"].add(entr[:, 0], entr[:, 1:])
+        for i in range(len(entrainment_names)) :
+            acc["entrainment_{}".format(i)].add(entr[:, i + 1], entr[:, 0])
+        return
+
+    def merge(self, other) :
+        """
+        Method to add the accumulated statistics of another
+        Cloud_Statistics.
+
+        """
+
+        for name, acc in self.accumulators.items() :
+            acc.merge(other.accumulators[name])
+        return
+
+    def save(self, filename) :
+        """
+        Method to save accumulators to a .npz file (with
+        trajectory_io.write_atomic), with the format, version and bins.
+
+        """
+
+        arrays = {"meta/format" : np.array(stats_format), \
+                  "meta/version" : np.array(self.version)}
+        for k, v in self.bins.items() :
+            arrays["meta/bins/" + k] = np.asarray(v)
+        for name, acc in self.accumulators.items() :
+            arrays[name + "/class"] = np.array(type(acc).__name__)
+            for k, v in acc.state().items() :
+                arrays[name + "/" + k] = v
+        write_atomic(filename, lambda tmp : np.savez(tmp, **arrays), \
+                     suffix=".tmp.npz")
+        return
+
+def load_cloud_statistics(filename) :
+    """
+    Function to read a Cloud_Statistics saved by Cloud_Statistics.save.
+
+    """
+
+    stats = Cloud_Statistics.__new__(Cloud_Statistics)
+    stats.accumulators = dict()
+    stats.bins, stats.version = _saved_settings(filename)
+    with np.load(filename) as f :
+        names = [k[:-len("/class")] for k in f.files if k.endswith("/class")]
+        for name in names :
+            state = dict([(k[len(name)+1:], f[k]) for k in f.files \
+                          if k.startswith(name + "/") and \
+                          k != name + "/class"])
+            cls = accumulator_classes[str(f[name + "/class"])]
+            stats.accumulators[name] = cls.from_state(state)
+    return stats
+
+def _saved_settings(filename) :
+    # bins and version saved with a Cloud_Statistics, or (None, None) if
+    # saved in an older format.
+    with np.load(filename) as f :
+        if "meta/format" not in f.files or \
+            int(f["meta/format"]) != stats_format :
+            return None, None
+        bins = dict([(k[len("meta/bins/"):], f[k]) for k in f.files \
+                     if k.startswith("meta/bins/")])
+        return bins, int(f["meta/version"])
+
+def _reusable(filename, bins, version) :
+    # Whether statistics saved in filename match bins and version.
+    saved_bins, saved_version = _saved_settings(filename)
+    if saved_bins is None or saved_version != version : return False
+    b = dict(default_bins)
+    if bins is not None : b.update(bins)
+    return set(saved_bins) == set(b) and \
+           all(np.array_equal(saved_bins[k], v) for k, v in b.items())
+
+def family_cloud_statistics(family_file, partial_file=None, bins=None, \
+                            version=1) :
+    """
+    Function to accumulate cloud statistics over the members of a family
+    saved by save_trajectory_family. Members are read one at a time.
+
+    Args:
+        family_file       : name of family file.
+        partial_file=None : if set, statistics are read from this file if
+                            it exists and was saved with the same bins
+                            and version (and stats_format), otherwise
+                            saved to it.
+        bins=None         : see Cloud_Statistics.
+        version=1         : version of set_cloud_class.
+
+    Returns:
+        Cloud_Statistics
+
+    """
+
+    if partial_file is not None and os.path.exists(partial_file) :
+        if _reusable(partial_file, bins, version) :
+            return load_cloud_statistics(partial_file)
+        analysis_logger.info('Recomputing %s: saved with other settings.', \
+                             partial_file)
+    stats = Cloud_Statistics(bins, version=version)
+    with Dataset(family_file) as dataset :
+        nmembers = dataset.getncattr("nmembers")
+    for member in range(nmembers) :
+        traj = load_trajectories(family_file, \
+                                 group=member_group.format(member), \
+                                 lazy=False)
+        stats.add(member_cloud_statistics(traj, version=version))
+    close_files()
+    if partial_file is not None : stats.save(partial_file)
+    return stats
+
+def _family_cloud_statistics(args) :
+    return family_cloud_statistics(*args)
+
+def aggregate_cloud_statistics(family_files, nproc=1, partial_dir=None, \
+                               bins=None, version=1) :
+    """
+    Function to accumulate cloud statistics over a list of family files,
+    with families processed in parallel worker processes.
+
+    Args:
+        family_files     : list of family files.
+        nproc=1          : number of worker processes.
+        partial_dir=None : if set, statistics for each family are saved
+                           in this directory as <family>.npz and reused
+                           if present.
+        bins=None        : see Cloud_Statistics.
+        version=1        : version of set_cloud_class.
+
+    Returns:
+        Cloud_Statistics
+
+    """
+
+    tasks = list([])
+    for family_file in family_files :
+        partial_file = None
+        if partial_dir is not None :
+            os.makedirs(partial_dir, exist_ok=True)
+            partial_file = os.path.join(partial_dir, \
+                os.path.splitext(os.path.basename(family_file))[0] + ".npz")
+        tasks.append((family_file, partial_file, bins, version))
+    total = Cloud_Statistics(bins, version=version)
+    if nproc > 1 :
+        with multiprocessing.Pool(nproc) as pool :
+            # Results are merged in order as they complete.
+            for i, stats in enumerate(pool.imap(_family_cloud_statistics, \
+                                                tasks)) :
+                analysis_logger.info('Cloud statistics for %s (%d of %d)', \
+                                     family_files[i], i+1, len(tasks))
+                total.merge(stats)
+    else :
+        for i, task in enumerate(tasks) :
+            analysis_logger.info('Cloud statistics for %s (%d of %d)', \
+                                 family_files[i], i+1, len(tasks))
+            total.merge(_family_cloud_statistics(task))
+    return total
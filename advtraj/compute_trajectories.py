@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
+import logging
 import os
+import pickle
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
 
 from netCDF4 import Dataset
 import numpy as np
 from scipy import ndimage
+from scipy import sparse
 from sklearn.cluster import KMeans
 from scipy.optimize import minimize
+
+from advtraj.instrumentation import span
+from advtraj.traj_logging import solver_logger, solver_stats_logger, \
+    io_logger, objects_logger, family_logger, analysis_logger, log_progress
 #import matplotlib.pyplot as plt
 
 L_vap = 2.501E6
@@ -19,18 +30,33 @@ mol_wt_water      =           18.0150
 epsilon           = mol_wt_water/mol_wt_air
 c_virtual         = 1.0/epsilon-1.0
 
-#debug_unsplit = True
-debug_unsplit = False
-#debug_label = True  
-debug_label = False  
-#debug_mean = True 
-debug_mean = False 
-#debug = True
-debug = False
-
-cyclic_xy = True
-#use_bilin = False
-use_bilin = True
+Traj_Config = namedtuple("Traj_Config", ["cyclic_xy", "use_bilin", \
+                         "interp_order", "debug", "debug_label", \
+                         "debug_unsplit", "debug_mean"], \
+                         defaults=(True, True, 1, False, False, False, False))
+Traj_Config.__doc__ = """
+    Immutable settings for trajectory computation and analysis, passed 
+    (as config) through Trajectory_Family, Trajectories, 
+    compute_trajectories, the step functions and the analysis functions, 
+    so that computations with different settings can run concurrently.
+    Use config._replace(...) to derive modified settings.
+
+    Fields:
+        cyclic_xy=True     : Domain is cyclic in x and y.
+        use_bilin=True     : Use tri_lin_interp rather than 
+                             ndimage.map_coordinates to interpolate.
+        interp_order=1     : Order of interpolation if not use_bilin.
+        debug=False        : Log debug information from trajectory 
+                             solver.
+        debug_label=False  : Log debug information from label_3D_cyclic.
+        debug_unsplit=False: Log debug information from unsplit_object.
+        debug_mean=False   : Log debug information from mean 
+                             calculations.
+        Debug information is logged at DEBUG level (see traj_logging).
+
+"""
+
+default_config = Traj_Config()
 
 class Trajectory_Family : 
     """
@@ -52,9 +78,28 @@ class Trajectory_Family :
         ref_func          : function to return reference trajectory positions and labels.
         in_obj_func       : function to determine which points are inside an object.
         kwargs            : any additional keyword arguments to ref_func (dict).
+        overlap_thresh=0.02: Threshold for overlap used to link objects 
+                            incrementally as members are appended.
+        nproc=1           : Number of worker processes used to compute 
+                            members in parallel. Members are still added 
+                            to the family in order of reference time. 
+                            Each worker keeps its input files open 
+                            (see Dataset_Pool). ref_func and in_obj_func 
+                            must be picklable (module level functions).
+        max_open=8        : Maximum number of files each worker keeps open.
+        config=default_config : Traj_Config settings.
+        checkpoint_dir=None : If set, each member is saved to this 
+                            directory when complete (see member_file) 
+                            and members in progress are checkpointed 
+                            every checkpoint_interval steps. Saved members 
+                            are read rather than recomputed, so an 
+                            interrupted family calculation can be 
+                            restarted with the same arguments.
+        checkpoint_interval=10 : Number of time steps between checkpoints.
     
     Attributes:
         family(list): List of trajectory objects with required reference times.
+        links(Family_Links): Incrementally maintained links between members.
     
     @author: Peter Clark
     
@@ -64,7 +109,10 @@ class Trajectory_Family :
                  first_ref_time, last_ref_time, \
                  back_len, forward_len, \
                  deltax, deltay, deltaz, \
-                 ref_func, in_obj_func, kwargs={}, variable_list=None) : 
+                 ref_func, in_obj_func, kwargs={}, variable_list=None, \
+                 overlap_thresh=0.02, nproc=1, max_open=8, \
+                 config=default_config, checkpoint_dir=None, \
+                 checkpoint_interval=10) : 
         """
         Create an instance of a family of back trajectories.
 
@@ -73,6 +121,7 @@ class Trajectory_Family :
         """
 
         self.family = list([]) 
+        self.links = Family_Links(overlap_thresh)
         
         first_ref_file, it, delta_t = find_time_in_files(files, \
                                                     first_ref_time)
@@ -80,27 +129,102 @@ class Trajectory_Family :
 #        print(first_ref_file, it, delta_t)
         if delta_t > 0.0 :                  
             dataset.close()
-            print(\
-            'Starting trajectory family calculation at time {} in file {}'.\
-            format(first_ref_time,files[first_ref_file]))
-            print('Time step is {}'.format(delta_t))
+            family_logger.info( \
+                'Starting trajectory family calculation at time %s in file %s',
+                first_ref_time, files[first_ref_file])
+            family_logger.info('Time step is %s', delta_t)
         else :
             return
         
-        for ref in np.arange(first_ref_time, last_ref_time+delta_t, delta_t):
-            print('Trajectories for reference time {}'.format(ref))
+        refs = np.arange(first_ref_time, last_ref_time+delta_t, delta_t)
+        if checkpoint_dir is not None :
+            os.makedirs(checkpoint_dir, exist_ok=True)
+        saved = [checkpoint_dir is not None and \
+                 os.path.exists(member_file(checkpoint_dir, ref)) \
+                 for ref in refs]
+        if nproc > 1 :
+            tasks = [(files, ref_prof_file, ref - back_len, ref, \
+                      ref + forward_len, deltax, deltay, deltaz, \
+                      ref_func, in_obj_func, kwargs, variable_list, config, \
+                      checkpoint_dir, checkpoint_interval) \
+                     for ref, done in zip(refs, saved) if not done]
+            with multiprocessing.Pool(nproc, \
+                                      initializer=_init_family_worker, \
+                                      initargs=(max_open,)) as pool :
+                # imap returns members in order as they complete.
+                members = pool.imap(_family_member, tasks)
+                for i, (ref, done) in enumerate(zip(refs, saved)) :
+                    family_logger.info( \
+                        'Trajectories for reference time %s (%d of %d)', \
+                        ref, i+1, len(refs))
+                    if done :
+                        self.append(load_member(checkpoint_dir, ref))
+                    else :
+                        self.append(next(members))
+            return
+        
+        for ref, done in zip(refs, saved) :
+            family_logger.info('Trajectories for reference time %s', ref)
+            if done :
+                self.append(load_member(checkpoint_dir, ref))
+                continue
             start_time = ref - back_len
             end_time = ref + forward_len  
 
-            traj = Trajectories(files, ref_prof_file, \
-                                start_time, ref, end_time, \
-                                deltax, deltay, deltaz, \
-                                ref_func, in_obj_func, kwargs=kwargs, \
-                                variable_list=variable_list) 
-            self.family.append(traj)
+            traj = _family_member((files, ref_prof_file, \
+                                   start_time, ref, end_time, \
+                                   deltax, deltay, deltaz, \
+                                   ref_func, in_obj_func, kwargs, \
+                                   variable_list, config, \
+                                   checkpoint_dir, checkpoint_interval))
+            self.append(traj)
 #            input("Press a key")
         return
     
+    def append(self, traj) :
+        """
+        Method to add a trajectory set with the next reference time to the 
+        family. Links between its max_at_ref objects and those of the 
+        previous member are found and added to self.links, using only the 
+        new member, so subsequent calls to find_super_objects and 
+        super_object_graph reuse them rather than matching every member 
+        again.
+        
+        Args:
+            traj : Trajectories object.
+            
+        """
+        
+        if getattr(self, "links", None) is None or \
+            self.links.nmembers != len(self.family) :
+            # Links missing or stale; rebuild from existing members.
+            self.links = Family_Links(getattr(getattr(self, "links", None), \
+                                              "overlap_thresh", 0.02))
+            for member in range(len(self.family)) :
+                self.links.add_member(self, member)
+        self.family.append(traj)
+        self.links.add_member(self, len(self.family) - 1)
+        return
+    
+    def _current_links(self, overlap_thresh) :
+        links = getattr(self, "links", None)
+        if links is not None and links.nmembers == len(self.family) and \
+            links.overlap_thresh == overlap_thresh :
+            return links
+        return None
+    
+    def member_links(self, member, overlap_thresh = 0.02) :
+        """
+        Method to return links between max_at_ref objects of member and 
+        member-1 (see linked_edges), from the incrementally maintained 
+        links if they were found with overlap_thresh.
+        
+        """
+        
+        links = self._current_links(overlap_thresh)
+        if links is not None : return links.links[member]
+        return self.linked_edges(member, overlap_thresh = overlap_thresh)
+    
     def matching_object_list(self, master_ref = None, select = None ):
         """
         Method to generate a list of matching objects at all times they match. 
@@ -147,6 +271,7 @@ class Trajectory_Family :
         if master_ref is None : master_ref = len(self.family) - 1
         traj = self.family[master_ref]
         if select is None : select = np.arange(0, traj.nobjects, dtype = int)
+        select = np.asarray(select, dtype = int)
         # Iterate backwards from first set before master_ref.
         for t_off in range(0, master_ref) :
             # We are looking for objects in match_traj matching those in traj.
@@ -163,25 +288,18 @@ class Trajectory_Family :
                 # Time in match_traj that matches ref_time
                 #       so match_time = master_ref - it_back
                 match_time = match_traj.ref + (t_off + 1)- it_back 
-                matching_object_at_time = list([])
-
-                # Iterate over objects in master_ref.
-                for iobj in select :
-
-                    if traj.num_in_obj[ref_time ,iobj] > 0 :
-                        b_test = traj.in_obj_box[ref_time, iobj,...]
-
-                        # Find boxes in match_traj at match_time that overlap
-                        # in_obj box for iobj at the same time.
-                        if (match_time >= 0) & \
-                          (match_time < np.shape(match_traj.in_obj_box)[0]) :
-
-                            b_set  = match_traj.in_obj_box[match_time,...]
-                            corr_box = box_overlap_with_wrap(b_test, b_set, \
-                                traj.nx, traj.ny)
-                            valid = (match_traj.num_in_obj[match_time, corr_box]>0)
-                            corr_box = corr_box[valid]
-                    matching_object_at_time.append(corr_box)
+                matching_object_at_time = list([np.array([], dtype=int) \
+                                                for iobj in select])
+
+                # Find boxes in match_traj at match_time that overlap
+                # in_obj box for each selected object at the same time.
+                if (match_time >= 0) & \
+                  (match_time < np.shape(match_traj.in_obj_box)[0]) :
+                    active = np.where(traj.num_in_obj[ref_time, select] > 0)[0]
+                    b_test = traj.in_obj_box[ref_time, select[active], ...]
+                    corr_boxes = match_traj.box_index(match_time).query(b_test)
+                    for i, corr_box in zip(active, corr_boxes) :
+                        matching_object_at_time[i] = corr_box
                 matching_objects.append(matching_object_at_time)
             mol.append(matching_objects)
         ret_dict = {"master_ref": master_ref, "objects": select, "matching_objects": mol}
@@ -264,6 +382,7 @@ class Trajectory_Family :
                 # Note match_traj.ref in general will equal traj.ref 
                 # Time in match_traj that matches ref_time
                  #       so match_time = master_ref - it_back
+            overlap = dict()
             for i, iobj in enumerate(select) :
                 objlist = list([])
                 otypelist = list([])
@@ -279,8 +398,10 @@ class Trajectory_Family :
                         
                                 if obj not in objlist : 
                                 
-                                    inter = self.refine_object_overlap(t_off, \
-                                            it_back, iobj, obj, master_ref = master_ref)
+                                    if it_back not in overlap :
+                                        overlap[it_back] = self.overlap_matrix(\
+                                            t_off, it_back, master_ref = master_ref)
+                                    inter = overlap[it_back][iobj, obj]
                                 
                                     if inter > overlap_thresh :
                                 
@@ -413,32 +534,19 @@ class Trajectory_Family :
         
         def step_obj_back(master_ref, objs) :
             found_super_objs = list([])
-            mol_dict = self.matching_object_list(master_ref = master_ref, select=objs)        
-            mol = mol_dict["matching_objects"]
-            t_off = 0
-            matching_objects = mol[t_off]
-            match_time = master_ref-(t_off+1)
-            for i,iobj in enumerate(objs) :
+            obj, mobj, pct = self.member_links(master_ref, \
+                                               overlap_thresh = overlap_thresh)
+            match_time = master_ref-1
+            split = np.searchsorted(obj, objs, side='left')
+            split_end = np.searchsorted(obj, objs, side='right')
+            for iobj, i1, i2 in zip(objs, split, split_end) :
                 objlist = list([(master_ref,iobj,100)])
-                it_back = 0
-#                print(iobj)
-#                print(master_ref,match_time, matching_objects[it_back][i])
-                for obj in matching_objects[it_back][i] :
-                    if np.size(obj) > 0 :
-                                
-                        inter = self.refine_object_overlap(t_off, \
-                                    it_back, iobj, obj, master_ref = master_ref)
-#                        print(obj,inter)        
-                        if inter > overlap_thresh :
-                            if obj in self.family[master_ref-(t_off+1)].max_at_ref :
-                                objlist.append((match_time,obj,\
-                                                int(inter*100+0.5)))
-#                                print(objlist)
-            
+                for m, p in zip(mobj[i1:i2], pct[i1:i2]) :
+                    objlist.append((match_time, m, p))
                 found_super_objs.append(objlist)
             return found_super_objs
             
-        print("Finding super-objects")
+        family_logger.info("Finding super-objects")
         if master_ref is None : master_ref = len(self.family) - 1
         select = self.family[master_ref].max_at_ref
         super_objects = list([])
@@ -483,6 +591,137 @@ class Trajectory_Family :
                          
         return super_objects, len_sup
            
+    def linked_edges(self, member, overlap_thresh = 0.02) :
+        """
+        Method to find links between objects in the max_at_ref list of a 
+        trajectory set and those in the max_at_ref list of the previous set, 
+        at the reference time of the set. 
+        Objects are linked if their in_obj boxes overlap and their 
+        fractional overlap (see overlap_matrix) exceeds overlap_thresh.
+        
+        Args: 
+            member(integer)      : Index of trajectory set in family (>0).
+            overlap_thresh=0.02  : Threshold for overlap to be sufficient for inclusion.
+                          
+        Returns:
+            obj, mobj, pct: arrays of object id in member, linked object id 
+            in member-1 and percentage overlap, sorted by obj then mobj.
+            
+        """
+        
+        with span("family_matching") as sp :
+            traj = self.family[member]
+            match_traj = self.family[member-1]
+            objs = np.asarray(traj.max_at_ref, dtype=int)
+            mobjs = np.asarray(match_traj.max_at_ref, dtype=int)
+            ref_time = traj.ref
+            match_time = match_traj.ref + 1
+            empty = np.array([], dtype=int)
+            if np.size(objs) == 0 or np.size(mobjs) == 0 or \
+                match_time >= np.shape(match_traj.in_obj_box)[0] :
+                return empty, empty, empty
+        
+            # Candidate pairs from box overlap.
+            active = objs[traj.num_in_obj[ref_time, objs] > 0]
+            q, b = match_traj.box_index(match_time).query_pairs(\
+                                       traj.in_obj_box[ref_time, active, ...])
+            obj = active[q]
+            mobj = b
+            keep = np.isin(mobj, mobjs)
+            obj = obj[keep]
+            mobj = mobj[keep]
+            if np.size(obj) == 0 :
+                return empty, empty, empty
+        
+            overlap = self.overlap_matrix(0, 0, master_ref = member)
+            inter = np.asarray(overlap[obj, mobj]).reshape(-1)
+            keep = inter > overlap_thresh
+            if sp : sp.add(pairs=np.size(obj), links=np.count_nonzero(keep))
+            pct = (inter[keep]*100+0.5).astype(int)
+            return obj[keep], mobj[keep], pct
+    
+    def super_object_graph(self, master_ref = None, overlap_thresh = 0.02) :
+        """
+        Method to build the graph of links between objects in the max_at_ref 
+        lists of consecutive trajectory sets, up to master_ref, and its 
+        connected components. 
+        An object may link to several objects in the previous set (a split 
+        looking backwards) and several objects may link to the same one 
+        (a merge), so components may be branching lineages.
+        
+        Args: 
+            master_ref=None      : Last trajectory set to include. Default is the last set.                         
+            overlap_thresh=0.02  : Threshold for overlap to be sufficient for inclusion.
+                          
+        Returns:
+            Dictionary::
+            
+                Dictionary keys::
+                  "nodes"     : array [n, 2] of (trajectory set, object id).
+                  "edges"     : array [e, 3] of (node, linked node in 
+                                previous set, percentage overlap).
+                  "component" : array [n] of component label of each node.
+            
+        """
+        
+        if master_ref is None : master_ref = len(self.family) - 1
+        links = self._current_links(overlap_thresh)
+        if links is not None and master_ref == len(self.family) - 1 :
+            return links.graph()
+        nodes = list([])
+        offset = np.zeros(master_ref+2, dtype=int)
+        for member in range(0, master_ref+1) :
+            objs = np.asarray(self.family[member].max_at_ref, dtype=int)
+            nodes.append(np.stack([np.full(np.size(objs), member), objs], \
+                                  axis=1))
+            offset[member+1] = offset[member] + np.size(objs)
+        nodes = np.concatenate(nodes, axis=0).reshape(-1, 2)
+        
+        uf = Union_Find(np.shape(nodes)[0])
+        edges = list([])
+        for member in range(1, master_ref+1) :
+            obj, mobj, pct = self.member_links(member, \
+                                               overlap_thresh = overlap_thresh)
+            i = offset[member] + np.searchsorted(\
+                    self.family[member].max_at_ref, obj)
+            j = offset[member-1] + np.searchsorted(\
+                    self.family[member-1].max_at_ref, mobj)
+            uf.union_all(i, j)
+            edges.append(np.stack([i, j, pct], axis=1))
+        if len(edges) > 0 :
+            edges = np.concatenate(edges, axis=0).reshape(-1, 3)
+        else :
+            edges = np.zeros((0, 3), dtype=int)
+        
+        return {"nodes": nodes, "edges": edges, "component": uf.components()}
+    
+    def find_super_object_components(self, master_ref = None, \
+                                     overlap_thresh = 0.02) :
+        """
+        Method to find all objects in the max_at_ref lists of the family 
+        connected (through any number of merges and splits) by links 
+        between consecutive sets. See super_object_graph.
+        
+        Args: 
+            master_ref=None      : Last trajectory set to include. Default is the last set.                         
+            overlap_thresh=0.02  : Threshold for overlap to be sufficient for inclusion.
+                          
+        Returns:
+            super_objects, len_sup
+            
+            super_objects is a list with one member for each connected 
+            component. Each member is an array of pairs containing the 
+            trajectory set and object id, sorted by trajectory set.
+            
+            len_sup is an array of the number of distinct trajectory sets 
+            (i.e. lifetime in reference times) spanned by each component.
+            
+        """
+        
+        graph = self.super_object_graph(master_ref = master_ref, \
+                                        overlap_thresh = overlap_thresh)
+        return _group_components(graph["nodes"], graph["component"])
+    
     def refine_object_overlap(self, t_off, time, obj, mobj, master_ref=None) :
         """
         Method to estimate degree of overlap between two trajectory objects.
@@ -505,42 +744,143 @@ class Trajectory_Family :
         """
         
         if master_ref == None : master_ref = len(self.family) - 1
-#        print(t_off, time, obj, mobj)
-#        print("Comparing trajectories {} and {}".format(master_ref, master_ref-(t_off+1)))
         
-        def extract_obj_as1Dint(fam, master_ref, time, obj) :
-            traj = fam[master_ref]
-            tr_time = traj.ref-time
-#            print("Time in {} is {}, {}".format(master_ref, tr_time, traj.times[tr_time]))
+        traj = self.family[master_ref]
+        match_traj = self.family[master_ref-(t_off+1)]
+        tr1D  = self.object_voxels(master_ref, traj.ref-time, obj)
+        trm1D = self.object_voxels(master_ref-(t_off+1), \
+                                   match_traj.ref-(time-(t_off+1)), mobj)
+                
+        max_size = np.max([np.size(tr1D),np.size(trm1D)])
+        if max_size > 0 :
+            intersection = sorted_intersection_size(tr1D,trm1D)/max_size
+        else :
+            intersection = 0
+        return intersection
+    
+    def overlap_matrix(self, t_off, time, master_ref=None) :
+        """
+        Method to compute the degree of overlap (as refine_object_overlap) 
+        between every pair of objects in two trajectory sets in one pass.
+            Reference objects are in self.family[master_ref] at time master_ref-time
+            Comparison objects are in self.family[master_ref-(t_off+1)] 
+            at same true time.
+        Results are held in the family Voxel_Cache.
+        
+        Args: 
+            t_off(integer)    : Comparison set is master_ref-(t_off+1).
+            time(integer)     : Reference objects are at time index ref-time.
+            master_ref=None(integer) : default is last set in family.
+                           
+        Returns: 
+            scipy.sparse.csr_matrix [nobjects, match nobjects] of 
+            fractional overlap. Pairs that do not overlap are not stored. 
+            
+        """
+        
+        if master_ref == None : master_ref = len(self.family) - 1
+        key = ("overlap", master_ref, t_off, time)
+        cache = self.voxel_cache()
+        overlap = cache.get(key)
+        if overlap is None :
+            match_ref = master_ref-(t_off+1)
+            traj = self.family[master_ref]
+            match_traj = self.family[match_ref]
+            vox, obj = self.time_voxels(master_ref, traj.ref-time)
+            mvox, mobj = self.time_voxels(match_ref, \
+                                          match_traj.ref-(time-(t_off+1)))
+            overlap = object_overlap_matrix(vox, obj, traj.nobjects, \
+                                            mvox, mobj, match_traj.nobjects)
+            cache.put(key, overlap)
+        return overlap
+    
+    def time_voxels(self, member, tr_time) :
+        """
+        Method to find the grid boxes occupied by the in_obj points of all 
+        objects at a time. See object_voxels.
+        Results are held in the family Voxel_Cache.
+        
+        Args: 
+            member(integer)  : Index of trajectory set in family.
+            tr_time(integer) : Time index in trajectory set.
+                           
+        Returns: 
+            vox, obj: arrays of unique (grid-box id, object id) pairs, 
+            sorted by object then grid box.
+            
+        """
+        
+        key = (member, tr_time, "all")
+        cache = self.voxel_cache()
+        pairs = cache.get(key)
+        if pairs is None :
+            traj = self.family[member]
+            obj_ptrs = np.logical_and(traj.labels >= 0, \
+                                      traj.labels < traj.nobjects)
+            mask, objvar = traj.in_obj_func(traj, tr_time, obj_ptrs, \
+                                            **traj.ref_func_kwargs)
+            tr = (traj.trajectory[tr_time, obj_ptrs, ... ] + 0.5).astype(int)
+            tr = tr[mask,:]
+            vox = tr[:,0] + traj.nx * (tr[:,1] + traj.ny * tr[:,2])
+            obj = traj.labels[obj_ptrs][mask]
+            order = np.lexsort((vox, obj))
+            vox = vox[order]
+            obj = obj[order]
+            new = np.ones(np.size(vox), dtype=bool)
+            new[1:] = np.logical_or(vox[1:] != vox[:-1], obj[1:] != obj[:-1])
+            pairs = np.stack([vox[new], obj[new]])
+            cache.put(key, pairs)
+        return pairs[0], pairs[1]
+    
+    def object_voxels(self, member, tr_time, obj) :
+        """
+        Method to find the grid boxes occupied by the in_obj points of an 
+        object, as sorted unique 1D integer grid-box ids. 
+        Results are held in the family Voxel_Cache so each is only 
+        computed once.
+        
+        Args: 
+            member(integer)  : Index of trajectory set in family.
+            tr_time(integer) : Time index in trajectory set.
+            obj(integer)     : Object id.
+                           
+        Returns: 
+            Sorted array of unique grid-box ids.
+            
+        """
+        
+        key = (member, tr_time, obj)
+        cache = self.voxel_cache()
+        tr1D = cache.get(key)
+        if tr1D is None :
+            traj = self.family[member]
             obj_ptrs = (traj.labels == obj)
-#            print('extr',master_ref, time, tr_time)
             mask, objvar = traj.in_obj_func(traj, tr_time, obj_ptrs, \
                                             **traj.ref_func_kwargs)
-#            mask = mask[tr_time, obj_ptrs]
-#            print(np.shape(mask))
             tr = (traj.trajectory[tr_time, obj_ptrs, ... ] + 0.5).astype(int)
-#            print(np.shape(tr))
             tr = tr[mask,:]
-#            for i in range(2) : print(np.min(tr[:,i]),np.max(tr[:,i]))
             tr1D = np.unique(tr[:,0] + traj.nx * (tr[:,1] + traj.ny * tr[:,2]))
-            return tr1D
-#        traj = self.family[master_ref]
-#        match_traj = self.family[master_ref-(t_off+1)]
-#        ref_time = traj.ref-it_back
-#        match_time = match_traj.ref + (t_off + 1)- it_back 
+            cache.put(key, tr1D)
+        return tr1D
+    
+    def voxel_cache(self) :
+        """
+        Method to return the family Voxel_Cache, creating it if need be. 
+
+        Returns: 
+            Voxel_Cache.
             
+        """
+        
+        if getattr(self, "_voxel_cache", None) is None :
+            self._voxel_cache = Voxel_Cache()
+        return self._voxel_cache
     
-        tr1D  = extract_obj_as1Dint(self.family, master_ref,           \
-                                    time, obj)
-        trm1D = extract_obj_as1Dint(self.family, master_ref-(t_off+1), \
-                                    time-(t_off+1) , mobj)
-                
-        max_size = np.max([np.size(tr1D),np.size(trm1D)])
-        if max_size > 0 :
-            intersection = np.size(np.intersect1d(tr1D,trm1D))/max_size
-        else :
-            intersection = 0
-        return intersection
+    def __getstate__(self) :
+        # Caches are not pickled.
+        state = self.__dict__.copy()
+        state.pop("_voxel_cache", None)
+        return state
             
     def __str__(self):
         rep = "Trajectories family\n"
@@ -573,6 +913,19 @@ class Trajectories :
         ref_func           : function to return reference trajectory positions and labels.
         in_obj_func        : function to determine which points are inside an object.
         kwargs             : any additional keyword arguments to ref_func (dict).
+        keep_point_data=True : If False, box and centroid properties are
+                             accumulated as each time level is computed and 
+                             the point arrays (trajectory, data, traj_error) 
+                             are not kept (set to None).
+        nproc=1            : Number of worker processes used to interpolate 
+                             fields to trajectory points (see Point_Parallel).
+        tiles=None         : Tile decomposition of domain (see 
+                             compute_trajectories).
+        halo=6             : Tile halo width.
+        config=default_config : Traj_Config settings.
+        checkpoint_file=None : File used to checkpoint and resume the 
+                             computation (see compute_trajectories).
+        checkpoint_interval=10 : Number of time steps between checkpoints.
     
     Attributes:
     
@@ -614,14 +967,21 @@ class Trajectories :
         bounding_box: box containing all trajectory points.
         in_obj_box: box containing all in_obj trajectory points.
         max_at_ref: list of objects which reach maximum LWC at reference time.
+        config: Traj_Config settings.
 
     @author: Peter Clark
     
     """
 
+    # Default for instances created without __init__ (e.g. by unpickling).
+    config = default_config
+
     def __init__(self, files, ref_prof_file, start_time, ref, end_time, \
                  deltax, deltay, deltaz, \
-                 ref_func, in_obj_func, kwargs={}, variable_list=None ) : 
+                 ref_func, in_obj_func, kwargs={}, variable_list=None, \
+                 keep_point_data=True, nproc=1, tiles=None, halo=6, \
+                 config=default_config, checkpoint_file=None, \
+                 checkpoint_interval=10) : 
         """
         Create an instance of a set of trajectories with a given reference. 
  
@@ -642,18 +1002,29 @@ class Trajectories :
                   "q_cloud_liquid_mass":r"$q_{cl}$ kg/kg", \
                   }
                   
-        dataset_ref = Dataset(ref_prof_file)
+        dataset_ref = open_dataset(ref_prof_file)
 
         self.rhoref = dataset_ref.variables['rhon'][-1,...]
         self.pref = dataset_ref.variables['prefn'][-1,...]
         self.thref = dataset_ref.variables['thref'][-1,...]
+        release_dataset(dataset_ref)
         self.piref = (self.pref[:]/1.0E5)**r_over_cp
+        if keep_point_data :
+            accumulator = None
+        else :
+            accumulator = Traj_Box_Accumulator(in_obj_func, variable_list, \
+                                               kwargs=kwargs, config=config)
         self.data, trajectory, self.traj_error, self.times, self.ref, \
         self.labels, self.nobjects, \
         self.xcoord, self.ycoord, self.zcoord, self.deltat = \
         compute_trajectories(files, start_time, ref, end_time, \
                              variable_list.keys(), self.thref, \
-                             ref_func, kwargs=kwargs) 
+                             ref_func, kwargs=kwargs, \
+                             accumulator=accumulator, nproc=nproc, \
+                             tiles=tiles, halo=halo, config=config, \
+                             checkpoint_file=checkpoint_file, \
+                             checkpoint_interval=checkpoint_interval) 
+        self.config = config
         self.ref_func=ref_func
         self.in_obj_func=in_obj_func
         self.ref_func_kwargs=kwargs
@@ -669,13 +1040,23 @@ class Trajectories :
         self.ny = np.size(self.ycoord)
         self.nz = np.size(self.zcoord)
         self.variable_list = variable_list
-        self.trajectory = unsplit_objects(trajectory, self.labels, \
-                                          self.nobjects, self.nx, self.ny)        
-        self.data_mean, self.in_obj_data_mean, self.objvar_mean, \
-            self.num_in_obj, \
-            self.centroid, self.in_obj_centroid, self.bounding_box, \
-            self.in_obj_box = compute_traj_boxes(self, in_obj_func, \
-                                                kwargs=kwargs)
+        if keep_point_data :
+            self.trajectory = unsplit_objects(trajectory, self.labels, \
+                                              self.nobjects, self.nx, self.ny, \
+                                              config=config)        
+            self.data_mean, self.in_obj_data_mean, self.objvar_mean, \
+                self.num_in_obj, \
+                self.centroid, self.in_obj_centroid, self.bounding_box, \
+                self.in_obj_box = compute_traj_boxes(self, in_obj_func, \
+                                                    kwargs=kwargs)
+        else :
+            self.trajectory = None
+            self.data = None
+            self.traj_error = None
+            self.data_mean, self.in_obj_data_mean, self.objvar_mean, \
+                self.num_in_obj, \
+                self.centroid, self.in_obj_centroid, self.bounding_box, \
+                self.in_obj_box = accumulator.boxes()
 
         max_objvar = (self.objvar_mean == np.max(self.objvar_mean, axis=0))
         when_max_objvar = np.where(max_objvar)
@@ -696,12 +1077,108 @@ class Trajectories :
 
         """
 
-        i = list(self.variable_list.keys()).index(v)
-        
-        for ii, vr in enumerate(list(self.variable_list)) :
-            if vr==v : break
-        if ii != i : print("var issue: ", self.variable_list.keys(), v, i, ii)
-        return ii
+        index = self.__dict__.get("_var_index")
+        if index is None or len(index) != len(self.variable_list) :
+            index = {vr : i for i, vr in enumerate(self.variable_list)}
+            self._var_index = index
+        return index[v]
+    
+    def reference_at_points(self) :
+        """
+        Method to return height and reference profiles at trajectory points.
+        Computed on first use and cached.
+
+        Returns:
+            tr_z, piref_z, thref_z: Arrays [nt, m] of height (m), reference 
+            Exner pressure and reference potential temperature.
+
+        """
+
+        cache = self.__dict__.setdefault("_derived_cache", dict())
+        if "_reference" not in cache :
+            tr_z = (self.trajectory[...,2]-0.5)*self.deltaz
+            zn = (np.arange(0,np.size(self.piref))-0.5)*self.deltaz
+            piref_z = np.interp(tr_z,zn,self.piref)
+            thref_z = np.interp(tr_z,zn,self.thref)
+            cache["_reference"] = (tr_z, piref_z, thref_z)
+        return cache["_reference"]
+    
+    def variable(self, v) :
+        """
+        Method to return a data or derived variable at all trajectory points.
+        Derived variables (see register_derived_variable) are computed on 
+        first use and cached.
+
+        Args:
+            v (string):  variable name.
+
+        Returns:
+            Array [nt, m].
+
+        """
+
+        if self.data is None :
+            raise ValueError("Trajectory point data not kept.")
+        if v in self.variable_list :
+            return self.data[..., self.var(v)]
+        if v not in derived_variable_functions :
+            raise ValueError("Unknown variable {}".format(v))
+        cache = self.__dict__.setdefault("_derived_cache", dict())
+        if v not in cache :
+            cache[v] = derived_variable_functions[v](self)
+        return cache[v]
+    
+    def derived_data(self, derived_variable_list=None, points=None) :
+        """
+        Method to return cached derived variables at trajectory points.
+
+        Args:
+            derived_variable_list=None : names of derived variables. 
+                Default is all registered.
+            points=None : index of points to select. Default is all.
+
+        Returns:
+            Array [nt, m, n] where n is number of derived variables.
+
+        """
+
+        if derived_variable_list is None :
+            derived_variable_list = list(derived_variables)
+        if points is None : points = slice(None)
+        s = (self.ntimes, np.size(self.labels[points]), \
+             len(derived_variable_list))
+        out = np.zeros(s)
+        for i, v in enumerate(derived_variable_list) :
+            out[...,i] = self.variable(v)[:, points]
+        return out
+    
+    def box_index(self, it) :
+        """
+        Method to return a spatial index over the in_obj boxes at a time.
+        Indices are built on first use and cached.
+
+        Args:
+            it(integer) : time index.
+
+        Returns:
+            Box_Index of in_obj_box[it] for objects with in_obj points.
+
+        """
+
+        cache = self.__dict__.setdefault("_box_index_cache", dict())
+        if it not in cache :
+            cache[it] = Box_Index(self.in_obj_box[it, ...], self.nx, self.ny, \
+                                  valid = self.num_in_obj[it, :] > 0, \
+                                  wrap = self.config.cyclic_xy)
+        return cache[it]
+    
+    def __getstate__(self) :
+        # Cached indices are cheap to rebuild so are not pickled.
+        state = self.__dict__.copy()
+        state.pop("_box_index_cache", None)
+        state.pop("_derived_cache", None)
+        state.pop("_var_index", None)
+        return state
     
     def select_object(self, iobj) :
         """
@@ -722,6 +1199,67 @@ class Trajectories :
         dat = self.data[:, in_object, ...]
         return obj, dat
     
+    def select_objects(self, objects) :
+        """
+        Method to return the trajectories of a subset of objects.
+        Labels and per-object attributes are unchanged, so analysis of 
+        the subset (e.g. cloud_properties with objects=objects) gives the 
+        same results for these objects as analysis of the full set. 
+        If the points of the objects are contiguous (as when loaded from 
+        file) they are read as a single slice.
+
+        Args:
+            objects : list or array of object ids.
+
+        Returns:
+            Trajectories object with point arrays (trajectory, data, 
+            traj_error) held in memory.
+
+        """
+
+        points = np.where(np.isin(self.labels, objects))[0]
+        if np.size(points) > 0 and \
+            points[-1] - points[0] + 1 == np.size(points) :
+            points = slice(points[0], points[-1] + 1)
+        sub = Trajectories.__new__(Trajectories)
+        sub.__dict__.update(Trajectories.__getstate__(self))
+        for name in ["trajectory", "data", "traj_error", "labels", \
+                     "point_index"] :
+            v = getattr(self, name, None)
+            if v is None : continue
+            if name in ["labels", "point_index"] :
+                setattr(sub, name, np.asarray(v[points]))
+            else :
+                setattr(sub, name, np.asarray(v[:, points, ...]))
+        sub.npoints = np.size(sub.labels)
+        return sub
+    
+    def object_blocks(self, max_points=2**20) :
+        """
+        Generator over blocks of consecutive objects with at most 
+        max_points points in total (or one object, if larger). 
+        Analysis functions can be applied to each block in turn, so that 
+        only one block of point data need be held in memory.
+
+        Args:
+            max_points=2**20 : maximum number of points in a block.
+
+        Yields:
+            objects, Trajectories object from select_objects(objects).
+
+        """
+
+        valid = np.logical_and(self.labels >= 0, self.labels < self.nobjects)
+        counts = np.bincount(self.labels[valid], minlength=self.nobjects)
+        first = 0
+        while first < self.nobjects :
+            last = first + max(1, np.searchsorted(np.cumsum(counts[first:]), \
+                                                  max_points, side='right'))
+            objects = np.arange(first, min(last, self.nobjects))
+            yield objects, self.select_objects(objects)
+            first = last
+        return
+    
     def __str__(self):
         rep = "Trajectories centred on reference Time : {}\n".\
         format(self.times[self.ref])
@@ -735,156 +1273,862 @@ class Trajectories :
           self.times[self.ref],self.ntimes,self.npoints, self.nobjects)
         return rep
 
+
+class Traj_Box_Accumulator :
+    """
+    Class to accumulate the properties computed by compute_traj_boxes one 
+    trajectory time level at a time, as the levels are produced by 
+    back_trajectory_step and forward_trajectory_step, so that the full 
+    [nt, m, 3] and [nt, m, n] arrays are not needed.
+    
+    Each level is unsplit (see unsplit_objects) before the boxes are 
+    computed, as is done for the full trajectory array in Trajectories.
+    
+    Args:
+        in_obj_func        : function to determine which points are inside an object.
+        variable_list      : List of variable names corresponding to data.
+        kwargs             : any additional keyword arguments to in_obj_func (dict).
+        config=default_config : Traj_Config settings.
         
-def dict_to_index( v) :
+    Attributes:
+        labels: Array [m] labelling points with labels 0 to nobjects-1. 
+        nobjects: Number of objects.
+        nx, ny: Number of grid points in x and y.
+        levels: List of per-level properties in time order.
+
     """
-    Method to convert variable name to numerical pointer. 
 
-    Args:
-        v (string):  variable name.
+    def __init__(self, in_obj_func, variable_list, kwargs={}, \
+                 config=default_config) :
+        self.in_obj_func = in_obj_func
+        self.config = config
+        self.variable_list = list(variable_list)
+        self.kwargs = kwargs
+        self.levels = list([])
+        
+    def set_objects(self, labels, nobjects, nx, ny) :
+        """
+        Method to set the object labels of the trajectory points.
+        
+        Args:
+            labels   : Array [m] labelling points with labels 0 to nobjects-1. 
+            nobjects : Number of objects.
+            nx, ny   : Number of grid points in x and y.
 
-    Returns:
-        Numerical pointer to data in data array.
+        """
+        
+        self.labels = labels
+        self.nobjects = nobjects
+        self.nx = nx
+        self.ny = ny
+        self.segments = object_segments(labels, nobjects)
+        return
+    
+    def var(self, v) :
+        """
+        Method to convert variable name to numerical pointer. 
 
-    @author: Peter Clark
+        Args:
+            v (string):  variable name.
 
-    """
+        Returns:
+            Numerical pointer to data in data array.
 
-    raise NotImplementedError("LD: `self` varible below doesn't exist here")
-    ii = list(self.variable_list.keys()).index(v)  # noqa
+        """
 
-#    for ii, vr in enumerate(list(self.variable_list)) :
-#        if vr==v : break
-    return ii
-    
-def compute_trajectories(files, start_time, ref_time, end_time, \
-                         variable_list, thref, ref_func, kwargs={}) :
-    """
-    Function to compute forward and back trajectories plus associated data.
+        return self.variable_list.index(v)
         
-    Args: 
-        files         : Ordered list of netcdf files containing 3D MONC output.
-        start_time    : Time corresponding to end of back trajectory.
-        ref_time      : Time at which reference objects are defined.
-        end_time      : Time corresponding to end of forward trajectory.
-        variable_list : List of variables to interpolate to trajectory points.
-        thref         : theta_ref profile.
-
-    Returns:
-        Set of variables defining trajectories::
+    def add_level(self, pos, data, at_start=False) :
+        """
+        Method to compute properties of a new time level.
         
-            data_val: Array [nt, m, n] where nt is total number of times, 
-                m the number of trajectory points at a given time and 
-                n is the number of variables in variable_list.
-            trajectory: Array [nt, m, 3] where the last index gives x,y,z 
-            traj_error: Array [nt, m, 3] with estimated error in trajectory.
-            traj_times: Array [nt] with times corresponding to trajectory.
-            labels: Array [m] labelling points with labels 0 to nobjects-1. 
-            nobjects: Number of objects.
-            xcoord: xcoordinate of model space.
-            ycoord: ycoordinate of model space.
-            zcoord: zcoordinate of model space.
-            deltat: time spacing in trajectories.
-           
-    @author: Peter Clark
+        Args:
+            pos      : Array [m, 3] of trajectory positions.
+            data     : Array [m, n] of data at pos.
+            at_start : If True the level is earlier than all so far, 
+                       otherwise later.
+
+        """
         
-    """
-    
-    print('Computing trajectories from {} to {} with reference {}.'.\
-          format(start_time, end_time, ref_time))
+        # Present this level to in_obj_func and unsplit_objects as a 
+        # single-time trajectory object.
+        self.trajectory = unsplit_objects(np.array(pos)[np.newaxis, ...], \
+                                          self.labels, self.nobjects, \
+                                          self.nx, self.ny, config=self.config)
+        self.data = np.asarray(data)[np.newaxis, ...]
+        in_obj_mask, objvar = self.in_obj_func(self, **self.kwargs)
+        stats = object_box_stats(self.trajectory, self.data, in_obj_mask, \
+                                 objvar, self.segments)
+        self.trajectory = None
+        self.data = None
+        if at_start :
+            self.levels.insert(0, stats)
+        else :
+            self.levels.append(stats)
+        return
     
-    ref_file_number, ref_time_index, delta_t = find_time_in_files(\
-                                                        files, ref_time)
+    def boxes(self) :
+        """
+        Method to return accumulated properties for all levels.
+        
+        Returns:  
+            As compute_traj_boxes.
+
+        """
+
+        return tuple(np.concatenate(s, axis=0) for s in zip(*self.levels))
+
+class Family_Links :
+    """
+    Class holding links between the max_at_ref objects of consecutive 
+    members of a Trajectory_Family, maintained incrementally as members are 
+    appended (see Trajectory_Family.append). Adding a member computes only 
+    the links between it and its predecessor (and the overlap tables 
+    needed for them) and adds them to a Union_Find over all objects.
+    
+    Args:
+        overlap_thresh=0.02 : Threshold for overlap to be sufficient for linking.
+        
+    Attributes:
+        nmembers(int)     : Number of members added.
+        union_find        : Union_Find over all nodes added.
+        nodes             : List of arrays [n, 2] of (member, object id).
+        links             : List of (obj, mobj, pct) arrays for each member 
+                            (see Trajectory_Family.linked_edges).
+        
+    """
+    
+    def __init__(self, overlap_thresh=0.02) :
+        self.overlap_thresh = overlap_thresh
+        self.nmembers = 0
+        self.union_find = Union_Find()
+        self.nodes = list([])
+        self.links = list([])
+        self.edges = list([])
+        
+    def add_member(self, family, member, links=None) :
+        """
+        Method to add links for family member (which must be the next one).
+        
+        Args:
+            family : Trajectory_Family.
+            member : Index of member in family.
+            links=None : (obj, mobj, pct) previously found for member 
+                (e.g. read from file). Default is to find them.
+            
+        """
+        
+        objs = np.asarray(family.family[member].max_at_ref, dtype=int)
+        first = self.union_find.add(np.size(objs))
+        self.nodes.append(np.stack([np.full(np.size(objs), member), objs], \
+                                   axis=1))
+        self.nmembers += 1
+        empty = np.array([], dtype=int)
+        if member == 0 : 
+            self.links.append((empty, empty, empty))
+            self.edges.append(np.zeros((0, 3), dtype=int))
+            return
+        
+        if links is None :
+            links = family.linked_edges(member, \
+                                        overlap_thresh = self.overlap_thresh)
+        obj, mobj, pct = links
+        self.links.append((obj, mobj, pct))
+        prev_objs = self.nodes[member-1][:, 1]
+        i = first + np.searchsorted(objs, obj)
+        j = first - np.size(prev_objs) + np.searchsorted(prev_objs, mobj)
+        self.union_find.union_all(i, j)
+        self.edges.append(np.stack([i, j, pct], axis=1))
+        return
+        
+    def graph(self) :
+        """
+        Method to return the link graph up to the last member.
+        
+        Returns:
+            Dictionary as Trajectory_Family.super_object_graph.
+            
+        """
+        
+        if len(self.nodes) > 0 :
+            nodes = np.concatenate(self.nodes, axis=0).reshape(-1, 2)
+            edges = np.concatenate(self.edges, axis=0).reshape(-1, 3)
+        else :
+            nodes = np.zeros((0, 2), dtype=int)
+            edges = np.zeros((0, 3), dtype=int)
+        return {"nodes": nodes, "edges": edges, \
+                "component": self.union_find.components()}
+
+class Union_Find :
+    """
+    Class implementing a disjoint-set (union-find) structure over integer 
+    nodes 0 to n-1, with union by size and path halving. Nodes can be 
+    added as needed.
+    
+    Args:
+        n=0 : Initial number of nodes.
+
+    """
+    
+    def __init__(self, n=0) :
+        self.parent = list(range(n))
+        self.size = [1] * n
+        
+    def __len__(self) :
+        return len(self.parent)
+        
+    def add(self, n=1) :
+        """
+        Method to add n new (singleton) nodes.
+        
+        Returns:
+            Id of first new node.
+
+        """
+        
+        first = len(self.parent)
+        self.parent.extend(range(first, first + n))
+        self.size.extend([1] * n)
+        return first
+        
+    def find(self, i) :
+        parent = self.parent
+        while parent[i] != i :
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    def union(self, i, j) :
+        ri = self.find(i)
+        rj = self.find(j)
+        if ri == rj : return ri
+        if self.size[ri] < self.size[rj] : ri, rj = rj, ri
+        self.parent[rj] = ri
+        self.size[ri] += self.size[rj]
+        return ri
+    
+    def union_all(self, i, j) :
+        """
+        Method to join each pair of nodes i[k], j[k].
+        
+        """
+        
+        for a, b in zip(np.asarray(i).tolist(), np.asarray(j).tolist()) :
+            self.union(a, b)
+        return
+        
+    def components(self) :
+        """
+        Method to return the component (root node) of every node.
+        
+        Returns:
+            Integer array [n].
+
+        """
+        
+        return np.array([self.find(i) for i in range(len(self.parent))], \
+                        dtype=int)
+
+def _group_components(nodes, component) :
+    """
+    Group rows of nodes [n, 2] of (trajectory set, object id) by component,
+    returning the list of groups sorted by trajectory set and an array of 
+    the number of distinct trajectory sets in each.
+    """
+    
+    order = np.lexsort((nodes[:, 1], nodes[:, 0], component))
+    comp = component[order]
+    split = np.where(comp[1:] != comp[:-1])[0] + 1
+    groups = [g for g in np.split(nodes[order], split) if len(g) > 0]
+    len_sup = np.array([np.size(np.unique(g[:, 0])) for g in groups], \
+                       dtype=int)
+    return groups, len_sup
+
+class Voxel_Cache :
+    """
+    Class providing a least-recently-used cache of arrays, e.g. the 
+    sorted voxel-id arrays used by Trajectory_Family.refine_object_overlap, 
+    keyed by (member, time index, object).
+    
+    Args:
+        max_bytes=2**28   : Maximum total size of cached arrays. Least 
+                            recently used entries are evicted beyond this.
+        max_entries=None  : Optional maximum number of entries.
+        
+    Attributes:
+        nbytes : Current total size of cached arrays.
+        hits, misses : Cache statistics.
+
+    """
+    
+    def __init__(self, max_bytes=2**28, max_entries=None) :
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._store = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key) :
+        """
+        Method to look up key, marking it as recently used.
+        
+        Returns:
+            Cached array or None.
+
+        """
+
+        value = self._store.get(key)
+        if value is None :
+            self.misses += 1
+        else :
+            self.hits += 1
+            self._store.move_to_end(key)
+        return value
+    
+    def put(self, key, value) :
+        """
+        Method to add an entry (array or scipy.sparse matrix), evicting 
+        old entries if necessary.
+        
+        """
+        
+        old = self._store.pop(key, None)
+        if old is not None : self.nbytes -= _cache_nbytes(old)
+        self._store[key] = value
+        self.nbytes += _cache_nbytes(value)
+        while len(self._store) > 1 and \
+            (self.nbytes > self.max_bytes or \
+             (self.max_entries is not None and \
+              len(self._store) > self.max_entries)) :
+            k, v = self._store.popitem(last=False)
+            self.nbytes -= _cache_nbytes(v)
+        return
+    
+    def clear(self) :
+        self._store.clear()
+        self.nbytes = 0
+        return
+        
+    def __len__(self) :
+        return len(self._store)
+    
+    def __contains__(self, key) :
+        return key in self._store
+
+def _cache_nbytes(value) :
+    if sparse.issparse(value) :
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    return value.nbytes
+
+class Dataset_Pool :
+    """
+    Class holding netCDF4 Datasets open for reading so that repeated 
+    opening of the same files (e.g. by a worker process computing several 
+    members of a Trajectory_Family) reuses them. 
+    
+    Args:
+        max_open=8 : Maximum number of open files. Least recently used 
+                     files are closed beyond this.
+        
+    Attributes:
+        hits, misses : Pool statistics.
+
+    """
+    
+    def __init__(self, max_open=8) :
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def open(self, filename) :
+        """
+        Method to return an open Dataset for filename.
+
+        """
+
+        dataset = self._open.get(filename)
+        if dataset is not None and dataset.isopen() :
+            self.hits += 1
+            self._open.move_to_end(filename)
+            return dataset
+        self.misses += 1
+        dataset = Dataset(filename)
+        self._open[filename] = dataset
+        while len(self._open) > self.max_open :
+            f, d = self._open.popitem(last=False)
+            if d.isopen() : d.close()
+        return dataset
+    
+    def close(self) :
+        for d in self._open.values() :
+            if d.isopen() : d.close()
+        self._open.clear()
+        return
+        
+    def __len__(self) :
+        return len(self._open)
+
+# Pool used by open_dataset; None (the default) opens and closes each time.
+dataset_pool = None
+
+def open_dataset(filename) :
+    """
+    Function to open a netCDF4 Dataset for reading, from dataset_pool if 
+    set. Datasets should be released with release_dataset.
+
+    """
+
+    with span("open_dataset") :
+        if dataset_pool is None : return Dataset(filename)
+        return dataset_pool.open(filename)
+
+def release_dataset(dataset) :
+    """
+    Function to release a Dataset from open_dataset, closing it unless 
+    it belongs to dataset_pool.
+
+    """
+
+    if dataset_pool is None : dataset.close()
+    return
+
+def _init_family_worker(max_open) :
+    # Each worker process keeps its input files open between members.
+    global dataset_pool
+    dataset_pool = Dataset_Pool(max_open=max_open)
+    return
+
+def _family_member(args) :
+    files, ref_prof_file, start_time, ref, end_time, \
+        deltax, deltay, deltaz, ref_func, in_obj_func, kwargs, \
+        variable_list, config, checkpoint_dir, checkpoint_interval = args
+    checkpoint_file = None
+    if checkpoint_dir is not None :
+        checkpoint_file = member_file(checkpoint_dir, ref)[:-3] + ".ckpt"
+    traj = Trajectories(files, ref_prof_file, \
+                        start_time, ref, end_time, \
+                        deltax, deltay, deltaz, \
+                        ref_func, in_obj_func, kwargs=kwargs, \
+                        variable_list=variable_list, config=config, \
+                        checkpoint_file=checkpoint_file, \
+                        checkpoint_interval=checkpoint_interval)
+    if checkpoint_dir is not None :
+        save_member(traj, checkpoint_dir, ref)
+    return traj
+
+def member_file(checkpoint_dir, ref) :
+    """
+    Function to give the name of the file holding the completed 
+    Trajectory_Family member with reference time ref.
+
+    """
+
+    return os.path.join(checkpoint_dir, "member_{:.0f}.nc".format(ref))
+
+def save_member(traj, checkpoint_dir, ref) :
+    """
+    Function to save a completed Trajectory_Family member (see 
+    trajectory_io.save_trajectories) with trajectory_io.write_atomic.
+
+    """
+
+    from advtraj.trajectory_io import save_trajectories, write_atomic
+    write_atomic(member_file(checkpoint_dir, ref), \
+                 lambda tmp : save_trajectories(traj, tmp))
+    return
+
+def load_member(checkpoint_dir, ref) :
+    """
+    Function to read a Trajectory_Family member saved by save_member.
+
+    """
+
+    from advtraj.trajectory_io import load_trajectories
+    return load_trajectories(member_file(checkpoint_dir, ref), lazy=False)
+
+class Box_Index :
+    """
+    Class providing a sort-and-sweep index over a set of rectangular boxes
+    (e.g. the in_obj boxes at one time) for overlap queries, with cyclic 
+    wrap in x and y.
+    
+    Boxes are sorted on their lower x coordinate; a query box can only 
+    overlap boxes whose lower x lies within the query box extended below 
+    by the widest box in the set, so each query only examines a contiguous 
+    run of the sorted boxes.
+    
+    Args:
+        boxes      : array[n,2,3] of box lower and upper corners.
+        nx         : number of points in x grid.
+        ny         : number of points in y grid.
+        valid=None : logical array[n]; only valid boxes are returned by 
+                     queries. Default is all.
+        wrap=None  : if True, allow overlap across the cyclic boundaries. 
+                     Default is default_config.cyclic_xy.
+
+    """
+    
+    def __init__(self, boxes, nx, ny, valid=None, wrap=None) :
+        if wrap is None : wrap = default_config.cyclic_xy
+        boxes = np.asarray(boxes)
+        ids = np.arange(np.shape(boxes)[0], dtype=int)
+        if valid is not None : ids = ids[np.asarray(valid)]
+        order = np.argsort(boxes[ids, 0, 0], kind='stable')
+        self.ids = ids[order]
+        self.lo = boxes[self.ids, 0, :]
+        self.hi = boxes[self.ids, 1, :]
+        self.nx = nx
+        self.ny = ny
+        self.wrap = wrap
+        if np.size(self.ids) > 0 :
+            self.max_width = np.max(self.hi[:, 0] - self.lo[:, 0])
+        else :
+            self.max_width = 0.0
+        return
+    
+    def query_pairs(self, b_test) :
+        """
+        Method to find all overlapping (query, box) pairs.
+        
+        Args:
+            b_test: array[m,2,3] of query boxes.
+            
+        Returns:
+            qind, bind: arrays of query index and box index (into the 
+            original boxes) for each overlapping pair, sorted by query 
+            then box.
+            
+        """
+
+        b_test = np.asarray(b_test)
+        nq = np.shape(b_test)[0]
+        if nq == 0 or np.size(self.ids) == 0 :
+            return np.array([], dtype=int), np.array([], dtype=int)
+        
+        q_lo = b_test[:, 0, :]
+        q_hi = b_test[:, 1, :]
+        if self.wrap :
+            kx = np.arange(np.floor((np.min(self.lo[:, 0]) - \
+                                     np.max(q_hi[:, 0])) / self.nx), \
+                           np.ceil((np.max(self.hi[:, 0]) - \
+                                    np.min(q_lo[:, 0])) / self.nx) + 1, \
+                           dtype=int)
+        else :
+            kx = np.array([0])
+        
+        qlist = list([])
+        blist = list([])
+        for k in kx :
+            shift = k * self.nx
+            start = np.searchsorted(self.lo[:, 0], \
+                                    q_lo[:, 0] + shift - self.max_width, \
+                                    side='left')
+            end = np.searchsorted(self.lo[:, 0], q_hi[:, 0] + shift, \
+                                  side='right')
+            ncand = np.maximum(end - start, 0)
+            if np.sum(ncand) == 0 : continue
+            q = np.repeat(np.arange(nq), ncand)
+            offsets = np.arange(np.sum(ncand)) - \
+                      np.repeat(np.cumsum(ncand) - ncand, ncand)
+            b = np.repeat(start, ncand) + offsets
+            x_overlap = self.hi[b, 0] >= q_lo[q, 0] + shift
+            qlist.append(q[x_overlap])
+            blist.append(b[x_overlap])
+            
+        if len(qlist) == 0 :
+            return np.array([], dtype=int), np.array([], dtype=int)
+        q = np.concatenate(qlist)
+        b = np.concatenate(blist)
+        
+        y_overlap = _interval_overlap_with_wrap(q_lo[q, 1], q_hi[q, 1], \
+                                                self.lo[b, 1], self.hi[b, 1], \
+                                                self.ny, self.wrap)
+        q = q[y_overlap]
+        b = self.ids[b[y_overlap]]
+        
+        key = np.unique(q * (np.max(self.ids) + 1) + b)
+        return key // (np.max(self.ids) + 1), key % (np.max(self.ids) + 1)
+    
+    def query(self, b_test) :
+        """
+        Method to find boxes overlapping each of a set of query boxes.
+        
+        Args:
+            b_test: array[m,2,3] of query boxes.
+            
+        Returns:
+            List with one array per query box of (sorted) indices of 
+            overlapping boxes.
+            
+        """
+
+        nq = np.shape(b_test)[0]
+        q, b = self.query_pairs(b_test)
+        split = np.searchsorted(q, np.arange(1, nq))
+        return np.split(b, split)
+        
+def dict_to_index( v) :
+    """
+    Method to convert variable name to numerical pointer. 
+
+    Args:
+        v (string):  variable name.
+
+    Returns:
+        Numerical pointer to data in data array.
+
+    @author: Peter Clark
+
+    """
+
+    raise NotImplementedError("LD: `self` varible below doesn't exist here")
+    ii = list(self.variable_list.keys()).index(v)  # noqa
+
+#    for ii, vr in enumerate(list(self.variable_list)) :
+#        if vr==v : break
+    return ii
+    
+def compute_trajectories(files, start_time, ref_time, end_time, \
+                         variable_list, thref, ref_func, kwargs={}, \
+                         accumulator=None, nproc=1, tiles=None, halo=6, \
+                         config=default_config, checkpoint_file=None, \
+                         checkpoint_interval=10) :
+    """
+    Function to compute forward and back trajectories plus associated data.
+        
+    Args: 
+        files         : Ordered list of netcdf files containing 3D MONC output.
+        start_time    : Time corresponding to end of back trajectory.
+        ref_time      : Time at which reference objects are defined.
+        end_time      : Time corresponding to end of forward trajectory.
+        variable_list : List of variables to interpolate to trajectory points.
+        thref         : theta_ref profile.
+        ref_func      : function to return reference trajectory positions and labels.
+        kwargs        : any additional keyword arguments to ref_func (dict).
+        accumulator=None : Traj_Box_Accumulator to be fed with each time 
+                        level as it is computed.
+        nproc=1       : Number of worker processes used to interpolate 
+                        fields to trajectory points (see Point_Parallel).
+        tiles=None    : (number in x, number in y). If set, the domain is 
+                        decomposed into tiles, each read and interpolated 
+                        by its own worker process (see Tile_Decomposition). 
+                        Overrides nproc.
+        halo=6        : Tile halo width.
+        config=default_config : Traj_Config settings.
+        checkpoint_file=None : If set, the state of the computation is 
+                        saved to this file every checkpoint_interval 
+                        steps (see save_checkpoint) and, if the file 
+                        exists, the computation resumes from it. The 
+                        file is removed when the computation completes.
+        checkpoint_interval=10 : Number of time steps between checkpoints.
+
+    Returns:
+        Set of variables defining trajectories::
+        
+            data_val: Array [nt, m, n] where nt is total number of times, 
+                m the number of trajectory points at a given time and 
+                n is the number of variables in variable_list.
+            trajectory: Array [nt, m, 3] where the last index gives x,y,z 
+            traj_error: Array [nt, m, 3] with estimated error in trajectory.
+            traj_times: Array [nt] with times corresponding to trajectory.
+            labels: Array [m] labelling points with labels 0 to nobjects-1. 
+            nobjects: Number of objects.
+            xcoord: xcoordinate of model space.
+            ycoord: ycoordinate of model space.
+            zcoord: zcoordinate of model space.
+            deltat: time spacing in trajectories.
+           
+    @author: Peter Clark
+        
+    """
+    
+    solver_logger.info('Computing trajectories from %s to %s with reference %s.', \
+                       start_time, end_time, ref_time)
+    
+    ref_file_number, ref_time_index, delta_t = find_time_in_files(\
+                                                        files, ref_time)
     
-    dataset=Dataset(files[ref_file_number])
+    dataset=open_dataset(files[ref_file_number])
     theta = dataset.variables["th"]
     ref_times = dataset.variables[theta.dimensions[0]][...]
-    print('Starting in file number {}, name {}, index {} at time {}.'.\
-          format(ref_file_number, os.path.basename(files[ref_file_number]), \
-                 ref_time_index, ref_times[ ref_time_index] ))
-    file_number = ref_file_number
-    time_index = ref_time_index
+    solver_logger.debug('Starting in file number %d, name %s, index %d at time %s.', \
+                        ref_file_number, os.path.basename(files[ref_file_number]), \
+                        ref_time_index, ref_times[ ref_time_index] )
     
-    # Find initial positions and labels using user-defined function.
-    traj_pos, labels, nobjects = ref_func(dataset, time_index, **kwargs)
+    key = (list(files), start_time, ref_time, end_time, list(variable_list))
+    state = None if checkpoint_file is None else \
+        load_checkpoint(checkpoint_file, key)
+    if state is None :
+        # Find initial positions and labels using user-defined function.
+        traj_pos, labels, nobjects = ref_func(dataset, ref_time_index, \
+                                              **kwargs)
+    else :
+        traj_pos = None
+        labels = state["labels"]
+        nobjects = state["nobjects"]
+
+    if tiles is not None :
+        (nx, ny) = theta.shape[1:3]
+        point_parallel = Tile_Decomposition(nx, ny, tiles, halo=halo, \
+                                            config=config, \
+                                            forward=end_time > ref_time)
+    elif nproc > 1 :
+        point_parallel = Point_Parallel(nproc)
+    else :
+        point_parallel = None
+    try :
+        output = _compute_trajectories(files, start_time, end_time, \
+                   variable_list, thref, accumulator, point_parallel, \
+                   dataset, ref_file_number, ref_time_index, ref_times, \
+                   traj_pos, labels, nobjects, delta_t, config, \
+                   state, key, checkpoint_file, checkpoint_interval)
+    finally :
+        if point_parallel is not None : point_parallel.close()
+    if checkpoint_file is not None and os.path.exists(checkpoint_file) :
+        os.remove(checkpoint_file)
+    return output
 
-    times = ref_times
-#    print(time_index)
-#    input("Press enter")
-    trajectory, data_val, traj_error, traj_times, xcoord, ycoord, zcoord \
-      = trajectory_init(dataset, time_index, variable_list, thref, traj_pos)
-#    input("Press enter")
-    ref_index = 0
+# Items of compute_trajectories state saved by save_checkpoint.
+checkpoint_fields = ["direction", "file_number", "time_index", "ref_index", \
+                     "trajectory", "data_val", "traj_error", "traj_times", \
+                     "xcoord", "ycoord", "zcoord", "labels", "nobjects"]
+
+def _compute_trajectories(files, start_time, end_time, variable_list, thref, \
+                          accumulator, point_parallel, dataset, \
+                          ref_file_number, ref_time_index, ref_times, \
+                          traj_pos, labels, nobjects, delta_t, config, \
+                          state, key, checkpoint_file, checkpoint_interval) :
+    # Stepping for compute_trajectories from the reference time, or from 
+    # state restored from a checkpoint.
+    if state is None :
+        direction = "back"
+        file_number = ref_file_number
+        time_index = ref_time_index
+        times = ref_times
+#        print(time_index)
+#        input("Press enter")
+        trajectory, data_val, traj_error, traj_times, xcoord, ycoord, zcoord \
+          = trajectory_init(dataset, time_index, variable_list, thref, \
+                            traj_pos, point_parallel=point_parallel, \
+                            config=config)
+#        input("Press enter")
+        ref_index = 0
     
-    print("Computing backward trajectories.")
+        if accumulator is not None :
+            accumulator.set_objects(labels, nobjects, np.size(xcoord), \
+                                    np.size(ycoord))
+            accumulator.add_level(trajectory[-1], data_val[0])
+    else :
+        direction, file_number, time_index, ref_index, \
+            trajectory, data_val, traj_error, traj_times, \
+            xcoord, ycoord, zcoord, labels, nobjects = \
+            [state[f] for f in checkpoint_fields]
+        if accumulator is not None :
+            accumulator.__dict__.update(state["accumulator"])
+        solver_logger.info('Resuming %s trajectories at time %s from %s.', \
+              direction, traj_times[0 if direction == "back" else -1], \
+              checkpoint_file)
+        release_dataset(dataset)
+        dataset = open_dataset(files[file_number])
+        theta = dataset.variables["th"]
+        times = dataset.variables[theta.dimensions[0]][...]
+
+    nsteps = 0
+    def checkpoint() :
+        if checkpoint_file is None or nsteps % checkpoint_interval != 0 :
+            return
+        values = [direction, file_number, time_index, ref_index, \
+                  trajectory, data_val, traj_error, traj_times, \
+                  xcoord, ycoord, zcoord, labels, nobjects]
+        state = dict(zip(checkpoint_fields, values))
+        if accumulator is not None :
+            state["accumulator"] = accumulator.__dict__
+        save_checkpoint(checkpoint_file, key, state)
+        return
+
+    if direction == "back" :
+        solver_logger.info("Computing backward trajectories.")
     
-    while (traj_times[0] > start_time) and (file_number >= 0) :
+    while direction == "back" and (traj_times[0] > start_time) and \
+        (file_number >= 0) :
         time_index -= 1
         if time_index >= 0 :
-            print('Time index: {} File: {}'.format(time_index, \
-                   os.path.basename(files[file_number])))
+            solver_logger.debug('Time index: %d File: %s', time_index, \
+                                os.path.basename(files[file_number]))
             trajectory, data_val, traj_error, traj_times = \
             back_trajectory_step(dataset, time_index, variable_list, thref, \
                                xcoord, ycoord, zcoord, \
-                               trajectory, data_val, traj_error, traj_times)
+                               trajectory, data_val, traj_error, traj_times, \
+                               accumulator=accumulator, \
+                               point_parallel=point_parallel, config=config)
             ref_index += 1
+            nsteps += 1
+            checkpoint()
         else :
             file_number -= 1
             if file_number < 0 :
-                print('Ran out of data.')
+                solver_logger.info('Ran out of data.')
             else :                
-                dataset.close()
-                print('File {} {}'.format(file_number, \
-                      os.path.basename(files[file_number])))
-                dataset = Dataset(files[file_number])
+                release_dataset(dataset)
+                solver_logger.debug('File %d %s', file_number, \
+                                    os.path.basename(files[file_number]))
+                dataset = open_dataset(files[file_number])
                 theta = dataset.variables["th"]
                 times = dataset.variables[theta.dimensions[0]][...]
                 time_index = len(times)
-    dataset.close()
     
+    if direction == "back" :
+        release_dataset(dataset)
 # Back to reference time for forward trajectories.
-    file_number = ref_file_number
-    time_index = ref_time_index
-    times = ref_times
-    dataset = Dataset(files[ref_file_number])
+        direction = "forward"
+        file_number = ref_file_number
+        time_index = ref_time_index
+        times = ref_times
+        dataset = open_dataset(files[ref_file_number])
 
-    print("Computing forward trajectories.")
+    solver_logger.info("Computing forward trajectories.")
          
     while (traj_times[-1] < end_time) and (file_number >= 0) :
         time_index += 1
         if time_index < len(times) :
-            print('Time index: {} File: {}'.format(time_index, \
-                   os.path.basename(files[file_number])))
+            solver_logger.debug('Time index: %d File: %s', time_index, \
+                                os.path.basename(files[file_number]))
             trajectory, data_val, traj_error, traj_times = \
                 forward_trajectory_step(dataset, time_index, \
                                         variable_list, thref, \
                                         xcoord, ycoord, zcoord, \
                                         trajectory, data_val,  traj_error, \
-                                        traj_times)
+                                        traj_times, accumulator=accumulator, \
+                                        point_parallel=point_parallel, \
+                                        config=config)
+            nsteps += 1
+            checkpoint()
         else :
             file_number += 1
             if file_number == len(files) :
-                print('Ran out of data.')
+                solver_logger.info('Ran out of data.')
             else :                
-                dataset.close()
-                print('File {} {}'.format(file_number, \
-                      os.path.basename(files[file_number])))
-                dataset = Dataset(files[file_number])
+                release_dataset(dataset)
+                solver_logger.debug('File %d %s', file_number, \
+                                    os.path.basename(files[file_number]))
+                dataset = open_dataset(files[file_number])
                 theta = dataset.variables["th"]
                 times = dataset.variables[theta.dimensions[0]][...]
                 time_index = -1
-    dataset.close()
+    release_dataset(dataset)
           
-    print('data_val: {} {} {}'.format( len(data_val), len(data_val[0]), \
-          np.size(data_val[0][0]) ) )
+    solver_logger.debug('data_val: %d %d %d', len(data_val), len(data_val[0]), \
+                        np.size(data_val[0][0]))
           
     data_val = np.reshape(np.vstack(data_val), \
                (len(data_val), len(data_val[0]), np.size(data_val[0][0]) ) )
     
-    print('trajectory: {} {} {}'.format(len(trajectory[1:]), len(trajectory[0]), \
-                               np.size(trajectory[0][0])))
-    print('traj_error: {} {} {}'.format(len(traj_error[1:]), len(traj_error[0]), \
-                               np.size(traj_error[0][0])))
+    solver_logger.debug('trajectory: %d %d %d', len(trajectory[1:]), \
+                        len(trajectory[0]), np.size(trajectory[0][0]))
+    solver_logger.debug('traj_error: %d %d %d', len(traj_error[1:]), \
+                        len(traj_error[0]), np.size(traj_error[0][0]))
 #    print np.shape()
 
     trajectory = np.reshape(np.vstack(trajectory[1:]), \
@@ -901,22 +2145,69 @@ def compute_trajectories(files, start_time, ref_time, end_time, \
       labels, nobjects, \
       xcoord, ycoord, zcoord, delta_t
 
-def extract_pos(nx, ny, dat) :
+def save_checkpoint(filename, key, state) :
+    """
+    Function to save the state of compute_trajectories so that it can be 
+    resumed. The state is pickled with trajectory_io.write_atomic, so an 
+    existing checkpoint is only replaced by a complete one.
+
+    Args:
+        filename : name of checkpoint file.
+        key      : identifies the computation (files, times and variables).
+        state    : dict with items checkpoint_fields and, if an 
+                   accumulator is in use, its attributes as "accumulator".
+
+    Returns:
+        Nothing
+
+    """
+
+    from advtraj.trajectory_io import write_atomic
+    state = dict(state)
+    state["key"] = key
+    def write(tmp) :
+        with open(tmp, "wb") as f :
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    write_atomic(filename, write)
+    return
+
+def load_checkpoint(filename, key) :
+    """
+    Function to read state saved by save_checkpoint.
+
+    Args:
+        filename : name of checkpoint file.
+        key      : identifies the computation; must match that saved.
+
+    Returns:
+        state dict, or None if filename does not exist.
+
+    """
+
+    if not os.path.exists(filename) : return None
+    with open(filename, "rb") as f :
+        state = pickle.load(f)
+    if state["key"] != key :
+        raise ValueError("Checkpoint {} is for a different computation.".\
+                         format(filename))
+    return state
+
+def extract_pos(nx, ny, dat, config=default_config) :
     """
     Function to extract 3D position from data array.
 
     Args:
         nx        : Number of points in x direction.
         ny        : Number of points in y direction.
-        dat       : Array[m,n] where n>=5 if cyclic_xy or 3 if not.
+        dat       : Array[m,n] where n>=5 if config.cyclic_xy or 3 if not.
+        config=default_config : Traj_Config settings.
 
     Returns: 
         pos       : Array[m,3]
         n_pvar    : Number of dimensions in input data used for pos.
     """
     
-    global cyclic_xy
-    if cyclic_xy :
+    if config.cyclic_xy :
         n_pvar = 5
         xpos = phase(dat[0],dat[1],nx)
         ypos = phase(dat[2],dat[3],ny)     
@@ -928,7 +2219,8 @@ def extract_pos(nx, ny, dat) :
     return pos, n_pvar
     
     
-def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
+def trajectory_init(dataset, time_index, variable_list, thref, traj_pos, \
+                    point_parallel=None, config=default_config) :
     """
     Function to set up origin of back and forward trajectories.
 
@@ -938,6 +2230,8 @@ def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
         variable_list : List of variable names.
         thref         : array with reference theta profile.
         traj_pos      : array[n,3] of initial 3D positions.
+        point_parallel=None : Point_Parallel used to interpolate to points.
+        config=default_config : Traj_Config settings.
 
     Returns: 
         Trajectory variables::
@@ -955,9 +2249,11 @@ def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
     """
     
     
-    data_list, time = load_traj_step_data(dataset, time_index, variable_list, \
-                                          thref)
-    print("Starting at time {}".format(time))
+    load = load_traj_step_data if point_parallel is None \
+        else point_parallel.load_step_data
+    data_list, time = load(dataset, time_index, variable_list, thref, \
+                           config=config)
+    solver_logger.info("Starting at time %s", time)
     
     (nx, ny, nz) = np.shape(data_list[0])
     
@@ -965,9 +2261,11 @@ def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
     ycoord = np.arange(ny, dtype='float')
     zcoord = np.arange(nz, dtype='float')
     
-    out = data_to_pos(data_list, traj_pos, xcoord, ycoord, zcoord)
+    interp = data_to_pos if point_parallel is None \
+        else point_parallel.data_to_pos
+    out = interp(data_list, traj_pos, xcoord, ycoord, zcoord, config=config)
 
-    traj_pos_new, n_pvar = extract_pos(nx, ny, out)
+    traj_pos_new, n_pvar = extract_pos(nx, ny, out, config=config)
 #    print data_list
 
 #    data_val = list([])
@@ -977,17 +2275,17 @@ def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
     
     data_val = list([np.vstack(out[n_pvar:]).T])
     
-    if debug :
+    if config.debug :
         raise NotImplementedError("LD: `variable` below doesn't exist here")
-        print('Value of {} at trajectory position.'.format(variable))  # noqa
-        print(np.shape(data_val))
-        print(np.shape(traj_pos))
-        print('xorg',traj_pos[:,0])
-        print('yorg',traj_pos[:,1])
-        print('zorg',traj_pos[:,2])
-        print('x',traj_pos_new[:,0])
-        print('y',traj_pos_new[:,1])
-        print('z',traj_pos_new[:,2])
+        solver_logger.debug('Value of %s at trajectory position.', variable)  # noqa
+        solver_logger.debug('%s', np.shape(data_val))
+        solver_logger.debug('%s', np.shape(traj_pos))
+        solver_logger.debug('xorg %s', traj_pos[:,0])
+        solver_logger.debug('yorg %s', traj_pos[:,1])
+        solver_logger.debug('zorg %s', traj_pos[:,2])
+        solver_logger.debug('x %s', traj_pos_new[:,0])
+        solver_logger.debug('y %s', traj_pos_new[:,1])
+        solver_logger.debug('z %s', traj_pos_new[:,2])
         
     trajectory = list([traj_pos])
     traj_error = list([np.zeros_like(traj_pos)])
@@ -1002,7 +2300,9 @@ def trajectory_init(dataset, time_index, variable_list, thref, traj_pos) :
 
 def back_trajectory_step(dataset, time_index, variable_list, thref, \
                          xcoord, ycoord, zcoord, \
-                         trajectory, data_val, traj_error, traj_times) :
+                         trajectory, data_val, traj_error, traj_times, \
+                         accumulator=None, point_parallel=None, \
+                         config=default_config) :
     """
     Function to execute backward timestep of set of trajectories.
     
@@ -1016,6 +2316,9 @@ def back_trajectory_step(dataset, time_index, variable_list, thref, \
         data_val       : associated data so far.
         traj_error     : estimated trajectory errors to far. 
         traj_times     : trajectory times so far.
+        accumulator=None : Traj_Box_Accumulator to add new time level to.
+        point_parallel=None : Point_Parallel used to interpolate to points.
+        config=default_config : Traj_Config settings.
 
     Returns:    
         Inputs updated to new location::
@@ -1026,29 +2329,40 @@ def back_trajectory_step(dataset, time_index, variable_list, thref, \
     
     """
         
-    data_list, time = load_traj_step_data(dataset, time_index, variable_list, \
-                                          thref)
-    print("Processing data at time {}".format(time))
+    load = load_traj_step_data if point_parallel is None \
+        else point_parallel.load_step_data
+    data_list, time = load(dataset, time_index, variable_list, thref, \
+                           config=config)
+    log_progress(solver_logger, "Processing data at time %s", time)
     
     (nx, ny, nz) = np.shape(data_list[0])
     
     traj_pos = trajectory[0]
 #    print "traj_pos ", np.shape(traj_pos), traj_pos[:,0:5]
     
-    out = data_to_pos(data_list, traj_pos, xcoord, ycoord, zcoord)
+    interp = data_to_pos if point_parallel is None \
+        else point_parallel.data_to_pos
+    out = interp(data_list, traj_pos, xcoord, ycoord, zcoord, config=config)
 
-    traj_pos_new, n_pvar = extract_pos(nx, ny, out)
+    traj_pos_new, n_pvar = extract_pos(nx, ny, out, config=config)
 
     data_val.insert(0, np.vstack(out[n_pvar:]).T)       
     trajectory.insert(0, traj_pos_new)  
     traj_error.insert(0, np.zeros_like(traj_pos_new))
     traj_times.insert(0, time)
+    
+    # Data at this time are at traj_pos; traj_pos_new is the position at 
+    # the previous time.
+    if accumulator is not None :
+        accumulator.add_level(traj_pos, data_val[0], at_start=True)
 
     return trajectory, data_val, traj_error, traj_times
     
 def forward_trajectory_step(dataset, time_index, variable_list, thref, \
                             xcoord, ycoord, zcoord, \
-                            trajectory, data_val, traj_error, traj_times) :    
+                            trajectory, data_val, traj_error, traj_times, \
+                            accumulator=None, point_parallel=None, \
+                            config=default_config) :    
     """
     Function to execute forward timestep of set of trajectories.
     
@@ -1062,6 +2376,9 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
         data_val       : associated data so far.
         traj_error     : estimated trajectory errors to far. 
         traj_times     : trajectory times so far.
+        accumulator=None : Traj_Box_Accumulator to add new time level to.
+        point_parallel=None : Point_Parallel used to interpolate to points.
+        config=default_config : Traj_Config settings.
 
     Returns: 
         Inputs updated to new location::
@@ -1072,9 +2389,11 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
         
     """
             
-    data_list, time = load_traj_step_data(dataset, time_index, variable_list, \
-                                          thref)
-    print("Processing data at time {}".format(time))
+    load = load_traj_step_data if point_parallel is None \
+        else point_parallel.load_step_data
+    data_list, time = load(dataset, time_index, variable_list, thref, \
+                           config=config)
+    log_progress(solver_logger, "Processing data at time %s", time)
     
     (nx, ny, nz) = np.shape(data_list[0])
     
@@ -1087,14 +2406,14 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
 #    print "traj_pos ", np.shape(traj_pos), traj_pos#[:,0:5]
 #    print "traj_pos_prev ",np.shape(trajectory[1]), trajectory[1]#[:,0:5]
     def print_info(kk):
-        print('kk = {} Error norm :{} Error :{}'.format(kk, mag_diff[kk], \
-              diff[:,kk]))
-        print('Looking for at this index ', \
-              [traj_pos[:,m][kk] for m in range(3)])
-        print('Nearest solution for the index', \
-              [traj_pos_at_est[kk,m] for m in range(3)])
-        print('Located at ', \
-              [traj_pos_next_est[kk,m] for m in range(3)])
+        solver_logger.debug('kk = %s Error norm :%s Error :%s', kk, \
+                            mag_diff[kk], diff[:,kk])
+        solver_logger.debug('Looking for at this index %s', \
+                            [traj_pos[:,m][kk] for m in range(3)])
+        solver_logger.debug('Nearest solution for the index %s', \
+                            [traj_pos_at_est[kk,m] for m in range(3)])
+        solver_logger.debug('Located at %s', \
+                            [traj_pos_next_est[kk,m] for m in range(3)])
         return
     
     def int3d_dist(pos) :
@@ -1108,6 +2427,8 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
 #   print ('out = {}'.format(out))
         return out
     
+    interp = data_to_pos if point_parallel is None \
+        else point_parallel.data_to_pos
     err = 1.0
     niter = 0 
     max_iter = 30
@@ -1116,112 +2437,115 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
     relax_param = 0.5
     not_converged = True
     correction_cycle = False 
-    while not_converged : 
-        out = data_to_pos(data_list, traj_pos_next_est, \
-                                  xcoord, ycoord, zcoord)
+    ncorrected = 0
+    with span("forward_solver", points=np.shape(traj_pos)[0]) as sp :
+        while not_converged : 
+            out = interp(data_list, traj_pos_next_est, \
+                         xcoord, ycoord, zcoord, config=config)
 
-        traj_pos_at_est, n_pvar = extract_pos(nx, ny, out)
+            traj_pos_at_est, n_pvar = extract_pos(nx, ny, out, config=config)
 
 #        print("traj_pos_at_est ", np.shape(traj_pos_at_est), traj_pos_at_est)#[:,0:5]
-        diff = traj_pos_at_est - traj_pos
+            diff = traj_pos_at_est - traj_pos
         
 # Deal with wrap around.
         
-        traj_pos_at_est[:,0][diff[:,0]<(-nx/2)] += nx
-        diff[:,0][diff[:,0]<(-nx/2)] += nx
-        traj_pos_at_est[:,0][diff[:,0]>=(nx/2)] -= nx
-        diff[:,0][diff[:,0]>=(nx/2)] -= nx
-        traj_pos_at_est[:,1][diff[:,1]<-(ny/2)] += ny
-        diff[:,1][diff[:,1]<-(ny/2)] += ny
-        traj_pos_at_est[:,1][diff[:,1]>=(ny/2)] -= ny
-        diff[:,1][diff[:,1]>= (ny/2)] -= ny
-        
-        mag_diff = 0
-        for i in range(3):
-            mag_diff += diff[i,:]**2
+            traj_pos_at_est[:,0][diff[:,0]<(-nx/2)] += nx
+            diff[:,0][diff[:,0]<(-nx/2)] += nx
+            traj_pos_at_est[:,0][diff[:,0]>=(nx/2)] -= nx
+            diff[:,0][diff[:,0]>=(nx/2)] -= nx
+            traj_pos_at_est[:,1][diff[:,1]<-(ny/2)] += ny
+            diff[:,1][diff[:,1]<-(ny/2)] += ny
+            traj_pos_at_est[:,1][diff[:,1]>=(ny/2)] -= ny
+            diff[:,1][diff[:,1]>= (ny/2)] -= ny
+        
+            mag_diff = 0
+            for i in range(3):
+                mag_diff += diff[i,:]**2
             
-        err = np.max(mag_diff)
-        
-        if correction_cycle :
-            print('After correction cycle {}'.format(err))
-            if debug :
-                try: 
-                    k
-                    for kk in k :
-                        print_info(kk)
-
-                except NameError:
-                    print('No k')
-            break
+            err = np.max(mag_diff)
+        
+            if correction_cycle :
+                solver_logger.debug('After correction cycle %s', err)
+                if config.debug :
+                    try: 
+                        k
+                        for kk in k :
+                            print_info(kk)
+
+                    except NameError:
+                        solver_logger.debug('No k')
+                break
         
-        if err <= errtol_iter :
-            not_converged = False
-            print(niter, err)
+            if err <= errtol_iter :
+                not_converged = False
            
-        if niter <= max_iter :
+            if niter <= max_iter :
 #            traj_pos_prev_est = traj_pos_next_est
 #            traj_pos_at_prev_est = traj_pos_at_est
-            traj_pos_next_est = traj_pos_next_est - diff * relax_param
-            niter +=1
-        else :   
-            print('Iterations exceeding {} {}'.format(max_iter, err))
-            if err > errtol :
-                bigerr = (mag_diff > errtol)    
-                if np.size(diff[:,bigerr]) > 0 :
-                    k = np.where(bigerr)[0]
-                    if debug :
-                        print('Index list into traj_pos_at_est is {}'.format(k))
-                    for kk in k :
-                        if debug :
-                            print_info(kk)            
-                        lx = np.int(np.round(traj_pos_next_est[kk,0]))
-                        ly = np.int(np.round(traj_pos_next_est[kk,1]))
-                        lz = np.int(np.round(traj_pos_next_est[kk,2]))
-                        if debug :
-                            print('Index in source array is {},{},{}'.\
-                                  format(lx,ly,lz))
+                traj_pos_next_est = traj_pos_next_est - diff * relax_param
+                niter +=1
+            else :   
+                solver_logger.warning('Iterations exceeding %d %s', max_iter, err)
+                if err > errtol :
+                    bigerr = (mag_diff > errtol)    
+                    if np.size(diff[:,bigerr]) > 0 :
+                        k = np.where(bigerr)[0]
+                        ncorrected += np.size(k)
+                        if config.debug :
+                            solver_logger.debug('Index list into traj_pos_at_est is %s', k)
+                        for kk in k :
+                            if config.debug :
+                                print_info(kk)            
+                            lx = int(np.round(traj_pos_next_est[kk,0]))
+                            ly = int(np.round(traj_pos_next_est[kk,1]))
+                            lz = int(np.round(traj_pos_next_est[kk,2]))
+                            if config.debug :
+                                solver_logger.debug('Index in source array is %d,%d,%d', \
+                                                    lx, ly, lz)
                         
-                        nd = 5
+                            nd = 5
                         
-                        xr = np.arange(lx-nd,lx+nd+1, dtype=np.intp) % nx
-                        yr = np.arange(ly-nd,ly+nd+1, dtype=np.intp) % ny
-                        zr = np.arange(lz-nd,lz+nd+1, dtype=np.intp)
+                            xr = np.arange(lx-nd,lx+nd+1, dtype=np.intp) % nx
+                            yr = np.arange(ly-nd,ly+nd+1, dtype=np.intp) % ny
+                            zr = np.arange(lz-nd,lz+nd+1, dtype=np.intp)
                         
-                        zr[zr >= nz] = nz-1
-                        zr[zr <  0 ] = 0
+                            zr[zr >= nz] = nz-1
+                            zr[zr <  0 ] = 0
                         
-                        x_real = data_list[0]
-                        x_imag = data_list[1]
-                        y_real = data_list[2]
-                        y_imag = data_list[3]
-                        z_dat   = data_list[4]
-        
-                        xpos = phase(x_real[np.ix_(xr,yr,zr)],\
-                                     x_imag[np.ix_(xr,yr,zr)],nx)
-                        ypos = phase(y_real[np.ix_(xr,yr,zr)],\
-                                     y_imag[np.ix_(xr,yr,zr)],ny)
-                        zpos = z_dat[np.ix_(xr,yr,zr)]
+                            x_real = data_list[0]
+                            x_imag = data_list[1]
+                            y_real = data_list[2]
+                            y_imag = data_list[3]
+                            z_dat   = data_list[4]
+        
+                            xpos = phase(x_real[np.ix_(xr,yr,zr)],\
+                                         x_imag[np.ix_(xr,yr,zr)],nx)
+                            ypos = phase(y_real[np.ix_(xr,yr,zr)],\
+                                         y_imag[np.ix_(xr,yr,zr)],ny)
+                            zpos = z_dat[np.ix_(xr,yr,zr)]
                         
-                        dx = xpos - traj_pos[:,0][kk]
-                        dy = ypos - traj_pos[:,1][kk]
-                        dz = zpos - traj_pos[:,2][kk]
-                        dx[dx >= (nx/2)] -= nx
-                        dx[dx < (-nx/2)] += nx
-                        dy[dy >= (ny/2)] -= ny
-                        dy[dy < (-ny/2)] += ny
+                            dx = xpos - traj_pos[:,0][kk]
+                            dy = ypos - traj_pos[:,1][kk]
+                            dz = zpos - traj_pos[:,2][kk]
+                            dx[dx >= (nx/2)] -= nx
+                            dx[dx < (-nx/2)] += nx
+                            dy[dy >= (ny/2)] -= ny
+                            dy[dy < (-ny/2)] += ny
                                                
-                        dist = dx**2 + dy**2 +dz**2
+                            dist = dx**2 + dy**2 +dz**2
                                                         
-                        lp = np.where(dist == np.min(dist))
+                            lp = np.where(dist == np.min(dist))
                         
-                        lxm = lp[0][0]
-                        lym = lp[1][0]
-                        lzm = lp[2][0]
-
-                        if debug :
-                            print('Nearest point is ({},{},{},{})'.\
-                                  format(lxm,lym,lzm, dist[lxm,lym,lzm]))
-                            print(xpos[lxm,lym,lzm],ypos[lxm,lym,lzm],zpos[lxm,lym,lzm])
+                            lxm = lp[0][0]
+                            lym = lp[1][0]
+                            lzm = lp[2][0]
+
+                            if config.debug :
+                                solver_logger.debug('Nearest point is (%d,%d,%d,%s)', \
+                                                    lxm, lym, lzm, dist[lxm,lym,lzm])
+                                solver_logger.debug('%s %s %s', xpos[lxm,lym,lzm], \
+                                                    ypos[lxm,lym,lzm], zpos[lxm,lym,lzm])
 #                            ix = (lx+lxm-nd)%nx
 #                            iy = (ly+lym-nd)%ny
 #                            print(phase(x_real[ix, iy, lz+lzm-nd],\
@@ -1232,43 +2556,55 @@ def forward_trajectory_step(dataset, time_index, variable_list, thref, \
                             
 #                            ndimage.map_coordinates(data[l], traj_pos, mode='wrap', \
 #                                          order=interp_order)
-                        envsize = 2
-                        nx1=lxm-envsize
-                        nx2=lxm+envsize+1
-                        ny1=lym-envsize
-                        ny2=lym+envsize+1
-                        nz1=lzm-envsize
-                        nz2=lzm+envsize+1
+                            envsize = 2
+                            nx1=lxm-envsize
+                            nx2=lxm+envsize+1
+                            ny1=lym-envsize
+                            ny2=lym+envsize+1
+                            nz1=lzm-envsize
+                            nz2=lzm+envsize+1
                         
-                        dist_data = dist[nx1:nx2,ny1:ny2,nz1:nz2]
-                        x0 = np.array([envsize,envsize,envsize],dtype='float')
-                        res = minimize(int3d_dist, x0, method='BFGS')
-                        #,options={'xtol': 1e-8, 'disp': True})
-                        if debug :
-                            print('New estimate, relative = {} {} '.\
-                                  format(res.x, res.fun))
-                        newx = lx-nd+lxm-envsize+res.x[0]
-                        newy = ly-nd+lym-envsize+res.x[1]
-                        newz = lz-nd+lzm-envsize+res.x[2]
-                        if debug :
-                            print('New estimate, absolute = {}'.\
-                                  format(np.array([newx,newy,newz])))                
-                        traj_pos_next_est[kk,:] = np.array([newx,newy,newz])
-                    # end kk loop
-                #  correction 
-            correction_cycle = True
-
-        traj_pos_next_est[:,0][ traj_pos_next_est[:,0] <   0 ] += nx
-        traj_pos_next_est[:,0][ traj_pos_next_est[:,0] >= nx ] -= nx
-        traj_pos_next_est[:,1][ traj_pos_next_est[:,1] <   0 ] += ny
-        traj_pos_next_est[:,1][ traj_pos_next_est[:,1] >= ny ] -= ny
-        traj_pos_next_est[:,2][ traj_pos_next_est[:,2] <   0 ]  = 0
-        traj_pos_next_est[:,2][ traj_pos_next_est[:,2] >= nz ]  = nz
+                            dist_data = dist[nx1:nx2,ny1:ny2,nz1:nz2]
+                            x0 = np.array([envsize,envsize,envsize],dtype='float')
+                            res = minimize(int3d_dist, x0, method='BFGS')
+                            #,options={'xtol': 1e-8, 'disp': True})
+                            if config.debug :
+                                solver_logger.debug('New estimate, relative = %s %s ', \
+                                                    res.x, res.fun)
+                            newx = lx-nd+lxm-envsize+res.x[0]
+                            newy = ly-nd+lym-envsize+res.x[1]
+                            newz = lz-nd+lzm-envsize+res.x[2]
+                            if config.debug :
+                                solver_logger.debug('New estimate, absolute = %s', \
+                                                    np.array([newx,newy,newz]))                
+                            traj_pos_next_est[kk,:] = np.array([newx,newy,newz])
+                        # end kk loop
+                    #  correction 
+                correction_cycle = True
+
+            traj_pos_next_est[:,0][ traj_pos_next_est[:,0] <   0 ] += nx
+            traj_pos_next_est[:,0][ traj_pos_next_est[:,0] >= nx ] -= nx
+            traj_pos_next_est[:,1][ traj_pos_next_est[:,1] <   0 ] += ny
+            traj_pos_next_est[:,1][ traj_pos_next_est[:,1] >= ny ] -= ny
+            traj_pos_next_est[:,2][ traj_pos_next_est[:,2] <   0 ]  = 0
+            traj_pos_next_est[:,2][ traj_pos_next_est[:,2] >= nz ]  = nz
         
+        sp.add(iterations=niter, corrections=ncorrected, \
+               max_err=float(err))
+    if solver_stats_logger.isEnabledFor(logging.DEBUG) :
+        solver_stats_logger.debug('niter %d err %s', niter, err, \
+            extra={"stats" : {"time" : time, "niter" : niter, \
+                              "err" : float(err), \
+                              "points" : np.shape(traj_pos)[0], \
+                              "corrected" : ncorrected, \
+                              "converged" : not not_converged}})
     data_val.append(np.vstack(out[n_pvar:]).T)       
     trajectory.append(traj_pos_next_est) 
     traj_error.append(diff)
     traj_times.append(time)
+    
+    if accumulator is not None :
+        accumulator.add_level(trajectory[-1], data_val[-1], at_start=False)
 #    print 'trajectory:',len(trajectory[:-1]), len(trajectory[0]), np.size(trajectory[0][0])
 #    print 'traj_error:',len(traj_error[:-1]), len(traj_error[0]), np.size(traj_error[0][0])
     return trajectory, data_val, traj_error, traj_times
@@ -1304,7 +2640,7 @@ def whichbox(xvec, x ) :
     ix[ix < 0] = 0
     return ix 
 
-def tri_lin_interp(data, pos, xcoord, ycoord, zcoord) :
+def tri_lin_interp(data, pos, xcoord, ycoord, zcoord, origin=None) :
     """
     Tri-linear interpolation with cyclic wrapround in x and y.
     
@@ -1314,6 +2650,9 @@ def tri_lin_interp(data, pos, xcoord, ycoord, zcoord) :
         xcoord: 1D coordinate vector.
         ycoord: 1D coordinate vector.
         zcoord: 1D coordinate vector.
+        origin=None: (x, y) index in the full domain of data[...][0, 0] 
+            if data cover only part of it (see Tile_Decomposition). 
+            Coordinates are those of the full domain.
     
     Returns:
         list of 1D arrays of data interpolated to pos.
@@ -1340,6 +2679,7 @@ def tri_lin_interp(data, pos, xcoord, ycoord, zcoord) :
     wx = [1.0 - xp, xp]
     wy = [1.0 - yp, yp]
     wz = [1.0 - zp, zp]
+    if origin is None : origin = (0, 0)
     output= list([])
     for l in range(len(data)) :
         output.append(np.zeros_like(x))
@@ -1349,14 +2689,16 @@ def tri_lin_interp(data, pos, xcoord, ycoord, zcoord) :
             for k in range(0,2):
                 w = wx[i]*wy[j]*wz[k]
                 t += w
+                ixl = ((ix+i)%nx - origin[0]) % nx
+                iyl = ((iy+j)%ny - origin[1]) % ny
                 for l in range(len(data)) :
-                    output[l] = output[l] + data[l][(ix+i)%nx,(iy+j)%ny,iz+k]*w
+                    output[l] = output[l] + data[l][ixl,iyl,iz+k]*w
 #                print 'Adding', ix+i,iy+j,iz+k,w,data[ix+i,iy+j,iz+k]
 #    print xp, yp, zp
 #    print t
     return output
 
-def data_to_pos(data, pos, xcoord, ycoord, zcoord):
+def data_to_pos(data, pos, xcoord, ycoord, zcoord, config=default_config):
     """
     Function to interpolate data to pos.
     
@@ -1364,6 +2706,7 @@ def data_to_pos(data, pos, xcoord, ycoord, zcoord):
         data      : list of data array.
         pos       : array[n,3] of n 3D positions.
         xcoord,ycoord,zcoord: 1D arrays giving coordinate spaces of data.
+        config=default_config : Traj_Config settings.
                       
     Returns: 
         list of arrays containing interpolated data.   
@@ -1372,25 +2715,367 @@ def data_to_pos(data, pos, xcoord, ycoord, zcoord):
     
     """
     
-    global interp_order
-    if use_bilin :
-        output = tri_lin_interp(data, pos, xcoord, ycoord, zcoord )
-    else:
-        output= list([])
-        for l in range(len(data)) :
-#            print 'Calling map_coordinates'
-#            print np.shape(data[l]), np.shape(traj_pos)
-            out = ndimage.map_coordinates(data[l], pos, mode='wrap', \
-                                          order=interp_order)
-            output.append(out)
+    with span("data_to_pos", points=np.shape(pos)[0], fields=len(data)) :
+        if config.use_bilin :
+            output = tri_lin_interp(data, pos, xcoord, ycoord, zcoord )
+        else:
+            output= list([])
+            for l in range(len(data)) :
+#                print 'Calling map_coordinates'
+#                print np.shape(data[l]), np.shape(traj_pos)
+                out = ndimage.map_coordinates(data[l], pos.T, mode='wrap', \
+                                              order=config.interp_order)
+                output.append(out)
     return output
 
-def load_traj_pos_data(dataset, it) :
+class Point_Parallel :
+    """
+    Class to interpolate fields to trajectory points (as data_to_pos) 
+    using a pool of worker processes, each working on a contiguous slice 
+    of the points. The fields for each snapshot are copied once into 
+    multiprocessing.shared_memory blocks, which the workers map without 
+    copying. Results are reassembled in point order, so are identical to 
+    data_to_pos.
+    
+    The forward solver's convergence test and iteration count apply to 
+    all points together, so the iteration stays in the calling process 
+    and only the interpolation at each iteration is split between workers.
+
+    Args:
+        nproc            : Number of worker processes.
+        min_points=1000  : Fewer points than this are interpolated serially.
+
+    """
+    
+    def __init__(self, nproc, min_points=1000) :
+        self.nproc = nproc
+        self.min_points = min_points
+        # Started before the workers so that they share it; shared memory 
+        # blocks are then unlinked and unregistered only by this process.
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(nproc)
+        self._data = None
+        self._shm = list([])
+        self._fields = list([])
+        
+    def set_fields(self, data) :
+        """
+        Method to copy a list of 3D field arrays into shared memory, unless 
+        they are already there.
+
+        """
+
+        if data is self._data : return
+        self._free()
+        for d in data :
+            d = np.asarray(d)
+            shm = shared_memory.SharedMemory(create=True, \
+                                             size=max(1, d.nbytes))
+            np.ndarray(d.shape, dtype=d.dtype, buffer=shm.buf)[...] = d
+            self._shm.append(shm)
+            self._fields.append((shm.name, d.shape, d.dtype.str))
+        self._data = data
+        return
+    
+    def load_step_data(self, dataset, it, variable_list, thref, \
+                       config=default_config) :
+        """
+        Method to read fields for a time, as load_traj_step_data.
+
+        """
+
+        return load_traj_step_data(dataset, it, variable_list, thref, \
+                                   config=config)
+    
+    def data_to_pos(self, data, pos, xcoord, ycoord, zcoord, \
+                    config=default_config) :
+        """
+        Method to interpolate data to pos, as data_to_pos.
+
+        """
+
+        npts = np.shape(pos)[0]
+        if npts < self.min_points :
+            return data_to_pos(data, pos, xcoord, ycoord, zcoord, \
+                               config=config)
+        with span("point_parallel_data_to_pos", points=npts, \
+                  fields=len(data)) :
+            self.set_fields(data)
+            bounds = np.linspace(0, npts, self.nproc + 1).astype(int)
+            tasks = [(self._fields, pos[i0:i1, ...], xcoord, ycoord, \
+                      zcoord, config) \
+                     for i0, i1 in zip(bounds[:-1], bounds[1:])]
+            parts = self.pool.map(_data_to_pos_slice, tasks)
+        return [np.concatenate([part[l] for part in parts]) \
+                for l in range(len(data))]
+    
+    def _free(self) :
+        for shm in self._shm :
+            shm.close()
+            shm.unlink()
+        self._shm = list([])
+        self._fields = list([])
+        self._data = None
+        return
+        
+    def close(self) :
+        self.pool.close()
+        self.pool.join()
+        self._free()
+        return
+
+# Shared memory blocks attached by a Point_Parallel worker.
+_worker_fields = dict()
+
+def _data_to_pos_slice(args) :
+    fields, pos, xcoord, ycoord, zcoord, config = args
+    names = [f[0] for f in fields]
+    for name in list(_worker_fields) :
+        if name not in names :
+            _worker_fields.pop(name)[0].close()
+    data = list([])
+    for name, shape, dtype in fields :
+        if name not in _worker_fields :
+            # The creating process is responsible for unlinking.
+            shm = shared_memory.SharedMemory(name=name)
+            _worker_fields[name] = (shm, np.ndarray(shape, dtype=dtype, \
+                                                    buffer=shm.buf))
+        data.append(_worker_fields[name][1])
+    return data_to_pos(data, pos, xcoord, ycoord, zcoord, config=config)
+
+class Tile_Decomposition :
+    """
+    Class to step trajectories with the horizontal domain decomposed into 
+    tiles, each handled by a worker process which reads only its tile plus 
+    a halo from file (as netCDF hyperslabs, wrapping cyclically) at each 
+    time. Used as the point_parallel argument of the stepping functions, 
+    it replaces load_traj_step_data and data_to_pos. 
+    
+    Point positions stay in the calling process; at each interpolation 
+    points are sent to the tile containing their grid box, so points 
+    migrate between tiles (including across the cyclic boundary) as they 
+    move. Interpolation is done as tri_lin_interp on the full domain, so 
+    results are identical. Memory for fields in each worker is 
+    proportional to the tile size.
+
+    Args:
+        nx, ny     : Size of full domain.
+        tiles      : (number of tiles in x, number of tiles in y).
+        halo=6     : Halo width. At least 1 is needed for interpolation 
+                     and 6 for the forward solver correction step.
+        config=default_config : Traj_Config settings. config.use_bilin 
+                     must be True.
+        forward=True : Forward steps will be run, so the halo must 
+                     allow for the correction step.
+
+    """
+    
+    def __init__(self, nx, ny, tiles, halo=6, config=default_config, \
+                 forward=True) :
+        if not config.use_bilin :
+            raise ValueError("Tile decomposition requires use_bilin.")
+        if halo < 1 :
+            raise ValueError("Tile halo must be at least 1.")
+        if forward and halo < 6 :
+            raise ValueError("Tile halo must be at least 6 for forward "
+                             "trajectories.")
+        self.config = config
+        self.nx = nx
+        self.ny = ny
+        self.tiles = tiles
+        self.halo = halo
+        self.xbounds = (np.arange(tiles[0]+1) * nx) // tiles[0]
+        self.ybounds = (np.arange(tiles[1]+1) * ny) // tiles[1]
+        self.workers = list([])
+        for i in range(tiles[0]) :
+            for j in range(tiles[1]) :
+                xidx = self._tile_index(self.xbounds[i:i+2], nx)
+                yidx = self._tile_index(self.ybounds[j:j+2], ny)
+                parent, child = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=_tile_worker, \
+                           args=(child, nx, ny, (xidx, yidx), config), \
+                           daemon=True)
+                proc.start()
+                self.workers.append((parent, proc, (xidx[0], yidx[0])))
+                
+    def _tile_index(self, bounds, n) :
+        # Global (cyclic) indices of tile with halo.
+        if bounds[1] - bounds[0] + 2 * self.halo >= n :
+            return np.arange(n)
+        return np.arange(bounds[0] - self.halo, bounds[1] + self.halo) % n
+    
+    def _tile(self, ix, iy) :
+        # Tile number of grid box (ix, iy).
+        i = np.searchsorted(self.xbounds, ix % self.nx, side='right') - 1
+        j = np.searchsorted(self.ybounds, iy % self.ny, side='right') - 1
+        return i * self.tiles[1] + j
+        
+    def load_step_data(self, dataset, it, variable_list, thref, \
+                       config=None) :
+        """
+        Method to read fields for a time into the tiles. Settings are 
+        those given when the tiles were created.
+
+        Returns:
+            Tiled_Fields, time.
+        
+        """
+
+        for conn, proc, origin in self.workers :
+            conn.send(("load", dataset.filepath(), it, list(variable_list), \
+                       np.asarray(thref)))
+        time = [_tile_reply(conn) for conn, proc, origin in self.workers][0]
+        nz = dataset.variables["th"].shape[-1]
+        n_pvar = 5 if self.config.cyclic_xy else 3
+        return Tiled_Fields(self, n_pvar + len(variable_list), \
+                            (self.nx, self.ny, nz)), time
+        
+    def data_to_pos(self, data, pos, xcoord, ycoord, zcoord, config=None) :
+        """
+        Method to interpolate tiled data to pos, as data_to_pos.
+
+        """
+
+        with span("tile_data_to_pos", points=np.shape(pos)[0], \
+                  fields=len(data)) :
+            tile = self._tile(whichbox(xcoord, pos[:,0]), \
+                              whichbox(ycoord, pos[:,1]))
+            points = [np.where(tile == t)[0] for t in range(len(self.workers))]
+            for (conn, proc, origin), pts in zip(self.workers, points) :
+                if np.size(pts) > 0 :
+                    conn.send(("interp", pos[pts, :], xcoord, ycoord, zcoord))
+            output = [np.zeros(np.shape(pos)[0]) for l in range(len(data))]
+            for (conn, proc, origin), pts in zip(self.workers, points) :
+                if np.size(pts) > 0 :
+                    for l, out in enumerate(_tile_reply(conn)) :
+                        output[l][pts] = out
+        return output
+    
+    def window(self, l, index) :
+        """
+        Method to return field l at np.ix_ style index (in full domain 
+        grid boxes) from the tile containing its centre.
+
+        """
+
+        xr, yr, zr = [np.ravel(i) for i in index]
+        t = self._tile(xr[len(xr)//2], yr[len(yr)//2])
+        conn, proc, origin = self.workers[t]
+        conn.send(("window", l, xr, yr, zr))
+        return _tile_reply(conn)
+        
+    def close(self) :
+        # Workers which have died (e.g. after an error) are skipped.
+        for conn, proc, origin in self.workers :
+            try :
+                conn.send(("close",))
+            except OSError :
+                pass
+        for conn, proc, origin in self.workers :
+            proc.join(timeout=10)
+            if proc.is_alive() : proc.terminate()
+            conn.close()
+        self.workers = list([])
+        return
+
+class Tiled_Fields :
+    """
+    Class standing in for the list of field arrays returned by 
+    load_traj_step_data when fields are held by a Tile_Decomposition. 
+    Items support np.shape and np.ix_ indexing only.
+
+    """
+    
+    def __init__(self, tiles, nfields, shape) :
+        self.tiles = tiles
+        self.nfields = nfields
+        self.shape = shape
+        
+    def __len__(self) :
+        return self.nfields
+    
+    def __getitem__(self, l) :
+        return _Tiled_Field(self, l)
+
+class _Tiled_Field :
+    
+    def __init__(self, fields, l) :
+        self.fields = fields
+        self.l = l
+        self.shape = fields.shape
+        
+    def __getitem__(self, index) :
+        return self.fields.tiles.window(self.l, index)
+
+def _tile_reply(conn) :
+    # Result of a request to a tile worker, re-raising its exception.
+    try :
+        status, value = conn.recv()
+    except EOFError :
+        raise RuntimeError("Tile worker process has died.")
+    if status == "error" : raise value
+    return value
+
+def _tile_worker(conn, nx, ny, region, config) :
+    # Serve requests for one tile until closed. Replies are ("ok", result) 
+    # or ("error", exception).
+    pool = Dataset_Pool()
+    fields = None
+    xidx, yidx = region
+    while True :
+        request = conn.recv()
+        if request[0] == "close" :
+            pool.close()
+            conn.close()
+            return
+        try :
+            if request[0] == "load" :
+                filename, it, variable_list, thref = request[1:]
+                fields, result = load_traj_step_data(pool.open(filename), \
+                                       it, variable_list, thref, \
+                                       region=region, config=config)
+            elif request[0] == "interp" :
+                pos, xcoord, ycoord, zcoord = request[1:]
+                result = tri_lin_interp(fields, pos, xcoord, ycoord, zcoord, \
+                                        origin=(xidx[0], yidx[0]))
+            elif request[0] == "window" :
+                l, xr, yr, zr = request[1:]
+                result = fields[l][np.ix_((xr - xidx[0]) % nx, \
+                                          (yr - yidx[0]) % ny, zr)]
+            else :
+                raise ValueError("Unknown request {}".format(request[0]))
+        except Exception as e :
+            try :
+                conn.send(("error", e))
+            except Exception :
+                # Exception cannot be pickled.
+                conn.send(("error", RuntimeError(repr(e))))
+            continue
+        conn.send(("ok", result))
+
+def _read_field(var, it, region=None) :
+    # Read var[it, ...], or the (cyclic) x and y indices in region.
+    if region is None : return var[it,...]
+    parts = list([])
+    for ix in _index_runs(region[0]) :
+        parts.append(np.concatenate([var[it, ix, iy, ...] \
+                     for iy in _index_runs(region[1])], axis=1))
+    return np.concatenate(parts, axis=0)
+
+def _index_runs(index) :
+    # Split index array into slices of consecutive indices.
+    breaks = np.where(np.diff(index) != 1)[0] + 1
+    return [slice(r[0], r[-1]+1) for r in np.split(index, breaks)]
+
+def load_traj_pos_data(dataset, it, region=None, config=default_config) :
     """
     Function to read trajectory position variables from file.
     Args: 
         dataset        : netcdf file handle.
         it             : time index in netcdf file.
+        region=None    : (x indices, y indices) of part of the domain 
+                         to read. Default is all.
+        config=default_config : Traj_Config settings.
 
     Returns:    
         List of arrays containing interpolated data.
@@ -1421,23 +3106,23 @@ def load_traj_pos_data(dataset, it) :
                       'zpos':'tracer_traj_zr' } 
         
         
-    if cyclic_xy :
-        xr = dataset.variables[trv['xr']][it,...]
-        xi = dataset.variables[trv['xi']][it,...]
+    if config.cyclic_xy :
+        xr = _read_field(dataset.variables[trv['xr']], it, region)
+        xi = _read_field(dataset.variables[trv['xi']], it, region)
 
-        yr = dataset.variables[trv['yr']][it,...]
-        yi = dataset.variables[trv['yi']][it,...]
+        yr = _read_field(dataset.variables[trv['yr']], it, region)
+        yi = _read_field(dataset.variables[trv['yi']], it, region)
     
         zpos = dataset.variables[trv['zpos']]
-        zposd = zpos[it,...]
+        zposd = _read_field(zpos, it, region)
         data_list = [xr, xi, yr, yi, zposd]      
         
     else :
         # Non-cyclic option may well not work anymore!
-        xpos = dataset.variables[trv_noncyc['xpos']][it,...]
-        ypos = dataset.variables[trv_noncyc['ypos']][it,...]
+        xpos = _read_field(dataset.variables[trv_noncyc['xpos']], it, region)
+        ypos = _read_field(dataset.variables[trv_noncyc['ypos']], it, region)
         zpos = dataset.variables[trv_noncyc['zpos']]
-        zposd = zpos[it,...]  
+        zposd = _read_field(zpos, it, region)
         data_list = [xpos, ypos, zposd]
 
 # Needed as zpos above is numpy array not NetCDF variable. 
@@ -1446,7 +3131,8 @@ def load_traj_pos_data(dataset, it) :
              
     return data_list, times[it]  
         
-def load_traj_step_data(dataset, it, variable_list, thref) :
+def load_traj_step_data(dataset, it, variable_list, thref, region=None, \
+                        config=default_config) :
     """
     Function to read trajectory variables and additional data from file 
     for interpolation to trajectory.
@@ -1456,6 +3142,9 @@ def load_traj_step_data(dataset, it, variable_list, thref) :
         it             : time index in netcdf file.
         variable_list  : List of variable names.
         thref          : Array with reference theta profile.
+        region=None    : (x indices, y indices) of part of the domain 
+                         to read. Default is all.
+        config=default_config : Traj_Config settings.
 
     Returns:    
         List of arrays containing interpolated data.
@@ -1464,15 +3153,19 @@ def load_traj_step_data(dataset, it, variable_list, thref) :
         
     """
     
-    data_list, time = load_traj_pos_data(dataset, it)
+    with span("load_traj_step_data") as sp :
+        data_list, time = load_traj_pos_data(dataset, it, region=region, \
+                                             config=config)
         
-    for variable in variable_list :
-#        print 'Reading ', variable
-        data = dataset.variables[variable]
-        data = data[it,...]
-        if variable == 'th' :
-            data = data+thref[...]
-        data_list.append(data)   
+        for variable in variable_list :
+#            print 'Reading ', variable
+            data = dataset.variables[variable]
+            data = _read_field(data, it, region)
+            if variable == 'th' :
+                data = data+thref[...]
+            data_list.append(data)   
+        if sp : sp.add(fields=len(data_list), \
+                       bytes=sum(d.nbytes for d in data_list))
         
     return data_list, time  
     
@@ -1498,7 +3191,7 @@ def phase(vr, vi, n) :
     vpos[vpos<0] += n
     return vpos    
        
-def label_3D_cyclic(mask) :
+def label_3D_cyclic(mask, config=default_config) :
     """
     Function to label 3D objects taking account of cyclic boundary 
     in x and y. Uses ndimage(label) as primary engine.
@@ -1506,6 +3199,7 @@ def label_3D_cyclic(mask) :
     Args:
         mask: 3D logical array with object mask (i.e. objects are 
             contiguous True).  
+        config=default_config : Traj_Config settings.
 
     Returns:   
         Object identifiers::
@@ -1519,21 +3213,19 @@ def label_3D_cyclic(mask) :
     
 #    print np.shape(mask)        
     (nx, ny, nz) = np.shape(mask)
-    labels, nobjects = ndimage.label(mask)
-    labels -=1
 #    print 'labels', np.shape(labels)     
     def relabel(labs, nobjs, i,j) :
-#        if debug_label : 
+#        if config.debug_label : 
 #            print('Setting label {:3d} to {:3d}'.format(j,i)) 
         lj = (labs == j)
         labs[lj] = i
         for k in range(j+1,nobjs) :
             lk = (labs == k)
             labs[lk] = k-1
-#            if debug_label : 
+#            if config.debug_label : 
 #                print('Setting label {:3d} to {:3d}'.format(k,k-1)) 
         nobjs -= 1
-#        if debug_label : print('nobjects = {:d}'.format(nobjects))
+#        if config.debug_label : print('nobjects = {:d}'.format(nobjects))
         return labs, nobjs
     
     def find_objects_at_edge(minflag, x_or_y, n, labs, nobjs) :
@@ -1549,9 +3241,9 @@ def label_3D_cyclic(mask) :
                 test1 = (np.max(posi[x_or_y][:]) == (n-1))
                 border = 'n{}-1'.format(['x','y'][x_or_y])
             if test1 :
-                if debug_label : 
-                    print('Object {:03d} on {}={} border?'.\
-                          format(i,['x','y'][x_or_y],border))
+                if config.debug_label : 
+                    objects_logger.debug('Object %03d on %s=%s border?', \
+                                         i, ['x','y'][x_or_y], border)
                 j = i+1
                 while j < (nobjs-1) :
                     posj = np.where(labs == j)
@@ -1564,9 +3256,9 @@ def label_3D_cyclic(mask) :
                         border = '0'
                         
                     if test2 :
-                        if debug_label : 
-                            print('Match Object {:03d} on {}={} border?'\
-                                  .format(j,['x','y'][x_or_y],border))
+                        if config.debug_label : 
+                            objects_logger.debug('Match Object %03d on %s=%s border?', \
+                                                 j, ['x','y'][x_or_y], border)
                             
                         if minflag :
                             ilist = np.where(posi[x_or_y][:] == 0)
@@ -1580,8 +3272,8 @@ def label_3D_cyclic(mask) :
                             if np.size( np.intersect1d(posi[2][ilist], \
                                            posj[2][jlist]) ) :
                             
-                                if debug_label : 
-                                    print('Yes!',i,j)
+                                if config.debug_label : 
+                                    objects_logger.debug('Yes! %d %d', i, j)
 #                                    for ii in range(3) : 
 #                                        print(ii, posi[ii][posi[x_or_y][:] \
 #                                                       == 0])
@@ -1593,14 +3285,18 @@ def label_3D_cyclic(mask) :
             i += 1
         return labs, nobjs
 
-    labels, nobjects = find_objects_at_edge(True,  0, nx, labels, nobjects)
-    labels, nobjects = find_objects_at_edge(False, 0, nx, labels, nobjects)
-    labels, nobjects = find_objects_at_edge(True,  1, ny, labels, nobjects)
-    labels, nobjects = find_objects_at_edge(False, 1, ny, labels, nobjects)
+    with span("label_3D_cyclic", points=np.size(mask)) as sp :
+        labels, nobjects = ndimage.label(mask)
+        labels -=1
+        labels, nobjects = find_objects_at_edge(True,  0, nx, labels, nobjects)
+        labels, nobjects = find_objects_at_edge(False, 0, nx, labels, nobjects)
+        labels, nobjects = find_objects_at_edge(True,  1, ny, labels, nobjects)
+        labels, nobjects = find_objects_at_edge(False, 1, ny, labels, nobjects)
+        sp.add(objects=nobjects)
        
     return labels, nobjects
 
-def unsplit_object( pos, nx, ny ) :
+def unsplit_object( pos, nx, ny, config=default_config ) :
     """
     Function to gather together points in object separated by cyclic boundaries. 
         For example, if an object spans the 0/nx boundary, so some 
@@ -1612,6 +3308,7 @@ def unsplit_object( pos, nx, ny ) :
     Args: 
         pos      : grid positions of points in object.
         nx,ny    : number of grid points in x and y directions.
+        config=default_config : Traj_Config settings.
     Returns:    
         Adjusted grid positions of points in object.
   
@@ -1619,29 +3316,29 @@ def unsplit_object( pos, nx, ny ) :
         
     """
     
-    global debug_unsplit
-    if debug_unsplit : print('pos:', pos)
+    if config.debug_unsplit : objects_logger.debug('pos: %s', pos)
     n_clust = np.min([4,np.shape(pos)[0]])
-    if debug_unsplit : print('Shape(pos):',np.shape(pos), \
-                             'Number of clutsters:', n_clust)
+    if config.debug_unsplit : objects_logger.debug( \
+        'Shape(pos): %s Number of clutsters: %d', np.shape(pos), n_clust)
     kmeans = KMeans(n_clusters=n_clust)
 #    print(kmeans)
     kmeans.fit(pos)
 #    print(kmeans)
     
-    if debug_unsplit : print('Shape(cluster centres):', \
-                            np.shape(kmeans.cluster_centers_))
-    if debug_unsplit : print('Cluster centres: ',kmeans.cluster_centers_)
+    if config.debug_unsplit : objects_logger.debug( \
+        'Shape(cluster centres): %s', np.shape(kmeans.cluster_centers_))
+    if config.debug_unsplit : objects_logger.debug('Cluster centres: %s', \
+                                                   kmeans.cluster_centers_)
     counts = np.zeros(n_clust,dtype=int)
     for i in range(n_clust):
         counts[i] = np.count_nonzero(kmeans.labels_ == i)
-    if debug_unsplit : print(counts)
+    if config.debug_unsplit : objects_logger.debug('%s', counts)
     main_cluster = np.where(counts == np.max(counts))[0]
     def debug_print(j) :
-        print('Main cluster:', main_cluster, 'cluster number: ', i, \
-              'dist:', dist)
-        print('Cluster centres:', kmeans.cluster_centers_)           
-        print('Changing ', pos[kmeans.labels_ == i,j])
+        objects_logger.debug('Main cluster: %s cluster number: %d dist: %s', \
+                             main_cluster, i, dist)
+        objects_logger.debug('Cluster centres: %s', kmeans.cluster_centers_)
+        objects_logger.debug('Changing %s', pos[kmeans.labels_ == i,j])
         return
     
     for i in range(n_clust):     
@@ -1649,21 +3346,22 @@ def unsplit_object( pos, nx, ny ) :
 #        print 'dist', dist
         dist = dist[0]
         if (dist[0] < -nx/2) :
-            if debug_unsplit : debug_print(0)
+            if config.debug_unsplit : debug_print(0)
             pos[kmeans.labels_ == i,0] = pos[kmeans.labels_ == i,0] + nx
         if (dist[0] >  nx/2) :
-            if debug_unsplit : debug_print(0)
+            if config.debug_unsplit : debug_print(0)
             pos[kmeans.labels_ == i,0] = pos[kmeans.labels_ == i,0] - nx
         if (dist[1] < -ny/2) :
-            if debug_unsplit : debug_print(1)
+            if config.debug_unsplit : debug_print(1)
             pos[kmeans.labels_ == i,1] = pos[kmeans.labels_ == i,1] + ny
         if (dist[1] >  ny/2) :
-            if debug_unsplit : debug_print(1)
+            if config.debug_unsplit : debug_print(1)
             pos[kmeans.labels_ == i,1] = pos[kmeans.labels_ == i,1] - ny
     
     return pos
     
-def unsplit_objects(trajectory, labels, nobjects, nx, ny) :
+def unsplit_objects(trajectory, labels, nobjects, nx, ny, \
+                    config=default_config) :
     """
     Function to unsplit a set of objects at a set of times using 
     unsplit_object on each.
@@ -1673,6 +3371,7 @@ def unsplit_objects(trajectory, labels, nobjects, nx, ny) :
                          times and np points.
         labels         : labels of trajectory points.
         nx,ny   : number of grid points in x and y directions.
+        config=default_config : Traj_Config settings.
     Returns:    
         Trajectory array with modified positions.
   
@@ -1680,27 +3379,32 @@ def unsplit_objects(trajectory, labels, nobjects, nx, ny) :
         
     """
     
-    global debug_unsplit
 #    print np.shape(trajectory)
-    print('Unsplitting Objects:')
-
-    for iobj in range(0,nobjects):
-        if debug_unsplit : print('Unsplitting Object: {:03d}'.format(iobj))
+    objects_logger.debug('Unsplitting Objects:')
+
+    with span("unsplit_objects", points=np.size(labels), \
+              objects=nobjects) as sp :
+        nsplit = 0
+        for iobj in range(0,nobjects):
+            if config.debug_unsplit : 
+                objects_logger.debug('Unsplitting Object: %03d', iobj)
 #        if iobj == 15 : 
 #            debug_unsplit = True
 #        else :
 #            debug_unsplit = False
 
-        for it in range(0,np.shape(trajectory)[0]) :
-            if debug_unsplit : print('Time: {:03d}'.format(it))
-            tr = trajectory[it,labels == (iobj),:]
-            if ((np.max(tr[:,0])-np.min(tr[:,0])) > nx/2 ) or \
-               ((np.max(tr[:,1])-np.min(tr[:,1])) > ny/2 ) :
-                trajectory[it, labels == iobj,:] = \
-                unsplit_object(trajectory[it,labels == iobj,:], \
-                                               nx, ny)
-                if debug_unsplit : print('New object:',\
-                    trajectory[it,labels == iobj,:])
+            for it in range(0,np.shape(trajectory)[0]) :
+                if config.debug_unsplit : objects_logger.debug('Time: %03d', it)
+                tr = trajectory[it,labels == (iobj),:]
+                if ((np.max(tr[:,0])-np.min(tr[:,0])) > nx/2 ) or \
+                   ((np.max(tr[:,1])-np.min(tr[:,1])) > ny/2 ) :
+                    nsplit += 1
+                    trajectory[it, labels == iobj,:] = \
+                    unsplit_object(trajectory[it,labels == iobj,:], \
+                                                   nx, ny, config=config)
+                    if config.debug_unsplit : objects_logger.debug( \
+                        'New object: %s', trajectory[it,labels == iobj,:])
+        sp.add(split=nsplit)
     return trajectory
     
 def compute_traj_boxes(traj, in_obj_func, kwargs={}) :
@@ -1728,45 +3432,140 @@ def compute_traj_boxes(traj, in_obj_func, kwargs={}) :
         
     """
     
-    scalar_shape = (np.shape(traj.data)[0], traj.nobjects)
-    centroid_shape = (np.shape(traj.data)[0], traj.nobjects, \
-                      3)
-    mean_obj_shape = (np.shape(traj.data)[0], traj.nobjects, \
-                      np.shape(traj.data)[2])
-    box_shape = (np.shape(traj.data)[0], traj.nobjects, 2, 3)
+    with span("compute_traj_boxes", points=traj.npoints, \
+              objects=traj.nobjects) :
+        in_obj_mask, objvar = in_obj_func(traj, **kwargs)
+
+        segments = object_segments(traj.labels, traj.nobjects)
+
+        return object_box_stats(traj.trajectory, traj.data, in_obj_mask, \
+                                objvar, segments)
+
+def object_segments(labels, nobjects) :
+    """
+    Function to sort trajectory points by object so that per-object 
+    reductions can be done with ufunc.reduceat.
+    
+    Args: 
+        labels   : Array[m] of point labels 0 to nobjects-1. Points with 
+                   labels outside this range are ignored.
+        nobjects : Number of objects.
+
+    Returns:  
+        Segment description::
+        
+            order    : Array of point indices sorted by object.
+            starts   : Array[nobjects] of start of each object in order.
+            counts   : Array[nobjects] of number of points in each object.
+        
+    """
     
-    data_mean = np.zeros(mean_obj_shape)
-    in_obj_data_mean = np.zeros(mean_obj_shape)
-    objvar_mean = np.zeros(scalar_shape)
-    num_in_obj = np.zeros(scalar_shape, dtype=int)
-    traj_centroid = np.zeros(centroid_shape)
-    in_obj_centroid = np.zeros(centroid_shape)
-    traj_box = np.zeros(box_shape)
-    in_obj_box = np.zeros(box_shape)
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    valid = np.logical_and(sorted_labels >= 0, sorted_labels < nobjects)
+    order = order[valid]
+    counts = np.bincount(sorted_labels[valid], minlength=nobjects)
+    starts = np.zeros(nobjects, dtype=int)
+    starts[1:] = np.cumsum(counts)[:-1]
+    return order, starts, counts
+
+def _segment_reduce(ufunc, arr, segments) :
+    """
+    Apply ufunc.reduceat along axis 1 of arr (already sorted by object) 
+    over the object segments. Empty objects are left as zero.
+    """
     
-    in_obj_mask, objvar = in_obj_func(traj, **kwargs)
+    order, starts, counts = segments
+    shape = list(np.shape(arr))
+    shape[1] = len(counts)
+    if arr.dtype == bool :
+        arr = arr.astype(int)
+        out = np.zeros(shape, dtype=int)
+    else :
+        out = np.zeros(shape)
+    nonempty = counts > 0
+    if np.any(nonempty) :
+        out[:, nonempty, ...] = ufunc.reduceat(arr, starts[nonempty], axis=1)
+    return out
+
+def grouped_sum(values, group, ngroups) :
+    """
+    Function to sum rows of values by group in one pass. Rows are added 
+    in order, so sums match np.sum over the rows of each group.
     
-    for iobj in range(traj.nobjects):
-        
-        data = traj.data[:,traj.labels == iobj,:]
-        data_mean[:,iobj,:] = np.mean(data, axis=1) 
-        obj = traj.trajectory[:, traj.labels == iobj, :]
+    Args: 
+        values   : Array[m, ...] of values.
+        group    : Integer array[m] of group 0 to ngroups-1 of each row.
+        ngroups  : Number of groups.
 
-        traj_centroid[:,iobj, :] = np.mean(obj,axis=1) 
-        traj_box[:,iobj, 0, :] = np.amin(obj, axis=1)
-        traj_box[:,iobj, 1, :] = np.amax(obj, axis=1)
+    Returns:  
+        sums, counts: Array[ngroups, ...] of sums over rows in each group 
+        (zero if empty) and Array[ngroups] of number of rows in each group.
         
-        objdat = objvar[:,traj.labels == iobj]
+    """
+    
+    sums = np.zeros((ngroups,) + np.shape(values)[1:])
+    np.add.at(sums, group, values)
+    counts = np.bincount(group, minlength=ngroups)
+    return sums, counts
+
+def object_box_stats(trajectory, data, in_obj_mask, objvar, segments) :
+    """
+    Function to compute the compute_traj_boxes properties for all objects 
+    and times at once using grouped reductions over (time, object).
+    
+    Args: 
+        trajectory   : Array[nt, m, 3] of (unsplit) trajectory positions.
+        data         : Array[nt, m, n] of data at trajectory points.
+        in_obj_mask  : Logical array[nt, m] of in_obj points.
+        objvar       : Array[nt, m] of in_obj scalar.
+        segments     : (order, starts, counts) from object_segments.
+
+    Returns:  
+        As compute_traj_boxes.
         
-        for it in np.arange(0,np.shape(obj)[0]) : 
-            mask = in_obj_mask[it, traj.labels == iobj]
-            num_in_obj[it, iobj] = np.size(np.where(mask))
-            if num_in_obj[it, iobj] > 0 :
-                in_obj_data_mean[it, iobj, :] = np.mean(data[it, mask, :], axis=0) 
-                objvar_mean[it, iobj] = np.mean(objdat[it, mask])
-                in_obj_centroid[it, iobj, :] = np.mean(obj[it, mask, :],axis=0)                
-                in_obj_box[it, iobj, 0, :] = np.amin(obj[it, mask, :], axis=0)
-                in_obj_box[it, iobj, 1, :] = np.amax(obj[it, mask, :], axis=0)
+    """
+    
+    order, starts, counts = segments
+    nobjects = len(counts)
+    
+    obj = trajectory[:, order, :]
+    dat = data[:, order, :]
+    mask = in_obj_mask[:, order]
+    objdat = objvar[:, order]
+    
+    npts = np.maximum(counts, 1)[np.newaxis, :]
+    
+    data_mean = _segment_reduce(np.add, dat, segments) / npts[..., np.newaxis]
+    traj_centroid = _segment_reduce(np.add, obj, segments) / \
+                    npts[..., np.newaxis]
+    
+    traj_box = np.zeros((np.shape(obj)[0], nobjects, 2, 3))
+    traj_box[:, :, 0, :] = _segment_reduce(np.minimum, obj, segments)
+    traj_box[:, :, 1, :] = _segment_reduce(np.maximum, obj, segments)
+    
+    num_in_obj = _segment_reduce(np.add, mask, segments).astype(int)
+    n_in = np.maximum(num_in_obj, 1)
+    in_obj = num_in_obj > 0
+    
+    mask3 = mask[..., np.newaxis]
+    in_obj_data_mean = _segment_reduce(np.add, \
+                           np.where(mask3, dat, 0.0), segments) / \
+                           n_in[..., np.newaxis]
+    objvar_mean = _segment_reduce(np.add, \
+                      np.where(mask, objdat, 0.0), segments) / n_in
+    in_obj_centroid = _segment_reduce(np.add, \
+                          np.where(mask3, obj, 0.0), segments) / \
+                          n_in[..., np.newaxis]
+    
+    in_obj_box = np.zeros_like(traj_box)
+    in_obj_box[:, :, 0, :] = _segment_reduce(np.minimum, \
+                                 np.where(mask3, obj, np.inf), segments)
+    in_obj_box[:, :, 1, :] = _segment_reduce(np.maximum, \
+                                 np.where(mask3, obj, -np.inf), segments)
+    in_obj_box[np.logical_not(in_obj), ...] = 0.0
+    
     return data_mean, in_obj_data_mean, objvar_mean, num_in_obj, \
            traj_centroid, in_obj_centroid, traj_box, in_obj_box
    
@@ -1797,15 +3596,18 @@ def print_boxes(traj) :
             print(strf)
     return 
 
-def box_overlap_with_wrap(b_test, b_set, nx, ny) :
+def box_overlap_with_wrap(b_test, b_set, nx, ny, config=default_config) :
     """
-        Function to compute whether rectangular boxes intersect.
+        Function to compute whether rectangular boxes intersect, allowing 
+        for cyclic wrap in x and y if config.cyclic_xy. See also Box_Index 
+        for many queries against the same set of boxes.
         
         Args: 
             b_test: box for testing array[8,3]
             b_set: set of boxes array[n,8,3]
             nx: number of points in x grid.
             ny: number of points in y grid.
+            config=default_config : Traj_Config settings.
            
         Returns:
             indices of overlapping boxes
@@ -1814,35 +3616,96 @@ def box_overlap_with_wrap(b_test, b_set, nx, ny) :
         
     """
     
-    # Wrap not yet implemented
-    
-    t1 = np.logical_and( \
-        b_test[0,0] >= b_set[...,0,0] , b_test[0,0] <= b_set[...,1,0])
-    t2 = np.logical_and( \
-        b_test[1,0] >= b_set[...,0,0] , b_test[1,0] <= b_set[...,1,0])
-    t3 = np.logical_and( \
-        b_test[0,0] <= b_set[...,0,0] , b_test[1,0] >= b_set[...,1,0])
-    t4 = np.logical_and( \
-        b_test[0,0] >= b_set[...,0,0] , b_test[1,0] <= b_set[...,1,0])
-    x_overlap =np.logical_or(np.logical_or( t1, t2), np.logical_or( t3, t4) )
-
-#    print(x_overlap)
+    x_overlap = _interval_overlap_with_wrap(b_test[0,0], b_test[1,0], \
+                                            b_set[...,0,0], b_set[...,1,0], \
+                                            nx, config.cyclic_xy)
     x_ind = np.where(x_overlap)[0]
-#    print(x_ind)
-    t1 = np.logical_and( \
-        b_test[0,1] >= b_set[x_ind,0,1] , b_test[0,1] <= b_set[x_ind,1,1])
-    t2 = np.logical_and( \
-        b_test[1,1] >= b_set[x_ind,0,1] , b_test[1,1] <= b_set[x_ind,1,1])
-    t3 = np.logical_and( \
-        b_test[0,1] <= b_set[x_ind,0,1] , b_test[1,1] >= b_set[x_ind,1,1])
-    t4 = np.logical_and( \
-        b_test[0,1] >= b_set[x_ind,0,1] , b_test[1,1] <= b_set[x_ind,1,1])
-    y_overlap = np.logical_or(np.logical_or( t1, t2), np.logical_or( t3, t4) )
-    
+    y_overlap = _interval_overlap_with_wrap(b_test[0,1], b_test[1,1], \
+                                            b_set[x_ind,0,1], b_set[x_ind,1,1], \
+                                            ny, config.cyclic_xy)
     y_ind = np.where(y_overlap)[0]
     
     return x_ind[y_ind]
 
+def object_overlap_matrix(vox, obj, nobjects, mvox, mobj, match_nobjects) :
+    """
+    Function to compute the fractional overlap of every pair of objects 
+    from two sets of (grid-box id, object id) pairs, by sorting one set on 
+    grid box and joining the other to it.
+    The overlap of two objects is the number of grid boxes they share 
+    divided by the number of grid boxes in the larger.
+    
+    Args: 
+        vox, obj       : arrays of unique (grid-box id, object id) pairs 
+                         for reference objects.
+        nobjects       : number of reference objects.
+        mvox, mobj     : arrays of unique (grid-box id, object id) pairs 
+                         for comparison objects.
+        match_nobjects : number of comparison objects.
+       
+    Returns:
+        scipy.sparse.csr_matrix [nobjects, match_nobjects] of fractional 
+        overlap.
+        
+    """
+    
+    shape = (nobjects, match_nobjects)
+    size = np.bincount(obj, minlength=nobjects)
+    msize = np.bincount(mobj, minlength=match_nobjects)
+    
+    order = np.argsort(mvox, kind='stable')
+    mvox = mvox[order]
+    mobj = mobj[order]
+    start = np.searchsorted(mvox, vox, side='left')
+    end = np.searchsorted(mvox, vox, side='right')
+    nmatch = end - start
+    total = np.sum(nmatch)
+    if total == 0 :
+        return sparse.csr_matrix(shape)
+    
+    i = np.repeat(obj, nmatch)
+    offsets = np.arange(total) - np.repeat(np.cumsum(nmatch) - nmatch, nmatch)
+    j = mobj[np.repeat(start, nmatch) + offsets]
+    
+    count = sparse.coo_matrix((np.ones(total), (i, j)), shape=shape).tocsr()
+    count.sum_duplicates()
+    
+    rows = np.repeat(np.arange(nobjects), np.diff(count.indptr))
+    count.data = count.data / np.maximum(size[rows], msize[count.indices])
+    return count
+
+def sorted_intersection_size(a, b) :
+    """
+    Function to count the common elements of two sorted arrays of unique 
+    values by binary search of the shorter in the longer.
+    
+    Args: 
+        a, b : sorted 1D arrays with no repeated values.
+       
+    Returns:
+        Number of values in both a and b.
+        
+    """
+    
+    if np.size(a) > np.size(b) : a, b = b, a
+    if np.size(a) == 0 : return 0
+    ind = np.searchsorted(b, a)
+    ind[ind == np.size(b)] = np.size(b) - 1
+    return np.count_nonzero(b[ind] == a)
+
+def _interval_overlap_with_wrap(a_lo, a_hi, b_lo, b_hi, n, wrap) :
+    """
+    Test whether closed intervals [a_lo, a_hi] and [b_lo, b_hi] intersect,
+    optionally allowing any shift of a by a multiple of the period n.
+    """
+    
+    if wrap :
+        # Overlap if some integer k has b_lo <= a_hi + k n and 
+        # b_hi >= a_lo + k n.
+        return np.ceil((b_lo - a_hi) / n) <= np.floor((b_hi - a_lo) / n)
+    else :
+        return np.logical_and(b_lo <= a_hi, b_hi >= a_lo)
+
 def file_key(file):
     f1 = file.split('_')[-1]
     f2 = f1.split('.')[0]
@@ -1897,14 +3760,14 @@ def find_time_in_files(files, ref_time, nodt = False) :
             dataset.close()
             it = 0
             if times[it] != ref_time :
-                print('Could not find exact time {} in file {}'.\
-                  format(ref_time,files[ref_file]))
+                io_logger.warning('Could not find exact time %s in file %s', \
+                                  ref_time, files[ref_file])
                 ref_file = None
             else :
                 if nodt :
                     delta_t = 0.0
                 else :
-                    print('Looking in next file to get dt.')
+                    io_logger.debug('Looking in next file to get dt.')
                     dataset_next=Dataset(files[ref_file+1])
                     times_next = get_file_times(dataset_next)
                     delta_t = times_next[0] - times[0]
@@ -1914,13 +3777,13 @@ def find_time_in_files(files, ref_time, nodt = False) :
         else : # len(times) > 1
             it = np.where(times == ref_time)[0]
             if len(it) == 0 :
-                print('Could not find exact time {} in file {}'.\
-                  format(ref_time,ref_file))
+                io_logger.warning('Could not find exact time %s in file %s', \
+                                  ref_time, ref_file)
                 it = np.where(times >= ref_time)[0]
 #                print("it={}".format(it))
                 if len(it) == 0 :
-                    print('Could not find time >= {} in file {}, looking in next.'.\
-                      format(ref_time,ref_file))
+                    io_logger.debug('Could not find time >= %s in file %s, looking in next.', \
+                                    ref_time, ref_file)
                     ref_file += 1
                     continue
 #            else :
@@ -1930,65 +3793,255 @@ def find_time_in_files(files, ref_time, nodt = False) :
             else :
                 delta_t = times[it+1] - times[it]
             break
-    print(\
-    "Looking for time {}, returning file #{}, index {}, time {}, delta_t {}".\
-          format(  ref_time,ref_file, it, times[it], delta_t) )
+    io_logger.debug( \
+        "Looking for time %s, returning file #%s, index %s, time %s, delta_t %s", \
+        ref_time, ref_file, it, times[it], delta_t)
     return ref_file, it, delta_t.astype(int)
 
-def compute_derived_variables(traj, derived_variable_list=None) :
+def _q_total(traj) :
+    return traj.variable("q_vapour") + \
+           traj.variable("q_cloud_liquid_mass")
+
+def _th_L(traj) :
+    tr_z, piref_z, thref_z = traj.reference_at_points()
+    return traj.variable("th") - \
+           L_over_cp * traj.variable("q_cloud_liquid_mass") / piref_z
+
+def _th_v(traj) :
+    tr_z, piref_z, thref_z = traj.reference_at_points()
+    return traj.variable("th") + \
+           thref_z * (c_virtual * traj.variable("q_vapour") - 
+                      traj.variable("q_cloud_liquid_mass"))
+
+def _MSE(traj) :
+    tr_z, piref_z, thref_z = traj.reference_at_points()
+    return traj.variable("th") * Cp * piref_z + \
+           grav * tr_z + \
+           L_vap * traj.variable("q_vapour")
+
+derived_variables = OrderedDict()
+derived_variable_functions = dict()
+
+def register_derived_variable(name, label, func) :
+    """
+    Function to register a derived variable, computed from trajectory 
+    data by Trajectories.variable and included in cloud_properties.
+
+    Args:
+        name (string) : variable name.
+        label (string) : axis label for plots.
+        func : function taking a Trajectories object and returning an 
+            array [nt, m]. Other variables should be obtained using 
+            traj.variable and heights and reference profiles using 
+            traj.reference_at_points so that they are computed only once.
+
+    Returns:
+        Nothing
+
+    """
+
+    derived_variables[name] = label
+    derived_variable_functions[name] = func
+    return
+
+register_derived_variable("q_total", r"$q_{t}$ kg/kg", _q_total)
+register_derived_variable("th_L", r"$\theta_L$ K", _th_L)
+register_derived_variable("th_v", r"$\theta_v$ K", _th_v)
+register_derived_variable("MSE", r"MSE J kg$^{-1}$", _MSE)
+
+def compute_derived_variables(traj, derived_variable_list=None, points=None) :
+    """
+    Function to compute derived variables at trajectory points. 
+    Values are cached on traj so repeated calls do not recompute them.
+
+    Args:
+        traj : Trajectories object.
+        derived_variable_list=None : dict (or list) of derived variable names. 
+            Default is all registered.
+        points=None : index of points to select. Default is all.
+
+    Returns:
+        derived_variable_list, array [nt, m, n].
+
+    """
+
     if derived_variable_list is None :
-        derived_variable_list = { \
-                           "q_total":r"$q_{t}$ kg/kg", \
-                           "th_L":r"$\theta_L$ K", \
-                           "th_v":r"$\theta_v$ K", \
-                           "MSE":r"MSE J kg$^{-1}$", \
-                           }
-    data_list = list([])        
-    tr_z = (traj.trajectory[...,2]-0.5)*traj.deltaz
-    zn = (np.arange(0,np.size(traj.piref))-0.5)*traj.deltaz
-    piref_z = np.interp(tr_z,zn,traj.piref)
-    thref_z = np.interp(tr_z,zn,traj.thref)
-    
-    s = list(np.shape(traj.data))
-#    print(s)
-    s.pop()
-    s.append(len(derived_variable_list))
-#    print(s)
-    out = np.zeros(s)
-#    print(np.shape(out))
-    
-    for i,variable in enumerate(derived_variable_list.keys()) :
-        
-        if variable == "q_total" :
-            data = traj.data[..., traj.var("q_vapour")] + \
-                   traj.data[..., traj.var("q_cloud_liquid_mass")]
+        derived_variable_list = dict(derived_variables)
+    return derived_variable_list, \
+        traj.derived_data(list(derived_variable_list), points=points)
+
+class Cloud_Class_Scheme :
+    '''
+    Class defining a trajectory point classification scheme for 
+    set_cloud_class.
+    
+    Each point is assigned a state at each time from its cloud mask at that 
+    time and the time before ("new" cloud, continuing cloud "cont", just 
+    detrained "detr", or out of cloud, "out"), whether the object is in 
+    its main cloud (contiguous in time with the reference time) and 
+    whether the point starts below the minimum cloud base of its object 
+    ("from_bl"). Two further states fill in times without an event: "pre" 
+    (before later entrainment) and "post" (after detrainment). 
+    
+    Classes are found by looking states up in a table for times up to the 
+    reference time and another for later times. Table keys are tuples 
+    (state, in_main_cloud, from_bl); None matches either value of 
+    in_main_cloud or from_bl. Table values are class names. 
+    States without an entry give class 0.
+    
+    Up to the reference time::
+    
+        "new", "cont", "detr" : at the time of the event.
+        "post" : at non-cloudy times after the first detrainment and 
+                 before the reference time. in_main_cloud is its value at 
+                 the time of first detrainment. Overrides events.
+        "pre"  : at other times with no event before the last entrainment
+                 up to the reference time.
                  
-        if variable == "th_L" :
-            data = traj.data[..., traj.var("th")] - \
-              L_over_cp * \
-              traj.data[..., traj.var("q_cloud_liquid_mass")] \
-              / piref_z
-              
-        if variable == "th_v" :
-            data = traj.data[..., traj.var("th")] + \
-                   thref_z * (c_virtual * \
-                              traj.data[..., traj.var("q_vapour")] - 
-                              traj.data[..., traj.var("q_cloud_liquid_mass")])
-
-        if variable == "MSE" :
-            data = traj.data[:, :, traj.var("th")] * \
-                          Cp * piref_z + \
-                          grav * tr_z + \
-                          L_vap * traj.data[:, :, traj.var("q_vapour")]
-                          
-#        print(variable, np.min(data),np.max(data),np.shape(data))
+    After the reference time::
+    
+        "new", "cont", "detr", "out" : at the time of the event.
+        "pre"  : at the time before "new" (including the reference time). 
+                 Overrides events.
+    
+    Args:
+        version       : Version number used to select the scheme.
+        classes       : List of (class name, plot colour). Class 0 should 
+                        be "Not set".
+        back_table    : Table (dict) used up to the reference time.
+        forward_table : Table (dict) used after the reference time.
+        mask_func     : Function mask_func(traj, thresh) returning boolean 
+                        cloud mask [nt, npoints].
+        
+    '''
+    
+    states = ["none", "new", "cont", "detr", "out", "pre", "post"]
+    
+    def __init__(self, version, classes, back_table, forward_table, \
+                 mask_func) :
+        self.version = version
+        self.classes = list(classes)
+        self.key = [c[0] for c in self.classes]
+        self.colours = [c[1] for c in self.classes]
+        self.back_table = self._compile(back_table)
+        self.forward_table = self._compile(forward_table)
+        self.mask_func = mask_func
+        
+    def _compile(self, table) :
+        # Expand table to integer array [nstates, in_main_cloud, from_bl].
+        lookup = np.zeros((len(self.states), 2, 2), dtype=int)
+        for (state, main, bl), cls in table.items() :
+            mains = [False, True] if main is None else [main]
+            bls = [False, True] if bl is None else [bl]
+            for m in mains :
+                for b in bls :
+                    lookup[self.states.index(state), int(m), int(b)] = \
+                        self.key.index(cls)
+        return lookup
+        
+    def lookup(self, table, state, in_main_cloud, from_bl) :
+        """
+        Method to look up class of points from state arrays.
+        
+        Args:
+            table        : self.back_table or self.forward_table.
+            state        : Integer array of indices into self.states.
+            in_main_cloud: Boolean array (broadcastable to state).
+            from_bl      : Boolean array (broadcastable to state).
+            
+        Returns:
+            Integer array of classes.
             
-        out[...,i] = data
-#        data_list.append(data)   
-#    out = np.vstack(data_list).T
-#    out = np.array(data_list).T
-#    print(np.shape(out))
-    return derived_variable_list, out
+        """
+        
+        return table[state, np.asarray(in_main_cloud, dtype=int), \
+                     np.asarray(from_bl, dtype=int)]
+    
+def cloud_mask_qcl(traj, thresh) :
+    '''
+    Cloud mask from liquid water threshold.
+    '''
+    qcl = traj.data[:,:,traj.var("q_cloud_liquid_mass")]
+    return (qcl >= thresh)
+
+def cloud_mask_qcl_w(traj, thresh, w_thresh=0.1) :
+    '''
+    Cloud mask from liquid water threshold and updraft exceeding w_thresh.
+    '''
+    w = traj.data[:,:,traj.var("w")]
+    return np.logical_and(cloud_mask_qcl(traj, thresh), (w >= w_thresh))
+
+_version_1_classes = [ \
+    ("Not set", "lightgray"), \
+    ("PRE_CLOUD_ENTR_FROM_BL", "red"), \
+    ("PRE_CLOUD_ENTR_FROM_ABOVE_BL", "green"), \
+    ("PREVIOUS_CLOUD", "blue"), \
+    ("DETR_PREV", "lightblue"), \
+    ("POST_DETR_PREV", "cyan"), \
+    ("CLOUD", "black"), \
+    ("ENTRAINED_FROM_BL", "orange"), \
+    ("ENTRAINED_FROM_ABOVE_BL", "lightgreen"), \
+    ("DETRAINED", "magenta"), \
+    ("POST_DETR", "pink"), \
+    ("SUBS_CLOUD", "darkgray"), \
+    ]
+
+_version_1_back_table = { \
+    ("new",  None,  True)  : "ENTRAINED_FROM_BL", \
+    ("new",  None,  False) : "ENTRAINED_FROM_ABOVE_BL", \
+    ("cont", True,  None)  : "CLOUD", \
+    ("cont", False, None)  : "PREVIOUS_CLOUD", \
+    ("detr", True,  None)  : "DETRAINED", \
+    ("detr", False, None)  : "DETR_PREV", \
+    ("pre",  None,  True)  : "PRE_CLOUD_ENTR_FROM_BL", \
+    ("pre",  None,  False) : "PRE_CLOUD_ENTR_FROM_ABOVE_BL", \
+    ("post", True,  None)  : "POST_DETR", \
+    ("post", False, None)  : "POST_DETR_PREV", \
+    }
+
+_version_1_forward_table = { \
+    ("new",  None,  None)  : "ENTRAINED_FROM_ABOVE_BL", \
+    ("cont", True,  None)  : "CLOUD", \
+    ("cont", False, None)  : "SUBS_CLOUD", \
+    ("detr", None,  None)  : "DETRAINED", \
+    ("out",  None,  None)  : "POST_DETR", \
+    ("pre",  None,  None)  : "PRE_CLOUD_ENTR_FROM_ABOVE_BL", \
+    }
+
+cloud_class_schemes = dict()
+
+def register_cloud_class_scheme(scheme) :
+    '''
+    Function to make a Cloud_Class_Scheme available to set_cloud_class 
+    under its version number.
+    '''
+    cloud_class_schemes[scheme.version] = scheme
+    return
+
+# Version 1: cloud is q_cloud_liquid_mass >= thresh.
+register_cloud_class_scheme(Cloud_Class_Scheme(1, _version_1_classes, \
+    _version_1_back_table, _version_1_forward_table, cloud_mask_qcl))
+# Version 2: as version 1 but cloud also requires w >= 0.1.
+register_cloud_class_scheme(Cloud_Class_Scheme(2, _version_1_classes, \
+    _version_1_back_table, _version_1_forward_table, cloud_mask_qcl_w))
+
+def cloud_class_key(traj_cl) :
+    '''
+    Function to return the class names and plot colours of a classification.
+
+    Args:
+        traj_cl    : Dict of Classifications of trajectory points 
+            provided by set_cloud_class function.
+
+    Returns: 
+        List of [class name, colour].
+        
+    '''
+    if "colours" in traj_cl :
+        colours = traj_cl["colours"]
+    else :
+        colours = cloud_class_schemes[traj_cl["version"]].colours
+    return [[k, c] for k, c in zip(traj_cl["key"], colours)]
 
 def set_cloud_class(traj, thresh=None, version=1) :
     '''
@@ -1996,7 +4049,9 @@ def set_cloud_class(traj, thresh=None, version=1) :
 
     Args:
         thresh: Threshold if LWC to define cloud. Default is traj.thresh.
-        version: Which version of classification. (Currently only 1).
+        version: Which version of classification (key in 
+            cloud_class_schemes). 1: cloud is LWC >= thresh. 
+            2: also requires w >= 0.1.
 
     Returns: 
         Dictionary containing trajectory class points, key and useful derived data::
@@ -2004,6 +4059,7 @@ def set_cloud_class(traj, thresh=None, version=1) :
           Dictionary keys:
           "class"
           "key"
+          "colours"
           "first_cloud_base"
           "min_cloud_base"
           "cloud_top"
@@ -2014,37 +4070,11 @@ def set_cloud_class(traj, thresh=None, version=1) :
     @author: Peter Clark
 
     '''
-    if version == 1 :
-        PRE_CLOUD_ENTR_FROM_BL = 1
-        PRE_CLOUD_ENTR_FROM_ABOVE_BL = 2
-        PREVIOUS_CLOUD = 3
-        DETR_PREV = 4
-        POST_DETR_PREV = 5
-        CLOUD = 6
-        ENTR_FROM_BL = 7
-        ENTR_FROM_ABOVE_BL = 8
-#            ENTR_PREV_CLOUD = 7
-        DETRAINED = 9
-        POST_DETR = 10
-        SUBSEQUENT_CLOUD = 11
-    else :
-        print("Illegal Version")
-        return 
-
-    class_key = list([\
-        "Not set" , \
-        "PRE_CLOUD_ENTR_FROM_BL", \
-        "PRE_CLOUD_ENTR_FROM_ABOVE_BL", \
-        "PREVIOUS_CLOUD", \
-        "DETR_PREV", \
-        "POST_DETR_PREV", \
-        "CLOUD", \
-        "ENTRAINED_FROM_BL", \
-        "ENTRAINED_FROM_ABOVE_BL", \
-        "DETRAINED", \
-        "POST_DETR", \
-        "SUBS_CLOUD", \
-        ])
+    if version not in cloud_class_schemes :
+        raise ValueError("Illegal Version {}. Available versions are {}".\
+                         format(version, list(cloud_class_schemes.keys())))
+    scheme = cloud_class_schemes[version]
+    state = scheme.states
 
     if thresh == None : thresh = traj.ref_func_kwargs["thresh"]
     traj_class = np.zeros_like(traj.data[:,:,0], dtype=int)
@@ -2056,288 +4086,126 @@ def set_cloud_class(traj, thresh=None, version=1) :
     cloud_dissipate_time = np.ones(traj.nobjects, dtype=int)*traj.ntimes
 
     tr_z = (traj.trajectory[:,:,2]-0.5)*traj.deltaz
-    zn = (np.arange(0,np.size(traj.piref))-0.5)*traj.deltaz
-    
-    for iobj in range(0,traj.nobjects) :
-#        debug_mean = (iobj == 61)
-        if debug_mean : print('Processing object {}'.format(iobj))
-        obj_ptrs = (traj.labels == iobj)
-        where_obj_ptrs = np.where(obj_ptrs)[0]
-        tr = traj.trajectory[:, obj_ptrs, :]
-        data = traj.data[:, obj_ptrs, :]
-        obj_z = tr_z[:,obj_ptrs]
-        
-        if debug_mean : print(np.shape(data))
-        
-        qcl = data[:,:,traj.var("q_cloud_liquid_mass")]
-        mask_qcl = (qcl >= thresh)
-        w = data[:,:,traj.var("w")]
-        mask_w = (w >= 0.1)
-#        mask = np.logical_and(mask_qcl, mask_w)
-        mask = mask_qcl       
-#        print("Object ",iobj, np.size(np.where(mask[traj.ref,:])[0]))
-        
-        if np.size(np.where(mask[traj.ref,:])[0]) == 0 :
-            print("Object {} is not active at reference time.".format(iobj))
-            continue
- 
-        # Original extracted variables
-        min_cloud_base[iobj] = (np.min(tr[mask,2])-0.5)*traj.deltaz
-#        data_class = traj_class[:,traj.labels == iobj]
-        if debug_mean : print('Version ',version)
-
-#        if version == 1 :
-            
-        in_main_cloud = True
+    
+    nt, npts = np.shape(traj_class)
+    ref = traj.ref
+    valid = np.logical_and(traj.labels >= 0, traj.labels < traj.nobjects)
+    lab = np.where(valid, traj.labels, 0)
+    
+    mask = scheme.mask_func(traj, thresh)
+    
+    # Number of cloudy points in each object at each time.
+    cloudy = np.logical_and(mask, valid)
+    tindex = np.arange(nt)[:, np.newaxis] * traj.nobjects + lab
+    ncloud = np.bincount(tindex[cloudy], minlength = nt * traj.nobjects).\
+        reshape(nt, traj.nobjects)
+    
+    active = ncloud[ref, :] > 0
+    for iobj in np.where(np.logical_not(active))[0] :
+        analysis_logger.debug("Object %d is not active at reference time.", iobj)
+    pt_active = np.logical_and(valid, active[lab])
         
-        for it in range(traj.ref,-1,-1) :
-            
-            if debug_mean : print("it = {}".format(it))
-
-            cloud_bottom = traj.in_obj_box[it, iobj, 0, 2]
-            
-            cloud = mask[it,:]
-            where_cloud = np.where(cloud)[0]
-            
-            not_cloud = np.logical_not(cloud)
-            where_not_cloud = np.where(not_cloud)[0]
-
-            if it > 0 :
-                
-                cloud_at_prev_step = mask[it-1,:]
-                not_cloud_at_prev_step = np.logical_not(\
-                                            cloud_at_prev_step) 
-                
-                new_cloud = np.logical_and(cloud, \
-                                           not_cloud_at_prev_step)
-                where_newcloud = np.where(new_cloud)[0]
-                
-                not_new_cloud = np.logical_and(cloud, \
-                                               cloud_at_prev_step)
-                where_not_newcloud = np.where(not_new_cloud)[0]
-#                            print(np.size(where_newcloud),np.size(where_not_newcloud))
-            else :
-                where_newcloud = np.array([])
-
-                not_new_cloud = cloud
-                where_not_newcloud = where_cloud
-                        
-            if np.size(where_cloud) > 0 :  
-                # There are cloudy points                            
-                # Find new cloudy points  
-                    
-                if np.size(where_newcloud) > 0 : # Entrainment
-                    if debug_mean : print('Entraining air')
-
-                    # New cloud in air that starts below cloud base.
-                    newcl_from_bl = np.logical_and( new_cloud,\
-                                      obj_z[0, :] < min_cloud_base[iobj])  
-                    where_newcl_from_bl = np.where(newcl_from_bl)[0]
-                    class_set_from_bl = where_obj_ptrs[ \
-                                      where_newcl_from_bl]
-                    
-                    # New cloud in air that starts above cloud base.
-                    newcl_from_above_bl = np.logical_and( new_cloud,\
-                                     obj_z[0, :] >= min_cloud_base[iobj])  
-                    where_newcl_from_above_bl = np.where( \
-                                                newcl_from_above_bl)[0]
-                    class_set_from_above_bl = where_obj_ptrs[ \
-                                            where_newcl_from_above_bl]
-                    
-                    traj_class[0:it, class_set_from_bl] = \
-                                PRE_CLOUD_ENTR_FROM_BL 
-                    traj_class[it, class_set_from_bl] = \
-                                ENTR_FROM_BL 
-                                
-                    traj_class[0:it, class_set_from_above_bl] = \
-                                PRE_CLOUD_ENTR_FROM_ABOVE_BL
-                    traj_class[it, class_set_from_above_bl] = \
-                                ENTR_FROM_ABOVE_BL
-
-                    if debug_mean : 
-                        print("From BL",class_set_from_bl)
-                        print("From above BL",class_set_from_above_bl)
-#                        input("Press Enter to continue...")
-                    
-                # Set traj_class flag for those points in cloud.              
-                if np.size(where_not_newcloud) > 0 : # Not entrainment
-                    if debug_mean : 
-                        print("Setting Cloud",it,\
-                              np.size(where_not_newcloud))
-                        
-                    class_set = where_obj_ptrs[where_not_newcloud]
-                
-                    if in_main_cloud :
-                        # Still in cloud contiguous with reference time.
-                        traj_class[it, class_set] = CLOUD
-                        if debug_mean : 
-                            print("CLOUD",class_set)
-                    else :
-                        # Must be cloud points that were present before.
-                        traj_class[it, class_set] = PREVIOUS_CLOUD
-                        if debug_mean : 
-                            print("PREV CLOUD",class_set)
-                        
-            else : # np.size(where_cloud) == 0 
-                if in_main_cloud : cloud_trigger_time[iobj] = it+1
-                in_main_cloud = False
-                
-            # Now what about detraining air?
-            if np.size(where_not_cloud) > 0 : 
-                
-#                    if it == traj.ref :
-#                        print("Problem - reference not all cloud",iobj)
-                
-                                        
-                # Find points that have ceased to be cloudy     
-                if it > 0 :
-                    detr_cloud = np.logical_and(not_cloud, \
-                                                cloud_at_prev_step)
-                    where_detrained = np.where(detr_cloud)[0]
-                                                
-                    if np.size(where_detrained) > 0 : # Detrainment
-                        if debug_mean : print('Detraining air')
-                            
-                        class_set = where_obj_ptrs[where_detrained] 
-                        if in_main_cloud :
-                            traj_class[it, class_set] = DETRAINED
-                            if debug_mean : 
-                                print("Detrained",class_set)
-                            for iit in range(it+1,traj.ref) :
-                                post_detr = np.logical_and(detr_cloud, \
-                                                   np.logical_not(mask[iit,:]))
-                                where_post_detr = np.where(post_detr)[0]
-                                class_set_post_detr = where_obj_ptrs[ \
-                                                where_post_detr]
-                                traj_class[iit, class_set_post_detr] = \
-                                    POST_DETR                             
-                                if debug_mean : 
-                                    print("Post detr",iit, class_set_post_detr)
-                        else :
-                            traj_class[it, class_set] = DETR_PREV
-                            if debug_mean : 
-                                print("Detrained prev",class_set)
-                            for iit in range(it+1,traj.ref) :
-                                post_detr_prev = np.logical_and(detr_cloud, \
-                                                   np.logical_not(mask[iit,:]))
-                                where_post_detr_prev = np.where(post_detr_prev)[0]
-                                class_set_post_detr_prev = where_obj_ptrs[ \
-                                                where_post_detr_prev]
-                                traj_class[iit, class_set_post_detr_prev] = \
-                                    POST_DETR_PREV                             
-                                if debug_mean : 
-                                    print("Post detr prev",iit, class_set_post_detr_prev)
-                        if debug_mean : 
-                            input("Press Enter to continue...")     
-                            
-        in_main_cloud = True
-        after_cloud_dissipated = False  
-
-        for it in range(traj.ref+1,traj.end+1) :
-            
-            if debug_mean : print("it = {}".format(it))
-            
-            cloud_bottom = traj.in_obj_box[it, iobj, 0, 2]
-            
-            cloud = mask[it,:]
-            where_cloud = np.where(cloud)[0]
-            
-            not_cloud = np.logical_not(cloud)
-            where_not_cloud = np.where(not_cloud)[0]
-            
-            cloud_at_prev_step = mask[it-1,:]
-            not_cloud_at_prev_step = np.logical_not(\
-                                        cloud_at_prev_step) 
-            
-            new_cloud = np.logical_and(cloud, \
-                                       not_cloud_at_prev_step)
-            where_newcloud = np.where(new_cloud)[0]
-            
-            not_new_cloud = np.logical_and(cloud, \
-                                           cloud_at_prev_step)
-            where_not_newcloud = np.where(not_new_cloud)[0]
-            
-            new_not_cloud = np.logical_and(not_cloud, \
-                                       cloud_at_prev_step)
-            where_new_not_cloud = np.where(new_not_cloud)[0]
-            
-            not_new_not_cloud = np.logical_and(not_cloud, \
-                                       not_cloud_at_prev_step)
-            where_not_new_not_cloud = np.where(not_new_not_cloud)[0]
-
-            
-#            if debug_mean : 
-#                print('it', it, np.shape(where_cloud))
-#                print(qcl[it,mask[it,:]])
-#                print(new_cloud)
-#                print(qcl[it-1,new_cloud],qcl[it,new_cloud])
-            
-                # Find new cloudy points  
-
-            if np.size(where_newcloud) > 0 : # Entrainment
-                if debug_mean : print('Entraining air')
-                
-                class_set = where_obj_ptrs[where_newcloud]
-                           
-                traj_class[it-1, class_set] = \
-                            PRE_CLOUD_ENTR_FROM_ABOVE_BL
-                traj_class[it, class_set] = \
-                            ENTR_FROM_ABOVE_BL
-
-                if debug_mean : 
-#                                print("From BL",class_set_from_bl)
-                    print("From above BL",class_set)
- 
-                
-            # Set traj_class flag for those points in cloud.              
-            if np.size(where_not_newcloud) > 0 : # Existing cloud
-                
-                if debug_mean : print("Setting Cloud",it,np.size(where_not_newcloud))
-                
-                class_set = where_obj_ptrs[where_not_newcloud]
-            
-                if in_main_cloud :
-                    # Still in cloud contiguous with reference time.
-                    traj_class[it, class_set] = CLOUD
-                    if debug_mean : 
-                        print("Cloud",class_set)
-                else :
-                    # Must be cloud points that were present before.
-                    traj_class[it, class_set] = SUBSEQUENT_CLOUD                           
-                    if debug_mean : 
-                        print("Subs Cloud",class_set)
-
-#                          (np.max(tr[it-1,cloud_at_prev_step,2])-0.5) * traj.deltaz
-
-                
-            # Now what about detraining and detraining air?
-            if np.size(where_new_not_cloud) > 0 : 
-                class_set = where_obj_ptrs[where_new_not_cloud]
-                traj_class[it, class_set] = DETRAINED
-                if debug_mean : 
-                    print("DETRAINED",class_set)
-
-            if np.size(where_not_new_not_cloud) > 0 : 
-                class_set = where_obj_ptrs[where_not_new_not_cloud]
-                traj_class[it, class_set] = POST_DETR
-                if debug_mean : 
-                    print("POST DETRAINED",class_set)
-                
-            if np.size(where_cloud) == 0 :  
-                # There are cloudy points
-                if in_main_cloud and not after_cloud_dissipated :
-                    # At cloud top.
-                    cloud_dissipate_time[iobj] = it
-                    cloud_top[iobj] = np.max(obj_z[it-1,cloud_at_prev_step])
-                    in_main_cloud = False
-                    after_cloud_dissipated = True  
-                if debug_mean : 
-                    input("Press Enter to continue...") 
-
+    # Original extracted variables
+    z_min = np.full(traj.nobjects, np.inf)
+    np.minimum.at(z_min, np.broadcast_to(lab, np.shape(mask))[cloudy], \
+                  traj.trajectory[:,:,2][cloudy])
+    min_cloud_base[active] = (z_min[active]-0.5)*traj.deltaz
+    
+    # Last time at or before ref with no cloud in object (-1 if none).
+    no_cloud = (ncloud[:ref+1, :] == 0)
+    trigger = np.where(np.any(no_cloud, axis=0), \
+                       ref - np.argmax(no_cloud[::-1, :], axis=0), -1)
+    cloud_trigger_time[active] = trigger[active] + 1
+    
+    # First time after ref with no cloud in object (nt if none).
+    no_cloud = (ncloud[ref:, :] == 0)
+    no_cloud[0, :] = False
+    dissipate = np.where(np.any(no_cloud, axis=0), \
+                         ref + np.argmax(no_cloud, axis=0), nt)
+    dissipated = np.logical_and(active, dissipate < nt)
+    cloud_dissipate_time[dissipated] = dissipate[dissipated]
+    
+    # Cloud top is highest cloudy point just before dissipation.
+    it_top = np.clip(dissipate - 1, 0, nt - 1)[lab]
+    at_top = np.logical_and(dissipated[lab], \
+                            mask[it_top, np.arange(npts)])
+    z_top = np.full(traj.nobjects, -np.inf)
+    np.maximum.at(z_top, lab[at_top], tr_z[it_top, np.arange(npts)][at_top])
+    cloud_top[dissipated] = z_top[dissipated]
+    
+    trigger = trigger[lab]
+    dissipate = dissipate[lab]
+    
+    # Times up to ref.
+    # Points enter cloud (new), stay in cloud (cont) or leave (detr) at it.
+    times = np.arange(ref+1)[:, np.newaxis]
+    cloud = mask[:ref+1, :]
+    new_cloud = np.zeros_like(cloud)
+    new_cloud[1:, :] = np.logical_and(cloud[1:, :], \
+                                      np.logical_not(cloud[:-1, :]))
+    not_new_cloud = cloud.copy()
+    not_new_cloud[1:, :] = np.logical_and(cloud[1:, :], cloud[:-1, :])
+    detr_cloud = np.zeros_like(cloud)
+    detr_cloud[1:, :] = np.logical_and(np.logical_not(cloud[1:, :]), \
+                                       cloud[:-1, :])
+    in_main_cloud = (times > trigger)
+    from_bl = (tr_z[0, :] < min_cloud_base[lab])
+    
+    event = np.zeros(np.shape(cloud), dtype=int)
+    event[new_cloud] = state.index("new")
+    event[not_new_cloud] = state.index("cont")
+    event[detr_cloud] = state.index("detr")
+    back_class = scheme.lookup(scheme.back_table, event, in_main_cloud, \
+                               from_bl)
+    
+    # Air that is not cloudy at it is post detrainment if it detrained 
+    # before it (class set by first detrainment time) and it < ref.
+    first_detr = np.where(np.any(detr_cloud, axis=0), \
+                          np.argmax(detr_cloud, axis=0), ref+1)
+    post_detr = np.logical_and(np.logical_and(times > first_detr, \
+                                              times < ref), \
+                               np.logical_not(cloud))
+    post_class = scheme.lookup(scheme.back_table, state.index("post"), \
+                               first_detr > trigger, from_bl)
+    back_class[post_detr] = post_class[np.where(post_detr)[1]]
+    
+    # Otherwise, air is pre-cloud if it is entrained later (up to ref).
+    last_entr = np.where(np.any(new_cloud, axis=0), \
+                         ref - np.argmax(new_cloud[::-1, :], axis=0), -1)
+    pre_cloud = np.logical_and(np.logical_and(event == 0, \
+                                              np.logical_not(post_detr)), \
+                               times < last_entr)
+    pre_class = scheme.lookup(scheme.back_table, state.index("pre"), \
+                              in_main_cloud, from_bl)
+    back_class[pre_cloud] = pre_class[pre_cloud]
+    
+    # Times after ref.
+    times = np.arange(ref, nt)[:, np.newaxis]
+    cloud = mask[ref:, :]
+    in_main_cloud = (times < dissipate)
+    new_cloud = np.logical_and(cloud[1:, :], np.logical_not(cloud[:-1, :]))
+    
+    event = np.full(np.shape(new_cloud), state.index("out"), dtype=int)
+    event[np.logical_and(np.logical_not(cloud[1:, :]), cloud[:-1, :])] = \
+        state.index("detr")
+    event[np.logical_and(cloud[1:, :], cloud[:-1, :])] = state.index("cont")
+    event[new_cloud] = state.index("new")
+    forward_class = scheme.lookup(scheme.forward_table, event, \
+                                  in_main_cloud[1:, :], from_bl)
+    # Point before new cloud, including ref.
+    pre_class = scheme.lookup(scheme.forward_table, state.index("pre"), \
+                              in_main_cloud[:-1, :], from_bl)
+    forward_class[:-1, :][new_cloud[1:, :]] = pre_class[1:, :][new_cloud[1:, :]]
+    if nt > ref+1 :
+        back_class[ref, new_cloud[0, :]] = pre_class[0, new_cloud[0, :]]
+    
+    traj_class[:ref+1, pt_active] = back_class[:, pt_active]
+    traj_class[ref+1:, pt_active] = forward_class[:, pt_active]
 
     traj_class = { \
                    "class":traj_class, \
-                   "key":class_key, \
+                   "key":list(scheme.key), \
+                   "colours":list(scheme.colours), \
                    "first_cloud_base":first_cloud_base, \
                    "min_cloud_base":min_cloud_base, \
                    "cloud_top":cloud_top, \
@@ -2382,7 +4250,378 @@ def print_cloud_class(traj, traj_cl, sel_obj, list_classes=True) :
         strout += "{:6d} ".format(tot)
         print(strout)
        
-def cloud_properties(traj, traj_cl, thresh=None, use_density = False) :
+class Cloud_Properties(Mapping) :
+    '''
+    Class giving mean properties of classified trajectories (see 
+    cloud_properties) as a read-only dictionary whose entries are computed 
+    when first accessed and then cached.
+
+    Args:
+        traj       : Trajectory object
+        traj_cl    : Dict of Classifications of trajectory points 
+            provided by set_cloud_class function.
+        thresh     : Threshold if LWC to define cloud. Default is traj.thresh.
+        outputs    : List of keys to provide. Default is all (see 
+            cloud_properties).
+        variables  : List of variable names (from traj.variable_list and 
+            derived_variables) to include. Default is all.
+        objects    : List of objects to compute. Default is all. Arrays 
+            are still indexed by object id; other objects are left as zero.
+            
+    Attributes:
+        variable_list         : Names of data variables included.
+        derived_variable_list : Dict of derived variables included.
+        
+    Property arrays have the included data variables, then derived 
+    variables, then x, y, z position and number of points; see method 
+    column.
+        
+    '''
+    
+    class_outputs = OrderedDict([ \
+        ("unclassified", "Not set"), \
+        ("pre_cloud_bl", "PRE_CLOUD_ENTR_FROM_BL"), \
+        ("pre_cloud_above_bl", "PRE_CLOUD_ENTR_FROM_ABOVE_BL"), \
+        ("previous_cloud", "PREVIOUS_CLOUD"), \
+        ("detr_prev", "DETR_PREV"), \
+        ("post_detr_prev", "POST_DETR_PREV"), \
+        ("cloud", "CLOUD"), \
+        ("entr_bot", "ENTRAINED_FROM_BL"), \
+        ("entr", "ENTRAINED_FROM_ABOVE_BL"), \
+        ("detr", "DETRAINED"), \
+        ("post_detr", "DETRAINED"), \
+        ("subsequent_cloud", "SUBS_CLOUD"), \
+        ])
+    
+    all_outputs = ["overall_mean"] + list(class_outputs.keys()) + \
+        ["cloud_properties", "budget_loss", "entrainment", \
+         "max_cloud_base_area", "max_cloud_base_time", \
+         "cloud_base_variables", "derived_variable_list"]
+    
+    # Pointers into cloud_properties array
+    CLOUD_HEIGHT = 0
+    CLOUD_POINTS = 1
+    CLOUD_VOLUME = 2
+    n_cloud_prop = 3
+    
+    # Pointers into entrainment array                            
+    TOT_ENTR = 0
+    TOT_ENTR_Z = 1
+    SIDE_ENTR = 2
+    SIDE_ENTR_Z = 3
+    CB_ENTR = 4
+    CB_ENTR_Z = 5
+    DETR = 6
+    DETR_Z = 7
+    n_entr_vars = 8
+    
+    def __init__(self, traj, traj_cl, thresh=None, outputs=None, \
+                 variables=None, objects=None) :
+        
+        self.traj = traj
+        self.traj_cl = traj_cl
+        if thresh == None : thresh = traj.ref_func_kwargs["thresh"]
+        self.thresh = thresh
+        
+        key = traj_cl["key"]
+        self.n_class = len(key)
+        try :
+            self.class_index = dict([(name, key.index(name)) for name in \
+                                     self.class_outputs.values()])
+        except ValueError :
+            raise ValueError(\
+                "Classification version {} does not have the classes required by cloud_properties.".\
+                format(traj_cl["version"]))
+            
+        if outputs is None : outputs = self.all_outputs
+        for k in outputs :
+            if k not in self.all_outputs :
+                raise ValueError("Unknown cloud property {}".format(k))
+        self.outputs = list(outputs)
+        
+        if objects is None : objects = np.arange(traj.nobjects)
+        self.objects = np.asarray(objects, dtype=int)
+        
+        if variables is None :
+            self.variable_list = list(traj.variable_list)
+            self.derived_variable_list = dict(derived_variables)
+        else :
+            for v in variables :
+                if v not in traj.variable_list and v not in derived_variables :
+                    raise ValueError("Unknown variable {}".format(v))
+            self.variable_list = [v for v in traj.variable_list \
+                                  if v in variables]
+            self.derived_variable_list = OrderedDict([(v, d) for v, d in \
+                derived_variables.items() if v in variables])
+        self.nvars = len(self.variable_list)
+        self.ndvars = len(self.derived_variable_list)
+        self.nposvars = 3
+        # Index of variable which is number of points
+        self.npts_ptr = self.nvars + self.ndvars + self.nposvars
+        # Index of variable which is height
+        self.z_ptr = self.nvars + self.ndvars + 2
+        
+        self._cache = dict()
+        
+    def __getitem__(self, k) :
+        if k not in self.outputs : raise KeyError(k)
+        if k not in self._cache :
+            if k == "overall_mean" :
+                self._cache[k] = self._mean_prop()
+            elif k in self.class_outputs :
+                self._cache[k] = self._class_mean()[..., \
+                                 self.class_index[self.class_outputs[k]]]
+            elif k == "cloud_properties" :
+                self._cache[k] = self._cloud_prop()
+            elif k == "budget_loss" :
+                mean_prop = self._mean_prop()
+                self._cache[k] = mean_prop[1:, :, :-1] - mean_prop[:-1, :, :-1]
+            elif k == "entrainment" :
+                self._cache[k] = self._entrainment()
+            elif k == "derived_variable_list" :
+                self._cache[k] = self.derived_variable_list
+            else :
+                self._cache.update(self._cloud_base())
+        return self._cache[k]
+        
+    def __iter__(self) :
+        return iter(self.outputs)
+        
+    def __len__(self) :
+        return len(self.outputs)
+    
+    def column(self, v) :
+        """
+        Method to convert variable name to pointer into property arrays.
+
+        Args:
+            v (string):  variable name, derived variable name, "x", "y", 
+                         "z" or "npts".
+
+        Returns:
+            Numerical pointer to data in property arrays.
+
+        """
+        
+        if v in self.variable_list : return self.variable_list.index(v)
+        if v in self.derived_variable_list :
+            return self.nvars + list(self.derived_variable_list).index(v)
+        pos = ["x", "y", "z", "npts"]
+        if v in pos : return self.nvars + self.ndvars + pos.index(v)
+        raise KeyError(v)
+        
+    def _cached(self, name, func) :
+        if name not in self._cache : self._cache[name] = func()
+        return self._cache[name]
+        
+    def _points(self) :
+        # Points in selected objects, in original order.
+        def points() :
+            return np.where(np.isin(self.traj.labels, self.objects))[0]
+        return self._cached("_points", points)
+    
+    def _values(self) :
+        # Values of included variables and positions at points.
+        def values() :
+            traj = self.traj
+            pts = self._points()
+            vars_ptr = [traj.var(v) for v in self.variable_list]
+            parts = [traj.data[:, pts, :][:, :, vars_ptr]]
+            if self.ndvars > 0 :
+                parts.append(compute_derived_variables(traj, \
+                             self.derived_variable_list, points=pts)[1])
+            parts.append(traj.trajectory[:, pts, :])
+            return np.concatenate(parts, axis=2)
+        return self._cached("_values", values)
+        
+    def _group(self) :
+        # Index of (time, object) of each point.
+        def group() :
+            traj = self.traj
+            return np.arange(traj.ntimes)[:, np.newaxis] * traj.nobjects + \
+                   traj.labels[self._points()]
+        return self._cached("_group", group)
+    
+    def _class_group(self) :
+        # Index of (time, object, class) of each point, and valid points.
+        def class_group() :
+            traj_class = self.traj_cl["class"][:, self._points()]
+            valid = np.logical_and(traj_class >= 0, traj_class < self.n_class)
+            return self._group() * self.n_class + traj_class, valid
+        return self._cached("_class_group", class_group)
+        
+    def _class_sum(self, values) :
+        # Sum values [nt, npts, ...] by class; returns [nt, nobj, ..., n_class]
+        traj = self.traj
+        group, valid = self._class_group()
+        class_sum = grouped_sum(values[valid], group[valid], \
+                                traj.ntimes * traj.nobjects * self.n_class)[0]
+        class_sum = class_sum.reshape((traj.ntimes, traj.nobjects, \
+                                       self.n_class) + np.shape(values)[2:])
+        return np.moveaxis(class_sum, 2, -1)
+        
+    def _mean_prop(self) :
+        def mean_prop() :
+            traj = self.traj
+            mean_prop = np.zeros([traj.ntimes, traj.nobjects, \
+                                  self.npts_ptr + 1])
+            obj_sum, npts_obj = grouped_sum(\
+                self._values().reshape(-1, self.npts_ptr), \
+                self._group().ravel(), traj.ntimes * traj.nobjects)
+            obj_sum = obj_sum.reshape(traj.ntimes, traj.nobjects, \
+                                      self.npts_ptr)
+            npts_obj = npts_obj.reshape(traj.ntimes, traj.nobjects)
+            sel = self.objects
+            with np.errstate(invalid='ignore', divide='ignore') :
+                mean_prop[:, sel, :self.npts_ptr] = obj_sum[:, sel, :] / \
+                    npts_obj[:, sel, np.newaxis]
+            mean_prop[:, sel, self.npts_ptr] = npts_obj[:, sel]
+            return mean_prop
+        return self._cached("_mean_prop", mean_prop)
+        
+    def _class_total(self) :
+        # Sum of properties and number of points over each class.
+        def class_total() :
+            traj = self.traj
+            total = np.zeros([traj.ntimes, traj.nobjects, \
+                              self.npts_ptr + 1, self.n_class + 1])
+            total[..., :self.npts_ptr, :self.n_class] = \
+                self._class_sum(self._values())
+            total[..., self.npts_ptr, :self.n_class] = \
+                self._class_count()
+            return total
+        return self._cached("_class_total", class_total)
+        
+    def _class_count(self) :
+        # Number of points in each class [nt, nobj, n_class].
+        def class_count() :
+            traj = self.traj
+            group, valid = self._class_group()
+            return np.bincount(group[valid], minlength = traj.ntimes * \
+                traj.nobjects * self.n_class).reshape(traj.ntimes, \
+                traj.nobjects, self.n_class)
+        return self._cached("_class_count", class_count)
+        
+    def _class_column(self, v) :
+        # Sum of variable v over each class [nt, nobj, n_class]
+        if "_class_total" in self._cache or v == "z" or \
+            v in self.variable_list :
+            return self._class_total()[..., self.column(v), :self.n_class]
+        return self._cached("_class_" + v, lambda : self._class_sum(\
+                    self.traj.data[:, self._points(), self.traj.var(v)]))
+        
+    def _class_mean(self) :
+        def class_mean() :
+            mean_prop_by_class = self._class_total().copy()
+            n = mean_prop_by_class[:, :, self.npts_ptr, :]
+            m = (n > 0)
+            for ii in range(self.npts_ptr) :
+                mean_prop_by_class[:, :, ii, :][m] /= n[m]
+            return mean_prop_by_class
+        return self._cached("_class_mean", class_mean)
+        
+    def _cloud_prop(self) :
+        traj = self.traj
+        CLOUD = self.class_index["CLOUD"]
+        ENTR_FROM_ABOVE_BL = self.class_index["ENTRAINED_FROM_ABOVE_BL"]
+        ENTR_FROM_BL = self.class_index["ENTRAINED_FROM_BL"]
+        grid_box_volume = traj.deltax * traj.deltay * traj.deltaz
+        
+        cloud_prop = np.zeros([traj.ntimes, traj.nobjects, self.n_cloud_prop])
+        n = self._class_count()
+        z = self._class_column("z")
+        v_main_cloud = z[..., CLOUD] + z[..., ENTR_FROM_ABOVE_BL] + \
+                       z[..., ENTR_FROM_BL]
+        n_main_cloud = (n[..., CLOUD] + n[..., ENTR_FROM_ABOVE_BL] + \
+                        n[..., ENTR_FROM_BL]).astype(float)
+        incl = (n_main_cloud > 0)
+        z_cloud = (v_main_cloud-0.5)*traj.deltaz
+        z_cloud[incl] = z_cloud[incl] / n_main_cloud[incl]          
+        
+        sel = self.objects
+        cloud_prop[:, sel, self.CLOUD_HEIGHT] = z_cloud[:, sel]
+        cloud_prop[:, sel, self.CLOUD_POINTS] = n_main_cloud[:, sel]
+        cloud_prop[:, sel, self.CLOUD_VOLUME] = n_main_cloud[:, sel] * \
+                                                grid_box_volume
+        return cloud_prop
+        
+    def _entrainment(self) :
+        traj = self.traj
+        CLOUD = self.class_index["CLOUD"]
+        ENTR_FROM_ABOVE_BL = self.class_index["ENTRAINED_FROM_ABOVE_BL"]
+        ENTR_FROM_BL = self.class_index["ENTRAINED_FROM_BL"]
+        DETRAINED = self.class_index["DETRAINED"]
+        DETR_PREV = self.class_index["DETR_PREV"]
+        
+        entrainment = -np.ones([traj.ntimes-1, traj.nobjects, \
+                                self.n_entr_vars])
+        delta_t = (traj.times[1:]-traj.times[:-1])[:, np.newaxis]
+        n = self._class_count()[1:, ...].astype(float)
+        n_now = n[..., CLOUD]
+        n_entr_bot = n[..., ENTR_FROM_BL]
+        n_entr = n[..., ENTR_FROM_ABOVE_BL]
+        n_detr = n[..., DETRAINED] + n[..., DETR_PREV]
+        
+# Detrainment rate
+        n_cloud = n_now + (n_entr + n_entr_bot + n_detr) / 2.0
+        some_cl = (n_cloud > 0)
+        w = self._class_column("w")[1:, ...]
+        w = w[..., CLOUD] + (w[..., ENTR_FROM_ABOVE_BL] + \
+                             w[..., ENTR_FROM_BL] + w[..., DETRAINED]) / 2.0 
+        w_cloud = np.zeros_like(w)
+        w_cloud[some_cl] = w[some_cl] / n_cloud[some_cl]
+        
+        def rate(n_change) :
+            delta_n_over_n = np.zeros_like(n_cloud)
+            delta_n_over_n[some_cl] = n_change[some_cl] / n_cloud[some_cl]
+            rate = delta_n_over_n / delta_t
+# Rate per m
+            rate_z = np.zeros_like(rate)
+            with np.errstate(invalid='ignore', divide='ignore') :
+                rate_z[some_cl] = rate[some_cl] / w_cloud[some_cl]
+            return rate, rate_z
+            
+        sel = self.objects
+        for (ptr, ptr_z, n_change) in [ \
+                (self.DETR, self.DETR_Z, n_detr), \
+                (self.TOT_ENTR, self.TOT_ENTR_Z, n_entr + n_entr_bot), \
+                (self.SIDE_ENTR, self.SIDE_ENTR_Z, n_entr), \
+                (self.CB_ENTR, self.CB_ENTR_Z, n_entr_bot)] :
+            r, r_z = rate(n_change)
+            entrainment[:, sel, ptr] = r[:, sel]
+            entrainment[:, sel, ptr_z] = r_z[:, sel]
+        return entrainment
+        
+    def _cloud_base(self) :
+        traj = self.traj
+        ENTR_FROM_BL = self.class_index["ENTRAINED_FROM_BL"]
+        grid_box_area = traj.deltax * traj.deltay
+        
+        max_cloud_base_area = np.zeros(traj.nobjects)
+        max_cloud_base_time = np.zeros(traj.nobjects, dtype = int)
+        cloud_base_variables = np.zeros([traj.nobjects, self.npts_ptr])
+        
+        sel = self.objects
+        n_entr_bot = self._class_count()[1:, :, ENTR_FROM_BL]
+        max_cloud_base_area[sel] = np.max(n_entr_bot[:, sel], axis=0)
+        max_cloud_base_time[sel] = np.argmax(n_entr_bot[:, sel], axis=0)
+        v_entr_bot = self._class_total()[1:, :, :self.npts_ptr, ENTR_FROM_BL]
+        for iobj in sel :
+            if max_cloud_base_area[iobj] > 0 :
+                cloud_base_variables[iobj,:] = \
+                    v_entr_bot[max_cloud_base_time[iobj], iobj, :] / \
+                    max_cloud_base_area[iobj]
+            else :
+                analysis_logger.debug('Zero cloud base area for cloud %d', iobj)
+        max_cloud_base_area = max_cloud_base_area * grid_box_area
+        
+        return {"max_cloud_base_area":max_cloud_base_area, \
+                "max_cloud_base_time":max_cloud_base_time, \
+                "cloud_base_variables":cloud_base_variables}
+
+def cloud_properties(traj, traj_cl, thresh=None, use_density = False, \
+                     outputs=None, variables=None, objects=None, \
+                     lazy=False) :
     '''
     Function to compute trajectory class and mean cloud properties.
 
@@ -2391,6 +4630,13 @@ def cloud_properties(traj, traj_cl, thresh=None, use_density = False) :
         traj_cl    : Dict of Classifications of trajectory points 
             provided by set_cloud_class function.
         thresh     : Threshold if LWC to define cloud. Default is traj.thresh.
+        outputs    : List of keys (below) to compute. Default is all.
+        variables  : List of variable names (from traj.variable_list and 
+            derived_variables) to include. Default is all.
+        objects    : List of objects to compute. Default is all. Arrays 
+            are still indexed by object id; other objects are left as zero.
+        lazy       : If True, return a Cloud_Properties object which 
+            computes each output when first used.
 
     Returns: 
         dictionary pointing to arrays of mean properties and meta data::
@@ -2412,515 +4658,23 @@ def cloud_properties(traj, traj_cl, thresh=None, use_density = False) :
                 "cloud_properties"
                 "budget_loss"
                 "entrainment"
+                "max_cloud_base_area"
+                "max_cloud_base_time"
+                "cloud_base_variables"
                 "derived_variable_list"
         
     @author: Peter Clark
 
     '''
  
-    if thresh == None : thresh = traj.ref_func_kwargs["thresh"]
-    version = traj_cl["version"]
-    if version == 1 :
-        n_class = len(traj_cl["key"])
-        UNCLASSIFIED = traj_cl["key"].index('Not set')
-        PRE_CLOUD_ENTR_FROM_BL = traj_cl["key"].index('PRE_CLOUD_ENTR_FROM_BL')
-        PRE_CLOUD_ENTR_FROM_ABOVE_BL = traj_cl["key"].index('PRE_CLOUD_ENTR_FROM_ABOVE_BL')
-        PREVIOUS_CLOUD = traj_cl["key"].index('PREVIOUS_CLOUD')
-        DETR_PREV = traj_cl["key"].index('DETR_PREV')
-        POST_DETR_PREV = traj_cl["key"].index('POST_DETR_PREV')
-        CLOUD = traj_cl["key"].index('CLOUD')
-        ENTR_FROM_BL = traj_cl["key"].index('ENTRAINED_FROM_BL')
-        ENTR_FROM_ABOVE_BL = traj_cl["key"].index('ENTRAINED_FROM_ABOVE_BL')
-        DETRAINED = traj_cl["key"].index('DETRAINED')
-        POST_DETR = traj_cl["key"].index('POST_DETR')
-        SUBSEQUENT_CLOUD = traj_cl["key"].index('SUBS_CLOUD')
-    else :
-        print("Illegal Version")
-        return 
-    
-    traj_class = traj_cl["class"]
+    mean_properties = Cloud_Properties(traj, traj_cl, thresh=thresh, \
+                                       outputs=outputs, variables=variables, \
+                                       objects=objects)
+    if lazy : return mean_properties
+    return dict(mean_properties)
     
-    derived_variable_list, derived_data = compute_derived_variables(traj)
-                    
-    nvars = np.shape(traj.data)[2]
-    ndvars = np.shape(derived_data)[2]
-    nposvars = 3
-    total_nvars = nvars + ndvars + nposvars + 1
-
-    z_ptr = nvars + ndvars + 2 # Index of variable in mean_prop which is height
-    npts_ptr = nvars + ndvars + nposvars # Index of variable in mean_prop which is 
-    w_ptr = traj.var('w')
-    mse_ptr = nvars + list(derived_variable_list.keys()).index("MSE") 
-    qt_ptr = nvars + list(derived_variable_list.keys()).index("q_total")
-
-    grid_box_area = traj.deltax * traj.deltay
-    grid_box_volume = grid_box_area * traj.deltaz
-    
-    rho = np.interp(traj.trajectory[:,:,2],traj.zcoord,traj.rhoref)
-    
-#    print(nvars, ndvars, nposvars)
-    # These possible slices are set for ease of maintenance.
-    # Main data variables.
-    r1 = slice(0,nvars)
-    # Derived variables
-    r2 = slice(nvars, nvars+ndvars)
-    # Position
-    r3 = slice(nvars+ndvars,nvars+ndvars+nposvars)
-    # Number of points
-    r4 = nvars + ndvars + nposvars 
-    
-    if version == 1 :
-        mean_prop = np.zeros([traj.ntimes, traj.nobjects, total_nvars])
-        
-        mean_prop_by_class = np.zeros([traj.ntimes, traj.nobjects, \
-                                       total_nvars,  n_class+1])
-        budget_loss = np.zeros([traj.ntimes-1, traj.nobjects, total_nvars-1])
-        
-        # Pointers into cloud_prop array
-        CLOUD_HEIGHT = 0
-        CLOUD_POINTS = 1
-        CLOUD_VOLUME = 2
-        n_cloud_prop = 3
-        
-        cloud_prop = np.zeros([traj.ntimes, traj.nobjects, n_cloud_prop])
-        
-        # Pointers into entrainment array                            
-        TOT_ENTR = 0
-        TOT_ENTR_Z = 1
-        SIDE_ENTR = 2
-        SIDE_ENTR_Z = 3
-        CB_ENTR = 4
-        CB_ENTR_Z = 5
-        DETR = 6
-        DETR_Z = 7
-        n_entr_vars = 8
-        entrainment = -np.ones([traj.ntimes-1, traj.nobjects, n_entr_vars])
-        
-        max_cloud_base_area = np.zeros(traj.nobjects)
-        max_cloud_base_time = np.zeros(traj.nobjects, dtype = int)
-        cloud_base_variables = np.zeros([traj.nobjects, total_nvars-1])
-       
-    else :
-        print("Illegal Version")
-        return 
-                                  
-# Compute mean properties of cloudy points. 
-   
-    for iobj in range(0,traj.nobjects) :
-#        debug_mean = (iobj == 61)
-        if debug_mean : print('Processing object {}'.format(iobj))
-        
-        obj_ptrs = (traj.labels == iobj)
-        
-#        where_obj_ptrs = np.where(obj_ptrs)[0]
-        tr = traj.trajectory[:, obj_ptrs, :]
-        data = traj.data[:, obj_ptrs, :]
-        derv_data = derived_data[:, obj_ptrs, :]
-#        obj_z = tr_z[:,obj_ptrs]
-        
-#        if debug_mean : print(np.shape(data), np.shape(derv_data))
-        
-#        qcl = data[:,:,traj.var("q_cloud_liquid_mass")]
-#        mask_qcl = (qcl >= thresh)
-#        w = data[:,:,traj.var("w")]
-#        mask_w = (w >= 0.1)
-#        mask = np.logical_and(mask_qcl, mask_w)
-#        
-##        print("Object ",iobj, np.size(np.where(mask[traj.ref,:])[0]))
-#        
-#        if np.size(np.where(mask[traj.ref,:])[0]) == 0 :
-#            print("Object {} is not active at reference time.".format(iobj))
-#            continue
-
-# Sum properties over classes; division by number of points happens later.
-        for it in range(0, traj.end+1) :
-            
-            mean_prop[it, iobj, r1] = np.mean(data[it, :, :], axis=0)  
-            mean_prop[it, iobj, r2] = np.mean(derv_data[it, :, :], axis=0)    
-            mean_prop[it, iobj, r3] = np.mean(tr[it, :, :], axis=0)
-            mean_prop[it, iobj, r4] = np.size(data[it, :, 0])
-            
-            for iclass in range(0,n_class) :
-#                if debug_mean : 
-#                    print(it, iclass)
-                trcl = traj_class[it, obj_ptrs]
-                lmask = (trcl == iclass)  
-                where_mask = np.where(lmask)[0]
-         
-                if np.size(where_mask) > 0 :
-#                    if debug_mean : 
-#                        print(data[it, lmask, :])
-#                        print(derv_data[it, lmask, :])
-                    mean_prop_by_class[it, iobj, r1, iclass] = \
-                        np.sum(data[it, lmask, :], axis=0)  
-                    mean_prop_by_class[it, iobj, r2, iclass] = \
-                        np.sum(derv_data[it, lmask, :], axis=0)    
-                    mean_prop_by_class[it, iobj, r3, iclass] = \
-                        np.sum(tr[it, lmask,:], axis=0)
-                    mean_prop_by_class[it, iobj, r4, iclass] = \
-                        np.size(where_mask)
-                        
-# Now compute budget and entrainment/detrainment terms.
-
-        delta_t = (traj.times[1:]-traj.times[:-1])
-                        
-        incloud = np.arange(traj.end + 1, dtype=int)
-        incloud = np.logical_and( \
-                        incloud >= traj_cl['cloud_trigger_time'][iobj],\
-                        incloud <  traj_cl['cloud_dissipate_time'][iobj])
-        
-        precloud = np.arange(traj.end + 1, dtype=int)
-        precloud = (precloud < traj_cl['cloud_trigger_time'][iobj])
-#            print(precloud)
-# Cloud volume
-        v_main_cloud = mean_prop_by_class[:,iobj,:npts_ptr, CLOUD] + \
-                       mean_prop_by_class[:,iobj,:npts_ptr, ENTR_FROM_ABOVE_BL] + \
-                       mean_prop_by_class[:,iobj,:npts_ptr, ENTR_FROM_BL]
-                       
-        n_main_cloud = mean_prop_by_class[:,iobj, npts_ptr, CLOUD] + \
-                       mean_prop_by_class[:,iobj, npts_ptr, ENTR_FROM_ABOVE_BL] + \
-                       mean_prop_by_class[:,iobj, npts_ptr, ENTR_FROM_BL]
-                       
-        incl = (n_main_cloud > 0)
-        z_cloud = (v_main_cloud[:, z_ptr]-0.5)*traj.deltaz
-#        print(np.shape(z_cloud), np.shape(n_main_cloud),np.shape(incl))
-        z_cloud[incl] = z_cloud[incl] / n_main_cloud[incl]          
-
-        if debug_mean :
-            print(traj_cl['cloud_trigger_time'][iobj],traj_cl['cloud_dissipate_time'][iobj])
-            print(np.shape(incloud),np.shape(precloud))
-            print(mean_prop_by_class[:, iobj, npts_ptr, CLOUD])
-            print(precloud)
-            print(incloud)
-            print(incl)
-            print(z_cloud)
-                      
-        cloud_volume = n_main_cloud * grid_box_volume 
-
-        cloud_prop[:,iobj,CLOUD_HEIGHT] = z_cloud
-        cloud_prop[:,iobj,CLOUD_POINTS] = n_main_cloud
-        cloud_prop[:,iobj,CLOUD_VOLUME] = cloud_volume
-        
-##################### Lagrangian budget #####################################        
-
-# Budget:
-# This timestep
-# (In cloud or prev cloud now and not new) +
-# (Just entrained at cloud base) +
-# (Just entrained above cloud base) +
-# (Just detrained)
-# 
-# Where did this come from?
-# Previous timestep
-# (In cloud or prev cloud now and not new) +
-# (Just entrained at cloud base) +
-# (Just entrained above cloud base) +
-# -(Change in pre cloud entrained at cloud base) +
-# -(Change in pre cloud entrained above cloud base) +
-# -(Change in post detrained if negative)
-# -(Change in post detrained previous cloud if negative)
-#   
-################### This timestep ###########################
-#            
-# In cloud now and not new.
-        v_now  = mean_prop_by_class[1:,iobj,:npts_ptr, CLOUD] 
-        n_now  = mean_prop_by_class[1:,iobj, npts_ptr, CLOUD]
-
-# In prev cloud now and not new.
-        v_prev_now  = mean_prop_by_class[1:,iobj,:npts_ptr, PREVIOUS_CLOUD]
-        n_prev_now  = mean_prop_by_class[1:,iobj, npts_ptr, PREVIOUS_CLOUD]
-  
-# New cloud entrained from cloud base                 
-        v_entr_bot = mean_prop_by_class[1:,iobj,:npts_ptr, ENTR_FROM_BL]
-        n_entr_bot = mean_prop_by_class[1:,iobj, npts_ptr, ENTR_FROM_BL]
-
-# New cloud entrained from above cloud base                               
-        v_entr = mean_prop_by_class[1:,iobj,:npts_ptr, ENTR_FROM_ABOVE_BL]
-        n_entr = mean_prop_by_class[1:,iobj, npts_ptr, ENTR_FROM_ABOVE_BL]
-
-# Just detrained.
-        v_detr = mean_prop_by_class[1:,iobj,:npts_ptr, DETRAINED] + \
-                 mean_prop_by_class[1:,iobj,:npts_ptr, DETR_PREV]
-        n_detr = mean_prop_by_class[1:,iobj, npts_ptr, DETRAINED] + \
-                 mean_prop_by_class[1:,iobj, npts_ptr, DETR_PREV]
-
-################### Previous timestep ###########################
-#
-# (In cloud or prev cloud now and not new) +
-# (Just entrained at cloud base) +
-# (Just entrained above cloud base) 
-                 
-        v_prev = mean_prop_by_class[:-1,iobj,:npts_ptr, CLOUD] + \
-                 mean_prop_by_class[:-1,iobj,:npts_ptr, PREVIOUS_CLOUD]+ \
-                 mean_prop_by_class[:-1,iobj,:npts_ptr, ENTR_FROM_ABOVE_BL] + \
-                 mean_prop_by_class[:-1,iobj,:npts_ptr, ENTR_FROM_BL] 
-        n_prev = mean_prop_by_class[:-1,iobj, npts_ptr, CLOUD] + \
-                 mean_prop_by_class[:-1,iobj, npts_ptr, PREVIOUS_CLOUD] + \
-                 mean_prop_by_class[:-1,iobj, npts_ptr, ENTR_FROM_ABOVE_BL] + \
-                 mean_prop_by_class[:-1,iobj, npts_ptr, ENTR_FROM_BL]
-
-# (Change in pre cloud entrained at cloud base)
-
-        v_entr_pre_bot = mean_prop_by_class[ :-1,iobj,:npts_ptr, PRE_CLOUD_ENTR_FROM_BL] - \
-                         mean_prop_by_class[1:,  iobj,:npts_ptr, PRE_CLOUD_ENTR_FROM_BL]
-        n_entr_pre_bot = mean_prop_by_class[ :-1,iobj, npts_ptr, PRE_CLOUD_ENTR_FROM_BL] - \
-                         mean_prop_by_class[1:,  iobj, npts_ptr, PRE_CLOUD_ENTR_FROM_BL]
-                        
-# (Change in pre cloud entrained above cloud base)
-        v_entr_pre = mean_prop_by_class[ :-1,iobj,:npts_ptr, PRE_CLOUD_ENTR_FROM_ABOVE_BL] - \
-                     mean_prop_by_class[1:,  iobj,:npts_ptr, PRE_CLOUD_ENTR_FROM_ABOVE_BL]
-        n_entr_pre = mean_prop_by_class[ :-1,iobj, npts_ptr, PRE_CLOUD_ENTR_FROM_ABOVE_BL] - \
-                     mean_prop_by_class[1:,  iobj, npts_ptr, PRE_CLOUD_ENTR_FROM_ABOVE_BL]
-                                                      
-                           
-# Decrease in air detrained from previous cloud.       
-# (Change in post detrained previous cloud if negative)
-        v_entr_prev_cl = mean_prop_by_class[1:  ,iobj,:npts_ptr, POST_DETR_PREV] - \
-                         mean_prop_by_class[ :-1,iobj,:npts_ptr, POST_DETR_PREV]
-        n_entr_prev_cl = mean_prop_by_class[1:  ,iobj, npts_ptr, POST_DETR_PREV] - \
-                         mean_prop_by_class[ :-1,iobj, npts_ptr, POST_DETR_PREV]
-                         
-        prev_cl_not_entr = (n_entr_prev_cl > 0)[...,0]
-        v_entr_prev_cl[prev_cl_not_entr,:] = 0
-        n_entr_prev_cl[prev_cl_not_entr,:] = 0
-
-# -(Change in post detrained if negative)
-        v_entr_detr_cl = mean_prop_by_class[1:  ,iobj,:npts_ptr, POST_DETR] - \
-                         mean_prop_by_class[ :-1,iobj,:npts_ptr, POST_DETR]
-        n_entr_detr_cl = mean_prop_by_class[1:  ,iobj, npts_ptr, POST_DETR] - \
-                         mean_prop_by_class[ :-1,iobj, npts_ptr, POST_DETR]
-
-        detr_cl_not_entr = (n_entr_detr_cl > 0)[...,0]
-        v_entr_detr_cl[detr_cl_not_entr,:] = 0
-        n_entr_detr_cl[detr_cl_not_entr,:] = 0
-                         
-        n_now = n_now[:, np.newaxis]
-        n_prev_now = n_prev_now[:, np.newaxis]
-        n_entr_bot = n_entr_bot[:, np.newaxis]
-        n_entr = n_entr[:, np.newaxis]
-        n_detr = n_detr[:, np.newaxis]
-        n_prev = n_prev[:, np.newaxis]
-        n_entr_pre_bot = n_entr_pre_bot[:, np.newaxis]
-        n_entr_pre = n_entr_pre[:, np.newaxis]
-        n_entr_prev_cl = n_entr_prev_cl[:, np.newaxis]
-        n_entr_detr_cl = n_entr_detr_cl[:, np.newaxis]
-
-
-#        if debug_mean : 
-#            print('entr_bot_pre', v_entr_pre_bot[..., mse_ptr ],n_entr_pre_bot)
-        
-        v_total_now = v_now + v_prev_now + v_entr + v_entr_bot + v_detr 
-        n_total_now = n_now + n_prev_now + n_entr + n_entr_bot + n_detr
-        
-#        if debug_mean : 
-#            print('v_total_now', v_total_now[..., mse_ptr ],n_total_now)
-        
-        v_total_pre = v_prev + v_entr_pre + v_entr_pre_bot \
-                      - v_entr_prev_cl - v_entr_detr_cl
-        n_total_pre = n_prev + n_entr_pre + n_entr_pre_bot \
-                      - n_entr_prev_cl - n_entr_detr_cl
-        
-#        if debug_mean : 
-#            print('v_total_pre', v_total_pre[..., mse_ptr ],n_total_pre)
-                                                                      
-        v_loss = v_total_now - v_total_pre 
-        n_loss = n_total_now - n_total_pre
-        
-        if debug_mean : 
-#            print('now',v_now[..., mse_ptr],n_now )
-
-            print('loss', v_loss[..., mse_ptr])
-        
-        some_cl = n_total_now[:,0] > 0
-        v_loss_cl = np.zeros_like(v_loss) 
-        v_loss_cl[some_cl] = v_loss[some_cl] / n_total_now[some_cl]
-
-        if debug_mean : 
-#            print('now',v_now[..., mse_ptr],n_now )
-
-            print('loss', v_loss_cl[..., mse_ptr])
-#        print(np.shape(some_cl), np.shape(v_loss), np.shape(n_total_now))                  
-        
-        if debug_mean : 
-#            print('loss per point', v_loss[..., mse_ptr ])
-            ln = "{:3d} "
-            for i in range(11) : ln += "{:5.0f} "
-            print(" i    now  prev e_bot   ent   det n_pre  pe_b    pe    pp     ep nloss")
-            for i in range(np.shape(v_now)[0]) :
-                print(ln.format(i+1, n_now[i,0], \
-                                     n_prev_now[i,0], \
-                                     n_entr_bot[i,0], \
-                                     n_entr[i,0], \
-                                     n_detr[i,0], \
-                                     n_prev[i,0], \
-                                     n_entr_pre_bot[i,0], \
-                                     n_entr_pre[i,0], \
-                                     n_entr_prev_cl[i,0], \
-                                     n_entr_detr_cl[i,0], \
-                                     n_loss[i,0]))
-# Detrainment rate
-        
-        if False : 
-            print("n_detr",np.shape(n_detr))
-            print("n_entr",np.shape(n_entr))
-            print("n_entr_bot",np.shape(n_entr_bot))
-            
-# Detrainment rate
-        
-        n_cloud = n_now + (n_entr + n_entr_bot + n_detr) / 2.0
-        some_cl = (n_cloud[:,0] > 0)
-        w = mean_prop_by_class[1:, iobj, w_ptr, CLOUD] + \
-            (mean_prop_by_class[1:, iobj, w_ptr, ENTR_FROM_ABOVE_BL] + \
-             mean_prop_by_class[1:, iobj, w_ptr, ENTR_FROM_BL] + \
-             mean_prop_by_class[1:, iobj, w_ptr, DETRAINED]) / 2.0 
-            
-#        print(np.shape(some_cl), np.shape(w), np.shape(n_cloud))                  
-        w_cloud = np.zeros_like(w)
-        w_cloud[some_cl] = w[some_cl] / n_cloud[some_cl,0]
-        
-        delta_n_over_n = np.zeros_like(n_cloud[:,0])
-        delta_n_over_n[some_cl] = n_detr[some_cl,0] / n_cloud[some_cl,0]
-#        print(np.shape(delta_n_over_n),np.shape(delta_t))
-        detr_rate = delta_n_over_n / delta_t
-# Detrainment rate per m
-             
-#        print(np.shape(some_cl), np.shape(w_cloud), np.shape(detr_rate))                  
-        detr_rate_z = np.zeros_like(detr_rate)
-        detr_rate_z[some_cl] = detr_rate[some_cl] / w_cloud[some_cl]
-            
-# Total Entrainment rate
-        n_new_cloud = n_entr + n_entr_bot 
-        delta_n_over_n = np.zeros_like(n_cloud[:,0])
-        delta_n_over_n[some_cl] = n_new_cloud[some_cl,0] / n_cloud[some_cl,0]                
-        entr_rate_tot = delta_n_over_n / delta_t
-                        
-# Entrainment rate per m      
-             
-        entr_rate_tot_z = np.zeros_like(entr_rate_tot)
-        entr_rate_tot_z[some_cl] = entr_rate_tot[some_cl] / w_cloud[some_cl]
-        
-# Side Entrainment rate 
-        n_new_cloud = n_entr 
-        delta_n_over_n = np.zeros_like(n_cloud[:,0])
-        delta_n_over_n[some_cl] = n_new_cloud[some_cl,0] / n_cloud[some_cl,0]
-        
-        z1 = (mean_prop_by_class[1:, iobj, z_ptr, CLOUD]-0.5)*traj.deltaz 
-        
-        
-        entr_rate = delta_n_over_n / delta_t
-# Side Entrainment rate per m
-             
-        entr_rate_z = np.zeros_like(entr_rate)
-        entr_rate_z[some_cl] = entr_rate[some_cl] / w_cloud[some_cl]
-        
-# Cloud_base Entrainment_rate 
-        n_new_cloud = n_entr_bot 
-        delta_n_over_n = np.zeros_like(n_cloud[:,0])
-        delta_n_over_n[some_cl] = n_new_cloud[some_cl,0] / n_cloud[some_cl,0]                
-        entr_rate_cb = delta_n_over_n / delta_t
-
-# Cloud_base Entrainment_rate per m 
-        entr_rate_cb_z = np.zeros_like(entr_rate)
-        entr_rate_cb_z[some_cl] = entr_rate_cb[some_cl] / w_cloud[some_cl]
-        
-        if False : 
-            print('n cloud', n_cloud)
-            print('w cloud', mean_prop_by_class[1:, iobj, w_ptr, CLOUD])
-            print('w entr', mean_prop_by_class[1:, iobj, w_ptr, ENTR_FROM_ABOVE_BL])
-            print('w', w)
-
-
-        if False : 
-            print('detr_rate', np.shape(detr_rate))
-            print('entr_rate_tot', np.shape(entr_rate_tot))
-            print('entr_rate', np.shape(entr_rate))
-
-        if debug_mean : 
-            print('detr_rate', detr_rate)
-            print('detr_rate_z', detr_rate_z)
-            print('entr_rate_tot', entr_rate_tot)
-            print('entr_rate_tot_z', entr_rate_tot_z)
-            print('entr_rate', entr_rate)
-            print('entr_rate_z', entr_rate_z)
-            
-            
-#        print(np.shape(v_loss), np.shape(budget_loss[:,iobj,:]))
-#        budget_loss[:,iobj,:] = v_loss_cl
-        budget_loss[:, iobj, :] = mean_prop[1:  , iobj, :-1] - \
-                                  mean_prop[ :-1, iobj, :-1]
-
-        entrainment[:, iobj, TOT_ENTR] = entr_rate_tot
-        entrainment[:, iobj, TOT_ENTR_Z] = entr_rate_tot_z
-            
-        entrainment[:, iobj, SIDE_ENTR] = entr_rate
-        entrainment[:, iobj, SIDE_ENTR_Z] = entr_rate_z
-
-        entrainment[:, iobj, CB_ENTR] = entr_rate_cb
-        entrainment[:, iobj, CB_ENTR_Z] = entr_rate_cb_z
-
-        entrainment[:, iobj, DETR] = detr_rate
-        entrainment[:, iobj, DETR_Z] = detr_rate_z
-        
-# Overall cloud properties
-# Cloud base
-        max_cloud_base_area[iobj] = np.max(n_entr_bot)
-#        print(max_cloud_base_area[iobj])
-#        print(np.where(n_entr_bot == max_cloud_base_area[iobj])[0][0])
-        max_cloud_base_time[iobj] = np.where(n_entr_bot == max_cloud_base_area[iobj])[0][0]
-#        print(max_cloud_base_time[iobj])
-        if max_cloud_base_area[iobj] > 0 :
-            cloud_base_variables[iobj,:] = v_entr_bot[max_cloud_base_time[iobj], :] / max_cloud_base_area[iobj]
-        else :
-           print('Zero cloud base area for cloud {}'.format(iobj))
-        max_cloud_base_area[iobj] = max_cloud_base_area[iobj] * grid_box_area
-           
-#        nplt = 72
-#        for it in range(np.shape(mean_prop_by_class)[0]) :
-#            s = '{:3d}'.format(it)
-#            for iclass in range(0,n_class) :
-#                s = s+'{:4d} '.format(mean_prop_by_class[it, nplt, r4, iclass].astype(int))
-#            s = s+'{:6d} '.format(np.sum(mean_prop_by_class[it, nplt, r4, :].astype(int)))
-#            print(s)
-#            
-#        for it in range(np.shape(mean_prop_by_class)[0]) :
-#            s = '{:3d}'.format(it)
-#            for iclass in range(0,n_class) :
-#                s = s+'{:10f} '.format(mean_prop_by_class[it, nplt, nvars, iclass]/1E6)
-#            s = s+'{:12f} '.format(np.sum(mean_prop_by_class[it, nplt, nvars, :])/1E6)
-#            print(s)
-        
-    for iclass in range(0,n_class) :
-        m = (mean_prop_by_class[:, :, r4, iclass]>0)   
-        for ii in range(nvars+ndvars+nposvars) : 
-            mean_prop_by_class[:, :, ii, iclass][m] /= \
-                mean_prop_by_class[:, :, r4, iclass][m]
-                
-
-    mean_properties = {"overall_mean":mean_prop, \
-                       "unclassified":mean_prop_by_class[..., UNCLASSIFIED], \
-                       "pre_cloud_bl":mean_prop_by_class[..., PRE_CLOUD_ENTR_FROM_BL], \
-                       "pre_cloud_above_bl":mean_prop_by_class[..., PRE_CLOUD_ENTR_FROM_ABOVE_BL], \
-                       "previous_cloud":mean_prop_by_class[..., PREVIOUS_CLOUD], \
-                       "detr_prev":mean_prop_by_class[..., DETR_PREV], \
-                       "post_detr_prev":mean_prop_by_class[..., POST_DETR_PREV], \
-                       "cloud":mean_prop_by_class[..., CLOUD], \
-                       "entr_bot":mean_prop_by_class[..., ENTR_FROM_BL], \
-                       "entr":mean_prop_by_class[..., ENTR_FROM_ABOVE_BL], \
-                       "detr":mean_prop_by_class[..., DETRAINED], \
-                       "post_detr":mean_prop_by_class[..., DETRAINED], \
-                       "subsequent_cloud":mean_prop_by_class[..., SUBSEQUENT_CLOUD], \
-                       "cloud_properties":cloud_prop, \
-                       "budget_loss":budget_loss, \
-                       "entrainment":entrainment, \
-                       "max_cloud_base_area":max_cloud_base_area, \
-                       "max_cloud_base_time":max_cloud_base_time, \
-                       "cloud_base_variables":cloud_base_variables, \
-                       "derived_variable_list":derived_variable_list, \
-                       }
-
-    return mean_properties
-            
-def trajectory_cloud_ref(dataset, time_index, thresh=0.00001) :
+def trajectory_cloud_ref(dataset, time_index, thresh=0.00001, \
+                         config=default_config) :
     """
     Function to set up origin of back and forward trajectories.
 
@@ -2928,6 +4682,7 @@ def trajectory_cloud_ref(dataset, time_index, thresh=0.00001) :
         dataset        : Netcdf file handle.
         time_index     : Index of required time in file.
         thresh=0.00001 : Cloud liquid water threshold for clouds.
+        config=default_config : Traj_Config settings used in labelling.
 
     Returns: 
         Trajectory variables::
@@ -2956,8 +4711,8 @@ def trajectory_cloud_ref(dataset, time_index, thresh=0.00001) :
     mask = np.zeros_like(data)
     mask[logical_pos] = 1
 
-    print('Setting labels.')
-    labels, nobjects = label_3D_cyclic(mask)
+    objects_logger.debug('Setting labels.')
+    labels, nobjects = label_3D_cyclic(mask, config=config)
     
     labels = labels[logical_pos]
     
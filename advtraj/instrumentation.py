@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-level timing and counters for the trajectory pipeline.
+
+Stages of the pipeline (file reads, interpolation, solver iterations,
+labelling, unsplitting, box statistics and family matching) are wrapped
+in named spans. When instrumentation is enabled each span writes one
+JSON record per call to a report file (JSON lines)::
+
+    {"span": "data_to_pos", "parent": "forward_solver", "pid": 1234,
+     "start": 1700000000.0, "wall": 0.012, "cpu": 0.011, "points": 120,
+     "fields": 9}
+
+Counters recorded include bytes read, points processed and iteration
+counts. Usage::
+
+    from advtraj.instrumentation import enable_instrumentation, \\
+                                        summarize_instrumentation
+    enable_instrumentation("report.jsonl")
+    ... compute trajectories ...
+    summarize_instrumentation("report.jsonl")
+
+or set the environment variable ADVTRAJ_INSTRUMENTATION to the report
+file name. Worker processes (Trajectory_Family, Point_Parallel,
+Tile_Decomposition, batch) append to the same file. A report is
+summarised by::
+
+    python -m advtraj.instrumentation report.jsonl
+
+When disabled (the default), span returns a shared null span, so the cost
+is one function call per stage.
+
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+env_variable = "ADVTRAJ_INSTRUMENTATION"
+
+_filename = None
+_file = None
+_pid = None
+# Names of open spans in each thread (as _local.stack).
+_local = threading.local()
+# Serialises writes to the report file from threads.
+_lock = threading.Lock()
+
+def _stack() :
+    stack = getattr(_local, "stack", None)
+    if stack is None :
+        stack = _local.stack = list([])
+    return stack
+
+class Span :
+    """
+    Class timing one call of a stage and recording counters. Use as a
+    context manager, or call start and stop (in the same thread). The
+    parent is the innermost span open in the same thread.
+
+    Args:
+        name     : name of stage.
+        counters : initial counters (or labels) to record.
+
+    """
+
+    __slots__ = ("name", "counters", "parent", "_depth", "_start", "_wall", \
+                 "_cpu")
+
+    def __init__(self, name, counters) :
+        self.name = name
+        self.counters = counters
+        self.parent = None
+
+    def __bool__(self) :
+        return True
+
+    def start(self) :
+        stack = _stack()
+        self.parent = stack[-1] if len(stack) > 0 else None
+        self._depth = len(stack)
+        stack.append(self.name)
+        self._start = time.time()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def add(self, **counters) :
+        """
+        Method to add to counters.
+
+        """
+
+        for k, v in counters.items() :
+            self.counters[k] = self.counters.get(k, 0) + v
+        return
+
+    def stop(self, **counters) :
+        """
+        Method to end the span, adding counters, and write its record.
+
+        """
+
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        # Also drops spans opened inside this one and not stopped.
+        del _stack()[self._depth:]
+        self.add(**counters)
+        record = {"span" : self.name, "parent" : self.parent, \
+                  "pid" : os.getpid(), "start" : self._start, \
+                  "wall" : wall, "cpu" : cpu}
+        record.update(self.counters)
+        _write(record)
+        return
+
+    def __enter__(self) :
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        self.stop()
+        return False
+
+class _Null_Span :
+    # Span returned when instrumentation is disabled.
+    __slots__ = ()
+
+    def __bool__(self) :
+        return False
+
+    def start(self) :
+        return self
+
+    def add(self, **counters) :
+        return
+
+    def stop(self, **counters) :
+        return
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        return False
+
+_null_span = _Null_Span()
+
+def span(name, **counters) :
+    """
+    Function to create a span for a stage. Counters needing work to
+    compute should only be added if the span is true, e.g.::
+
+        with span("load_traj_step_data") as sp :
+            data = ...
+            if sp : sp.add(bytes=data.nbytes)
+
+    Args:
+        name       : name of stage.
+        **counters : initial counters (or labels).
+
+    Returns:
+        Span, or a null span (false, and recording nothing) if disabled.
+
+    """
+
+    if _filename is None : return _null_span
+    return Span(name, counters)
+
+def start_span(name, **counters) :
+    """
+    Function to create and start a span; call stop on the result.
+
+    """
+
+    return span(name, **counters).start()
+
+def instrumentation_enabled() :
+    return _filename is not None
+
+def enable_instrumentation(filename) :
+    """
+    Function to write span records to filename (appending). The setting
+    is also passed to worker processes through the environment.
+
+    Args:
+        filename : name of report file (JSON lines).
+
+    """
+
+    global _filename
+    disable_instrumentation()
+    _filename = os.path.abspath(filename)
+    os.environ[env_variable] = _filename
+    return
+
+def disable_instrumentation() :
+    """
+    Function to stop recording spans and close the report file.
+
+    """
+
+    global _filename, _file, _pid
+    if _file is not None and _pid == os.getpid() : _file.close()
+    _filename = None
+    _file = None
+    _pid = None
+    os.environ.pop(env_variable, None)
+    return
+
+def _write(record) :
+    global _file, _pid
+    line = json.dumps(record, default=_json_default) + "\n"
+    with _lock :
+        # Forked worker processes open the file for themselves.
+        if _file is None or _pid != os.getpid() :
+            _file = open(_filename, "a", buffering=1)
+            _pid = os.getpid()
+        # One write per line, so records from processes do not interleave.
+        _file.write(line)
+    return
+
+def _json_default(v) :
+    # numpy scalars.
+    return v.item() if hasattr(v, "item") else str(v)
+
+def read_instrumentation(filename) :
+    """
+    Function to read span records.
+
+    Returns:
+        List of dicts.
+
+    """
+
+    with open(filename) as f :
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize_instrumentation(filename) :
+    """
+    Function to total span records by stage.
+
+    Args:
+        filename : name of report file.
+
+    Returns:
+        dict mapping span name to dict of "calls", "wall", "cpu" and the
+        totals (or maxima, for counters named max_...) of numeric counters.
+
+    """
+
+    summary = dict()
+    for record in read_instrumentation(filename) :
+        total = summary.setdefault(record["span"], {"calls" : 0})
+        total["calls"] += 1
+        for k, v in record.items() :
+            if k in ("span", "parent", "pid", "start") : continue
+            if isinstance(v, (int, float)) and not isinstance(v, bool) :
+                # Counters named max_... are maxima, others are summed.
+                if k.startswith("max_") :
+                    total[k] = max(total.get(k, v), v)
+                else :
+                    total[k] = total.get(k, 0) + v
+    return summary
+
+def main(argv=None) :
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 :
+        print("Usage: python -m advtraj.instrumentation report.jsonl")
+        return 2
+    summary = summarize_instrumentation(argv[0])
+    for name, total in sorted(summary.items(), \
+                              key=lambda item: -item[1].get("wall", 0)) :
+        counters = " ".join("{}={:g}".format(k, v) for k, v in \
+                            total.items() if k not in ("calls", "wall", "cpu"))
+        print("{:24s} calls={:<8d} wall={:10.3f}s cpu={:10.3f}s {}".format( \
+              name, total["calls"], total["wall"], total["cpu"], counters))
+    return 0
+
+if env_variable in os.environ :
+    _filename = os.environ[env_variable]
+
+if __name__ == "__main__" :
+    raise SystemExit(main())
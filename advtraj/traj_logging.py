@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Logging for the trajectory code.
+
+Output goes through the logging module, to one logger per subsystem::
+
+    advtraj.solver       : trajectory computation and solver.
+    advtraj.solver.stats : solver convergence records (DEBUG), with
+                           record.stats a dict of niter, err, points, time.
+    advtraj.io           : finding times in files, reading and writing.
+    advtraj.objects      : labelling and unsplitting objects.
+    advtraj.family       : trajectory families and object matching.
+    advtraj.analysis     : cloud classification, properties, statistics.
+    advtraj.batch        : batch runs.
+
+Nothing is shown below WARNING until logging is configured, e.g.::
+
+    from advtraj.traj_logging import configure_logging
+    configure_logging("INFO", progress_interval=30.0,
+                      solver_stats="solver_stats.jsonl")
+
+Messages use logging's deferred %-formatting, so messages below the
+configured level are not formatted. Per-step progress messages (see
+log_progress) are rate-limited by the handlers set up by
+configure_logging.
+
+"""
+import json
+import logging
+import sys
+import time
+
+solver_logger = logging.getLogger("advtraj.solver")
+solver_stats_logger = logging.getLogger("advtraj.solver.stats")
+io_logger = logging.getLogger("advtraj.io")
+objects_logger = logging.getLogger("advtraj.objects")
+family_logger = logging.getLogger("advtraj.family")
+analysis_logger = logging.getLogger("advtraj.analysis")
+batch_logger = logging.getLogger("advtraj.batch")
+
+def log_progress(logger, msg, *args) :
+    """
+    Function to log a progress message at INFO level, marked so that
+    Rate_Limit_Filter passes at most one message with the same msg (and
+    logger) per interval.
+
+    """
+
+    if logger.isEnabledFor(logging.INFO) :
+        logger.info(msg, *args, extra={"progress" : True})
+    return
+
+class Rate_Limit_Filter(logging.Filter) :
+    """
+    Filter passing at most one progress record (see log_progress) with a
+    given logger and msg per interval. Other records are passed.
+
+    Args:
+        interval=10.0 : minimum time between progress records (s).
+
+    """
+
+    def __init__(self, interval=10.0) :
+        super().__init__()
+        self.interval = interval
+        self._last = dict()
+
+    def filter(self, record) :
+        if not getattr(record, "progress", False) : return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and now - last < self.interval : return False
+        self._last[key] = now
+        return True
+
+class Json_Formatter(logging.Formatter) :
+    """
+    Formatter writing each record as one line of JSON, with time,
+    logger, level and message, plus the items of record.stats if set.
+
+    """
+
+    def format(self, record) :
+        out = {"time" : record.created, "logger" : record.name, \
+               "level" : record.levelname, "message" : record.getMessage()}
+        stats = getattr(record, "stats", None)
+        if stats is not None : out.update(stats)
+        if record.exc_info :
+            out["exception"] = self.formatException(record.exc_info)
+        return json.dumps(out, default=_json_default)
+
+def _json_default(v) :
+    # numpy scalars and arrays.
+    return v.tolist() if hasattr(v, "tolist") else str(v)
+
+def configure_logging(level="INFO", stream=None, filename=None, \
+                      json_format=False, progress_interval=10.0, \
+                      solver_stats=None, levels=None) :
+    """
+    Function to set up handlers for the advtraj loggers. Previous
+    handlers set up by this function are replaced.
+
+    Args:
+        level="INFO"      : level for all advtraj loggers.
+        stream=None       : stream to write to. Default sys.stderr
+                            (unless filename is set).
+        filename=None     : file to write to (appending).
+        json_format=False : write records as JSON lines (Json_Formatter).
+        progress_interval=10.0 : minimum time between progress
+                            messages of each kind (s). 0 passes all.
+        solver_stats=None : file name (or stream) to which solver
+                            convergence records are written as JSON
+                            lines, whatever level is.
+        levels=None       : dict of levels for individual loggers, e.g.
+                            {"advtraj.family" : "DEBUG"}.
+
+    Returns:
+        The "advtraj" logger.
+
+    """
+
+    logger = reset_logging()
+    logger.setLevel(level)
+    if levels is not None :
+        for name, lev in levels.items() :
+            logging.getLogger(name).setLevel(lev)
+
+    if filename is not None :
+        handler = logging.FileHandler(filename)
+    else :
+        handler = logging.StreamHandler(sys.stderr if stream is None \
+                                        else stream)
+    if json_format :
+        handler.setFormatter(Json_Formatter())
+    else :
+        handler.setFormatter(logging.Formatter( \
+            "%(asctime)s %(name)s %(levelname)s %(message)s"))
+    if progress_interval > 0 :
+        handler.addFilter(Rate_Limit_Filter(progress_interval))
+    handler._advtraj = True
+    logger.addHandler(handler)
+
+    if solver_stats is not None :
+        if isinstance(solver_stats, str) :
+            stats_handler = logging.FileHandler(solver_stats)
+        else :
+            stats_handler = logging.StreamHandler(solver_stats)
+        stats_handler.setFormatter(Json_Formatter())
+        stats_handler._advtraj = True
+        solver_stats_logger.addHandler(stats_handler)
+        solver_stats_logger.setLevel(logging.DEBUG)
+        solver_stats_logger.propagate = False
+    return logger
+
+def reset_logging() :
+    """
+    Function to remove handlers set up by configure_logging and restore
+    the default levels.
+
+    Returns:
+        The "advtraj" logger.
+
+    """
+
+    logger = logging.getLogger("advtraj")
+    for log in (logger, solver_stats_logger) :
+        for handler in list(log.handlers) :
+            if getattr(handler, "_advtraj", False) :
+                log.removeHandler(handler)
+                handler.close()
+    logger.setLevel(logging.NOTSET)
+    solver_stats_logger.setLevel(logging.NOTSET)
+    solver_stats_logger.propagate = True
+    return logger
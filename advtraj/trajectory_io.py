@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar netCDF4 (HDF5) storage for Trajectories and Trajectory_Family.
+
+Each set of trajectories is stored in its own group (one per family member)
+with a variable per array, so a set can be read without reading the others
+and arrays can be read lazily. Point arrays are stored with points grouped
+by object and chunked by time and point, so reading one object's history
+touches only the chunks holding that object. Layout of a member group::
+
+    attributes : scalar attributes of Trajectories (ref, nobjects, deltax ...)
+                 plus JSON encoded variable_list, files, ref_func_kwargs and
+                 the module and name of ref_func and in_obj_func.
+    trajectory [time, point, xyz], traj_error [time, point, xyz],
+    data [time, point, variable] : point arrays (absent if point data were
+                 not kept).
+    labels [point], point_index [point] : object label and index in the
+                 original set of each stored point.
+    object_start [object+1] : stored points of object i are
+                 object_start[i]:object_start[i+1].
+    times, xcoord, ycoord, zcoord, rhoref, pref, thref, piref, max_at_ref,
+    data_mean, in_obj_data_mean, objvar_mean, num_in_obj, centroid,
+    in_obj_centroid, bounding_box, in_obj_box : as in Trajectories.
+    link_obj, link_mobj, link_pct : family links to the previous member
+                 (Family_Links.links).
+
+If saved with a position_resolution, trajectory and traj_error are stored 
+as compressed integers (see encode_positions) with attributes encoding 
+and resolution, and decoded on reading; trajectory_origin [point, xyz] 
+holds the quantized trajectory at the first time.
+
+"""
+import importlib
+import json
+import os
+
+from netCDF4 import Dataset
+import numpy as np
+
+from advtraj.compute_trajectories import Trajectories, Trajectory_Family, \
+                                         Family_Links, Traj_Config
+from advtraj.traj_logging import io_logger
+
+format_name = "advtraj_trajectories"
+format_version = 1
+
+member_group = "member_{:03d}"
+
+point_arrays = [ \
+                ("trajectory", ("time", "point", "xyz")), \
+                ("traj_error", ("time", "point", "xyz")), \
+                ("data", ("time", "point", "variable")), \
+               ]
+
+other_arrays = [ \
+                ("times", ("time",)), \
+                ("xcoord", ("x",)), \
+                ("ycoord", ("y",)), \
+                ("zcoord", ("z",)), \
+                ("rhoref", ("ref_level",)), \
+                ("pref", ("ref_level",)), \
+                ("thref", ("ref_level",)), \
+                ("piref", ("ref_level",)), \
+                ("max_at_ref", ("max_at_ref",)), \
+                ("data_mean", ("time", "object", "variable")), \
+                ("in_obj_data_mean", ("time", "object", "variable")), \
+                ("objvar_mean", ("time", "object")), \
+                ("num_in_obj", ("time", "object")), \
+                ("centroid", ("time", "object", "xyz")), \
+                ("in_obj_centroid", ("time", "object", "xyz")), \
+                ("bounding_box", ("time", "object", "corner", "xyz")), \
+                ("in_obj_box", ("time", "object", "corner", "xyz")), \
+               ]
+
+scalar_attributes = ["ref", "end", "ntimes", "npoints", "nobjects", \
+                     "deltax", "deltay", "deltaz", "deltat", "nx", "ny", "nz"]
+
+_open_datasets = dict()
+
+def _dataset(filename) :
+    # Files are opened once for reading and shared by all Lazy_Arrays.
+    if filename not in _open_datasets or \
+        not _open_datasets[filename].isopen() :
+        _open_datasets[filename] = Dataset(filename, "r")
+    return _open_datasets[filename]
+
+def _close(filename) :
+    # A file open for lazy reading must be closed before it is rewritten.
+    dataset = _open_datasets.pop(filename, None)
+    if dataset is not None and dataset.isopen() : dataset.close()
+    return
+
+def close_files() :
+    """
+    Function to close all files opened for lazy reading.
+
+    """
+
+    for filename in list(_open_datasets) :
+        _close(filename)
+    return
+
+def write_atomic(filename, write, suffix=".tmp") :
+    """
+    Function to write a file under a temporary name then rename it, so 
+    that filename exists only when complete and an existing file is only 
+    replaced by a complete one.
+
+    Args:
+        filename      : name of file.
+        write         : function called with the temporary name to write 
+                        the file.
+        suffix=".tmp" : added to filename to give the temporary name 
+                        (e.g. ".tmp.npz" for numpy.savez).
+
+    Returns:
+        Nothing
+
+    """
+
+    tmp = filename + suffix
+    try :
+        write(tmp)
+    except BaseException :
+        if os.path.exists(tmp) : os.remove(tmp)
+        raise
+    _close(filename)
+    os.replace(tmp, filename)
+    return
+
+def _as_slice(index) :
+    # Contiguous integer or boolean indices are read as a slice.
+    index = np.asarray(index)
+    if index.dtype == bool :
+        index = np.flatnonzero(index)
+    if index.ndim == 1 and np.size(index) > 0 and \
+        np.all(np.diff(index) == 1) :
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+class Lazy_Array :
+    """
+    Class giving read-only array access to a netCDF4 variable, which is
+    read only when indexed (or converted with np.asarray).
+
+    Args:
+        filename : file containing variable.
+        group    : path of group containing variable.
+        name     : variable name.
+
+    Attributes:
+        shape, dtype, ndim, size: as for numpy arrays.
+
+    """
+
+    def __init__(self, filename, group, name) :
+        self.filename = filename
+        self.group = group
+        self.name = name
+        var = self._variable()
+        self.shape = tuple(var.shape)
+        self.dtype = var.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    def _variable(self) :
+        ds = _dataset(self.filename)
+        if self.group != "/" : ds = ds[self.group]
+        var = ds.variables[self.name]
+        var.set_auto_mask(False)
+        return var
+
+    def __len__(self) :
+        return self.shape[0]
+
+    def __getitem__(self, key) :
+        if not isinstance(key, tuple) : key = (key,)
+        key = tuple(_as_slice(k) if isinstance(k, (list, np.ndarray)) \
+                    else k for k in key)
+        return np.asarray(self._variable()[key])
+
+    def __array__(self, dtype=None, copy=None) :
+        data = self[...]
+        if dtype is not None : data = data.astype(dtype)
+        return data
+
+    def __repr__(self) :
+        return "Lazy_Array({}:{}/{}, shape={}, dtype={})".format(\
+          self.filename, self.group, self.name, self.shape, self.dtype)
+
+def _smallest_int(q) :
+    for dtype in [np.int8, np.int16, np.int32] :
+        info = np.iinfo(dtype)
+        if np.size(q) == 0 or \
+            (np.min(q) >= info.min and np.max(q) <= info.max) :
+            return q.astype(dtype)
+    raise ValueError("Encoded positions too large for int32.")
+
+def encode_positions(pos, resolution, delta=True) :
+    """
+    Function to quantize positions (in grid boxes) to multiples of 
+    resolution and (optionally) difference them along time (axis 0). 
+    Positions change smoothly in time, so the differences are small 
+    integers which are stored in the smallest integer type that holds 
+    them and compress well.
+    
+    The reconstruction error of decode_positions is at most resolution/2 
+    in each component, at all times; quantization is done before 
+    differencing so errors do not accumulate along the trajectory. 
+
+    Args:
+        pos          : Array [nt, m, ...] of positions.
+        resolution   : quantization step as a fraction of a grid box.
+        delta=True   : If True, difference along time.
+
+    Returns:
+        origin, q : origin is int32 array [m, ...] of quantized positions at 
+        time 0 (None if delta is False), q integer array [nt, m, ...] of 
+        differences from the previous time (zero at time 0) or quantized 
+        positions.
+
+    """
+
+    q = np.rint(np.asarray(pos) / resolution)
+    origin = None
+    if delta :
+        origin = _smallest_int(q[0, ...]).astype(np.int32)
+        q = np.diff(q, axis=0, prepend=q[0:1, ...])
+    return origin, _smallest_int(q)
+
+def decode_positions(q, resolution, origin=None) :
+    """
+    Function to decode positions encoded with encode_positions.
+
+    Args:
+        q            : Integer array [nt, m, ...], all times if origin given.
+        resolution   : quantization step.
+        origin=None  : origin from encode_positions if delta encoded.
+
+    Returns:
+        Array [nt, m, ...] of positions.
+
+    """
+
+    q = np.asarray(q, dtype=np.int64)
+    if origin is not None : 
+        q = np.cumsum(q, axis=0) + np.asarray(origin, dtype=np.int64)
+    return q * resolution
+
+class Encoded_Array(Lazy_Array) :
+    """
+    Class as Lazy_Array for a variable encoded with encode_positions. 
+    Indexing reads all times for the points selected (contiguous for an 
+    object) and decodes them as a block.
+
+    """
+
+    def __init__(self, filename, group, name) :
+        Lazy_Array.__init__(self, filename, group, name)
+        var = self._variable()
+        self.resolution = var.getncattr("resolution")
+        self.delta = var.getncattr("encoding") == "delta"
+        self.dtype = np.dtype(np.float64)
+
+    def __getitem__(self, key) :
+        if not isinstance(key, tuple) : key = (key,)
+        if any(k is Ellipsis for k in key) :
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + \
+                  key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        key = (key[0],) + tuple(_as_slice(k) \
+            if isinstance(k, (list, np.ndarray)) else k for k in key[1:])
+        if not self.delta :
+            return decode_positions(self._variable()[key], self.resolution)
+        var = self._variable()
+        ds = var.group()
+        origin = ds.variables[self.name+"_origin"]
+        origin.set_auto_mask(False)
+        data = decode_positions(var[(slice(None),) + key[1:]], \
+                                self.resolution, origin=origin[key[1:]])
+        return data[key[0]]
+
+def _json_default(v) :
+    # numpy scalars and arrays in kwargs.
+    return np.asarray(v).tolist()
+
+def _function_name(func) :
+    if func is None : return ""
+    return "{}:{}".format(func.__module__, func.__qualname__)
+
+def _function_from_name(name) :
+    # Returns None if the function can no longer be imported.
+    if name == "" : return None
+    module, qualname = name.split(":")
+    try :
+        func = importlib.import_module(module)
+        for part in qualname.split(".") :
+            func = getattr(func, part)
+    except (ImportError, AttributeError) :
+        io_logger.warning("Cannot import function %s", name)
+        func = None
+    return func
+
+def _chunks(dims, shape, chunk_times, chunk_points) :
+    chunks = list(shape)
+    for i, d in enumerate(dims) :
+        if d == "time" and chunk_times is not None :
+            chunks[i] = max(1, min(chunk_times, shape[i]))
+        if d == "point" :
+            chunks[i] = max(1, min(chunk_points, shape[i]))
+    return chunks
+
+def save_trajectories(traj, filename, group=None, links=None, \
+                      chunk_times=None, chunk_points=4096, compress=False, \
+                      point_data=True, position_resolution=None) :
+    """
+    Function to save a Trajectories object to a netCDF4 file.
+
+    Args:
+        traj              : Trajectories object.
+        filename          : name of file or open netCDF4 Dataset (or group).
+        group=None        : name of group to write to. Default is root
+                            (or the Dataset given).
+        links=None        : (obj, mobj, pct) family links to store.
+        chunk_times=None  : chunk length in time for point arrays.
+                            Default is all times.
+        chunk_points=4096 : chunk length in points for point arrays.
+        compress=False    : Use zlib compression.
+        point_data=True   : If False, point arrays are not written.
+        position_resolution=None : If set, trajectory and traj_error are 
+                            quantized to this fraction of a grid box 
+                            (trajectory delta encoded in time, see 
+                            encode_positions) and compressed. 
+                            Reconstruction error is at most 
+                            position_resolution/2 grid boxes.
+
+    Returns:
+        Nothing
+
+    """
+
+    if isinstance(filename, str) :
+        _close(filename)
+        dataset = Dataset(filename, "w", format="NETCDF4")
+        dataset.setncattr("format", format_name)
+        dataset.setncattr("format_version", format_version)
+    else :
+        dataset = filename
+    ds = dataset if group is None else dataset.createGroup(group)
+
+    for a in scalar_attributes :
+        ds.setncattr(a, getattr(traj, a))
+    ds.setncattr("variable_list", json.dumps(list(traj.variable_list.items())))
+    ds.setncattr("files", json.dumps(list(traj.files)))
+    ds.setncattr("ref_func_kwargs", json.dumps(traj.ref_func_kwargs, \
+                                               default=_json_default))
+    ds.setncattr("config", json.dumps(traj.config._asdict()))
+    ds.setncattr("ref_func", _function_name(traj.ref_func))
+    ds.setncattr("in_obj_func", _function_name(traj.in_obj_func))
+    keep_point_data = traj.trajectory is not None
+    ds.setncattr("keep_point_data", int(keep_point_data))
+
+    labels = np.asarray(traj.labels)
+    order = np.argsort(labels, kind='stable')
+    object_start = np.searchsorted(labels[order], np.arange(traj.nobjects+1))
+
+    arrays = [(name, dims, getattr(traj, name)) for name, dims in other_arrays]
+    point_index = getattr(traj, "point_index", np.arange(np.size(labels)))
+    arrays += [("labels", ("point",), labels[order]), \
+               ("point_index", ("point",), point_index[order]), \
+               ("object_start", ("object_edge",), object_start)]
+    if keep_point_data and point_data :
+        arrays += [(name, dims, np.asarray(getattr(traj, name))[:, order, ...]) \
+                   for name, dims in point_arrays]
+    if links is not None :
+        for name, v in zip(["link_obj", "link_mobj", "link_pct"], links) :
+            arrays.append((name, ("link",), v))
+
+    for name, dims, v in arrays :
+        v = np.asarray(v)
+        encoding = None
+        if position_resolution is not None and \
+            name in ["trajectory", "traj_error"] :
+            encoding = "delta" if name == "trajectory" else "quantized"
+            origin, v = encode_positions(v, position_resolution, \
+                                         delta=(encoding == "delta"))
+        for d, n in zip(dims, np.shape(v)) :
+            if d not in ds.dimensions : ds.createDimension(d, n)
+        if encoding == "delta" :
+            var = ds.createVariable(name+"_origin", origin.dtype, \
+                                    dims[1:], zlib=True)
+            var[...] = origin
+        chunks = None
+        if (name, dims) in point_arrays and v.size > 0 :
+            chunks = _chunks(dims, np.shape(v), chunk_times, chunk_points)
+        var = ds.createVariable(name, v.dtype, dims, \
+                                zlib=compress or encoding is not None, \
+                                chunksizes=chunks)
+        if encoding is not None :
+            var.setncattr("encoding", encoding)
+            var.setncattr("resolution", position_resolution)
+        var[...] = v
+
+    if isinstance(filename, str) : dataset.close()
+    return
+
+def load_trajectories(filename, group=None, lazy=True) :
+    """
+    Function to load a Trajectories object saved by save_trajectories.
+    Points are in the stored order, grouped by object; point_index gives
+    the index of each point in the original set.
+
+    Args:
+        filename   : name of file.
+        group=None : path of group to read. Default is root.
+        lazy=True  : If True, point arrays (trajectory, data, traj_error)
+                     are Lazy_Array objects read only when indexed.
+                     Otherwise all arrays are read and the file closed.
+
+    Returns:
+        Trajectories object.
+
+    """
+
+    dataset = _dataset(filename)
+    ds = dataset if group is None else dataset[group]
+    path = "/" if group is None else group
+
+    traj = Trajectories.__new__(Trajectories)
+    for a in scalar_attributes :
+        setattr(traj, a, ds.getncattr(a))
+    traj.variable_list = dict(json.loads(ds.getncattr("variable_list")))
+    traj.files = json.loads(ds.getncattr("files"))
+    traj.ref_func_kwargs = json.loads(ds.getncattr("ref_func_kwargs"))
+    if "config" in ds.ncattrs() :
+        traj.config = Traj_Config(**json.loads(ds.getncattr("config")))
+    traj.ref_func = _function_from_name(ds.getncattr("ref_func"))
+    traj.in_obj_func = _function_from_name(ds.getncattr("in_obj_func"))
+
+    for name in [n for n, d in other_arrays] + \
+                ["labels", "point_index", "object_start"] :
+        var = ds.variables[name]
+        var.set_auto_mask(False)
+        setattr(traj, name, np.asarray(var[...]))
+
+    for name, dims in point_arrays :
+        if name not in ds.variables :
+            setattr(traj, name, None)
+            continue
+        if "encoding" in ds.variables[name].ncattrs() :
+            array = Encoded_Array(filename, path, name)
+        else :
+            array = Lazy_Array(filename, path, name)
+        setattr(traj, name, array if lazy else array[...])
+    if not lazy : _close(filename)
+    return traj
+
+mapped_metadata_file = "trajectories.nc"
+
+def save_mapped_trajectories(traj, directory, max_points=2**20) :
+    """
+    Function to save a Trajectories object as an uncompressed layout for 
+    Mapped_Trajectories. Point arrays are written to directory as .npy 
+    files [point, time, ...] with points grouped by object, so each 
+    object's history is contiguous on disk; other attributes are written 
+    to a netCDF4 file as save_trajectories. Point data are copied in 
+    blocks of objects so the source need not fit in memory.
+
+    Args:
+        traj             : Trajectories object.
+        directory        : directory to write to (created if need be).
+        max_points=2**20 : maximum number of points copied at once.
+
+    Returns:
+        Nothing
+
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    save_trajectories(traj, os.path.join(directory, mapped_metadata_file), \
+                      point_data=False)
+    if traj.trajectory is None : return
+    order = np.argsort(np.asarray(traj.labels), kind='stable')
+    for name, dims in point_arrays :
+        v = getattr(traj, name)
+        shape = (np.shape(v)[1], np.shape(v)[0]) + tuple(np.shape(v)[2:])
+        out = np.lib.format.open_memmap(os.path.join(directory, name+".npy"), \
+                                        mode="w+", dtype=v.dtype, shape=shape)
+        for start in range(0, np.size(order), max_points) :
+            points = order[start:start+max_points]
+            # Read source points in increasing order.
+            srt = np.argsort(points)
+            block = np.asarray(v[:, points[srt], ...])
+            out[start + srt, ...] = np.swapaxes(block, 0, 1)
+        out.flush()
+        del out
+    return
+
+class Mapped_Trajectories(Trajectories) :
+    """
+    Class giving read-only access to Trajectories saved by 
+    save_mapped_trajectories, with point arrays (trajectory, data, 
+    traj_error) memory-mapped from disk. These are [nt, m, ...] views, 
+    so can be used as in-memory arrays; only the parts used are read.
+    Points are grouped by object, so object_blocks and select_objects 
+    read contiguous regions of each file.
+
+    Args:
+        directory : directory written by save_mapped_trajectories.
+
+    Attributes:
+        As Trajectories, plus:
+        directory    : directory holding the files.
+        point_index  : index of each point in the original set.
+        object_start : points of object i are 
+                       object_start[i]:object_start[i+1].
+
+    """
+
+    def __init__(self, directory) :
+        traj = load_trajectories(os.path.join(directory, mapped_metadata_file))
+        self.__dict__.update(traj.__dict__)
+        self.directory = directory
+        self._map_point_arrays()
+
+    def _map_point_arrays(self) :
+        for name, dims in point_arrays :
+            filename = os.path.join(self.directory, name+".npy")
+            if os.path.isfile(filename) :
+                setattr(self, name, \
+                        np.swapaxes(np.load(filename, mmap_mode="r"), 0, 1))
+            else :
+                setattr(self, name, None)
+        return
+
+    def select_object(self, iobj) :
+        points = slice(self.object_start[iobj], self.object_start[iobj+1])
+        return self.trajectory[:, points, ...], self.data[:, points, ...]
+
+    def __getstate__(self) :
+        # Maps are reopened when unpickled.
+        state = Trajectories.__getstate__(self)
+        for name, dims in point_arrays :
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self._map_point_arrays()
+
+def save_trajectory_family(family, filename, chunk_times=None, \
+                           chunk_points=4096, compress=False, \
+                           position_resolution=None) :
+    """
+    Function to save a Trajectory_Family to a netCDF4 file with a group
+    per member.
+
+    Args:
+        family            : Trajectory_Family.
+        filename          : name of file.
+        chunk_times, chunk_points, compress, position_resolution : 
+                            see save_trajectories.
+
+    Returns:
+        Nothing
+
+    """
+
+    links = getattr(family, "links", None)
+    if links is not None and links.nmembers != len(family.family) :
+        links = None
+    _close(filename)
+    dataset = Dataset(filename, "w", format="NETCDF4")
+    dataset.setncattr("format", format_name)
+    dataset.setncattr("format_version", format_version)
+    dataset.setncattr("nmembers", len(family.family))
+    if links is not None :
+        dataset.setncattr("overlap_thresh", links.overlap_thresh)
+    for member, traj in enumerate(family.family) :
+        save_trajectories(traj, dataset, group=member_group.format(member), \
+                          links=None if links is None else links.links[member], \
+                          chunk_times=chunk_times, chunk_points=chunk_points, \
+                          compress=compress, \
+                          position_resolution=position_resolution)
+    dataset.close()
+    return
+
+def load_trajectory_family(filename, lazy=True) :
+    """
+    Function to load a Trajectory_Family saved by save_trajectory_family.
+    Stored family links are restored without recomputing overlaps.
+
+    Args:
+        filename  : name of file.
+        lazy=True : see load_trajectories.
+
+    Returns:
+        Trajectory_Family.
+
+    """
+
+    dataset = _dataset(filename)
+    family = Trajectory_Family.__new__(Trajectory_Family)
+    family.family = [load_trajectories(filename, \
+                                       group=member_group.format(member), \
+                                       lazy=lazy) \
+                     for member in range(dataset.getncattr("nmembers"))]
+    family.links = None
+    if "overlap_thresh" in dataset.ncattrs() :
+        family.links = Family_Links(dataset.getncattr("overlap_thresh"))
+        for member in range(len(family.family)) :
+            ds = dataset[member_group.format(member)]
+            links = tuple(np.asarray(ds.variables[name][...]) for name in \
+                          ["link_obj", "link_mobj", "link_pct"])
+            family.links.add_member(family, member, links=links)
+    return family
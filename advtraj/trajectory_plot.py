@@ -13,7 +13,7 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import animation
 from trajectory_compute import file_key
 
-from compute_trajectories import find_time_in_files
+from compute_trajectories import find_time_in_files, cloud_class_key
 
 
 
@@ -48,9 +48,10 @@ def plot_trajectory_history(tr, select_obj, fn) :
 #    fig.clf
     traj = tr.trajectory[:,mask,:]
     data = tr.data[:,mask,:]
+    thl = tr.variable("th_L")[:,mask]
+    qt = tr.variable("q_total")[:,mask]
           
     z = (traj[:,:,2]-0.5)*tr.deltaz
-    zn = (np.arange(0,np.size(tr.piref))-0.5)*tr.deltaz
     
     times = tr.times/3600.0
 #    print np.shape(z)
@@ -73,22 +74,14 @@ def plot_trajectory_history(tr, select_obj, fn) :
 
     ax = axa[2,0]
     for i in range(np.shape(z)[1]-1) :
-        piref_z = np.interp(z[:,i],zn,tr.piref)
-#        print piref_z
-        thl = data[:,i,tr.var("th")] - \
-              L_over_cp*data[:,i,tr.var("q_cloud_liquid_mass")]/piref_z
-#        print thl, data[:,var("th"),i],data[:,var("q_vapour"),i]
-        ax.plot(thl,z[:,i])
+        ax.plot(thl[:,i],z[:,i])
     ax.set_xlabel(r"$\theta_L$ K",fontsize=16)
     ax.set_ylabel(r"$z$ m",fontsize=16)
     ax.set_title('Cloud %2.2d'%select_obj)
     
     ax = axa[2,1]
     for i in range(np.shape(z)[1]-1) :
-        qt = data[:,i,tr.var("q_vapour")] + \
-             data[:,i,tr.var("q_cloud_liquid_mass")]
-#        print qt,data[:,var("q_vapour"),i],data[:,var("q_cloud_liquid_mass"),i]
-        ax.plot( qt,z[:,i])
+        ax.plot( qt[:,i],z[:,i])
 #    ax.set_xlabel(r"$q_t$ kg/kg",fontsize=16)
     ax.set_ylabel(r"$z$ m",fontsize=16)
     ax.set_title('Cloud %2.2d'%select_obj)
@@ -110,12 +103,7 @@ def plot_trajectory_history(tr, select_obj, fn) :
 
     ax = axa[2,0]
     for i in range(np.shape(z)[1]-1) :
-        piref_z = np.interp(z[:,i],zn,tr.piref)
-#        print piref_z
-        thl = data[:,i,tr.var("th")] - \
-              L_over_cp*data[:,i,tr.var("q_cloud_liquid_mass")]/piref_z
-#        print thl, data[:,var("th"),i],data[:,var("q_vapour"),i]
-        ax.plot(times,thl)
+        ax.plot(times,thl[:,i])
     ax.plot(times[tr.ref]*np.ones(2),ax.get_ylim(),'--k')
     ax.set_ylabel(r"$\theta_L$ K",fontsize=16)
     ax.set_xlabel(r"time h$^{-1}$",fontsize=16)
@@ -123,10 +111,7 @@ def plot_trajectory_history(tr, select_obj, fn) :
     
     ax = axa[2,1]
     for i in range(np.shape(z)[1]-1) :
-        qt = data[:,i,tr.var("q_vapour")] + \
-             data[:,i,tr.var("q_cloud_liquid_mass")]
-#        print qt,data[:,var("q_vapour"),i],data[:,var("q_cloud_liquid_mass"),i]
-        ax.plot( times, qt)
+        ax.plot( times, qt[:,i])
     ax.plot(times[tr.ref]*np.ones(2),ax.get_ylim(),'--k')
     ax.set_ylabel(r"$q_t$ kg/kg",fontsize=16)
     ax.set_xlabel(r"time h$^{-1}$",fontsize=16)
@@ -592,21 +577,7 @@ def plot_traj_animation(traj, save_anim=False, anim_name='traj_anim', \
 #    print(files)
     if select is None : select = np.arange(0, nobj)
     if plot_class is not None :
-        if plot_class["version"] == 1 :
-            class_key = list([\
-                ["Not set", "lightgray"] , \
-                ["PRE_CLOUD_ENTR_FROM_BL","red"], \
-                ["PRE_CLOUD_ENTR_FROM_ABOVE_BL","green"], \
-                ["PREVIOUS_CLOUD","blue"], \
-                ["DETR_PREV","lightblue"], \
-                ["POST_DETR_PREV","cyan"], \
-                ["CLOUD","black"], \
-                ["ENTRAINED_FROM_BL","orange"], \
-                ["ENTRAINED_FROM_ABOVE_BL","lightgreen"], \
-                ["DETRAINED","magenta"], \
-                ["POST_DETR","pink"], \
-                ["SUBS_CLOUD","darkgray"], \
-                ])
+        class_key = cloud_class_key(plot_class)
 
 #    print(select)
     #input("Press any key...")
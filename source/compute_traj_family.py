@@ -2,14 +2,19 @@ import glob
 import os
 import os.path
 import numpy as np
-import pickle as pickle
 
 from trajectory_compute import *
+from advtraj.trajectory_io import save_trajectory_family, \
+                                   load_trajectory_family
+from advtraj.traj_logging import configure_logging
+
+# Progress output at most once a minute; use "DEBUG" for per-step detail.
+configure_logging("INFO", progress_interval=60.0)
 
 dn = 5
 #dir = 'C:/Users/paclk/OneDrive - University of Reading/traj_data/r{:02d}/'.format(dn)
 dir = '/storage/silver/wxproc/xm904103/traj/BOMEX/r6n/'
-#   Set to True to calculate trajectory family,False to read pre-calculated from pickle file.
+#   Set to True to calculate trajectory family,False to read pre-calculated from family file.
 #get_traj = False
 get_traj = True
     
@@ -21,7 +26,7 @@ def main():
     Top level code, a bit of a mess.
     This computes families of trajectories from files in directory dir.
     Current setup is back 40 min, forward 30 min from reference times every minute. 
-    Trajectories are calculated with reference times from 3h in to 23h 59 min - each hour's family is picked in a separate pickle file
+    Trajectories are calculated with reference times from 3h in to 23h 59 min - each hour's family is saved in a separate family file
     '''
 
     ref_prof_file = glob.glob(dir+'diagnostics_ts_*.nc')[0]
@@ -40,8 +45,8 @@ def main():
                 'quintic', \
                 ] 
 
-    interp_order = 1
-    iorder = '_'+order_labs[interp_order-1]
+    traj_config = Traj_Config(interp_order = 1)
+    iorder = '_'+order_labs[traj_config.interp_order-1]
     fn = os.path.basename(files[0])[:-3]
     fn = ''.join(fn)+iorder
     fn = dir + fn
@@ -62,7 +67,7 @@ def main():
 
         first_ref_min = hh*60
         last_ref_min = first_ref_min + 59
-        pickle_file = 'traj_family_{:03d}_{:03d}_{:03d}_{:03d}_v2'.\
+        family_file = 'traj_family_{:03d}_{:03d}_{:03d}_{:03d}_v2.nc'.\
             format(first_ref_min ,last_ref_min, tr_back_len_min, tr_forward_len_min)
         dt = 60
         
@@ -73,24 +78,24 @@ def main():
         ref = 30
             
         if get_traj :
+            # Completed members are kept here so a restart skips them.
+            checkpoint_dir = dir + family_file[:-3] + '_members/'
             tfm = Trajectory_Family(files, ref_prof_file, \
                      first_ref_time, last_ref_time, \
                      tr_back_len, tr_forward_len, \
                      dx, dy, dz, trajectory_cloud_ref, in_cloud, \
-                     kwargs=kwa, variable_list=var_list)
-            outfile = open(dir+pickle_file,'wb')
-            print('Pickling ',dir+pickle_file)
-            pickle.dump(tfm, outfile)
-            outfile.close()
+                     kwargs=kwa, variable_list=var_list, \
+                     config=traj_config, checkpoint_dir=checkpoint_dir, \
+                     checkpoint_interval=10)
+            print('Saving ',dir+family_file)
+            save_trajectory_family(tfm, dir+family_file)
         else :
-            if os.path.isfile(dir+pickle_file) : 
-                infile = open(dir+pickle_file,'rb')
-                print('Un-pickling ',dir+pickle_file)
-                tfm = pickle.load(infile)
+            if os.path.isfile(dir+family_file) : 
+                print('Loading ',dir+family_file)
+                tfm = load_trajectory_family(dir+family_file)
     #                print(tfm)
-                infile.close()
             else :
-                print("File not found: ",dir+pickle_file)
+                print("File not found: ",dir+family_file)
                 
 
     
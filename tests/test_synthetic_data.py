@@ -1,3 +1,6 @@
+import os
+
+import pytest
 import xarray as xr
 import numpy as np
 from scipy.constants import pi
@@ -74,3 +77,404 @@ def test_compute_trajectories():
         thref=ds.thref.values,
         ref_func=trajectory_cloud_ref,
     )
+
+
+def _create_cloud_file(tmp_path):
+    ds = _create_synthetic_dataset(
+        dL=(25.0, 25.0, 25.0),
+        L=(0.5e3, 0.5e3, 1.0e3),
+        t_max=900.,
+        dt=60.,
+        U=[1., 2., 0.5, ]
+    )
+    ds['th'] = 300.0 + 0.*ds.x + 0.*ds.y + 0.*ds.z + 0.*ds.t
+    ds['w'] = 0.5 + 0.*ds.x + 0.*ds.y + 0.*ds.z + 0.*ds.t
+    ds['q_vapour'] = 0.01 + 0.*ds.x + 0.*ds.y + 0.*ds.z + 0.*ds.t
+    ds['q_cloud_liquid_mass'] = (
+        1.0e-3*(((ds.x-250)**2 + (ds.y-450)**2 + (ds.z-500)**2) < 150**2)
+        + 0.*ds.t
+    )
+    fn = str(tmp_path / "diag_900.nc")
+    ds.transpose('t', 'x', 'y', 'z').to_netcdf(fn)
+    # back trajectories only.
+    args = ([fn, ], 120., 360., 360., ["w", "th"], np.full(ds.z.size, 300.),
+            trajectory_cloud_ref)
+    return args
+
+
+def _create_forward_file(tmp_path):
+    # tracer_traj_zr is read as a grid index, so dz is 1 m for the forward
+    # solver to converge.
+    ds = _create_synthetic_dataset(
+        dL=(25.0, 25.0, 1.0),
+        L=(0.5e3, 0.5e3, 40.),
+        t_max=900.,
+        dt=60.,
+        U=[1., 2., 0., ]
+    )
+    ds['th'] = 300.0 + 0.*ds.x + 0.*ds.y + 0.*ds.z + 0.*ds.t
+    ds['w'] = 0.5 + 0.*ds.x + 0.*ds.y + 0.*ds.z + 0.*ds.t
+    ds['q_cloud_liquid_mass'] = (
+        1.0e-3*(((ds.x-250)**2 + (ds.y-450)**2) < 100**2)*(abs(ds.z-20) < 4)
+        + 0.*ds.t
+    )
+    fn = str(tmp_path / "diag_900.nc")
+    ds.transpose('t', 'x', 'y', 'z').to_netcdf(fn)
+    # back and forward trajectories.
+    args = ([fn, ], 120., 360., 480., ["w", "th"], np.full(ds.z.size, 300.),
+            trajectory_cloud_ref)
+    return args
+
+
+def test_tiled_trajectories_match_serial(tmp_path):
+    # points cross tile and cyclic boundaries.
+    args = _create_cloud_file(tmp_path)
+    serial = compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+    tiled = compute_trajectories(*args, kwargs={'thresh': 1.0e-5},
+                                 tiles=(2, 3), halo=2)
+    for s, t in zip(serial, tiled):
+        assert np.array_equal(np.asarray(s), np.asarray(t))
+
+
+def test_point_parallel_trajectories_match_serial(tmp_path):
+    # Run in a new interpreter, so the shared memory resource tracker
+    # writes any errors to the captured stderr. The second parallel run
+    # starts its workers after the tracker is running.
+    import subprocess
+    import sys
+    _create_forward_file(tmp_path)
+    script = """
+import functools, sys
+import numpy as np
+import advtraj.compute_trajectories as ct
+ct.Point_Parallel = functools.partial(ct.Point_Parallel, min_points=10)
+args = ([sys.argv[1]], 120., 360., 480., ["w", "th"], np.full(40, 300.),
+        ct.trajectory_cloud_ref)
+serial = ct.compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+for run in range(2):
+    par = ct.compute_trajectories(*args, kwargs={'thresh': 1.0e-5}, nproc=3)
+    print(all(np.array_equal(np.asarray(s), np.asarray(p))
+              for s, p in zip(serial, par)))
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop("ADVTRAJ_INSTRUMENTATION", None)
+    result = subprocess.run([sys.executable, "-c", script,
+                             str(tmp_path / "diag_900.nc")],
+                            capture_output=True, text=True, env=env,
+                            timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ["True", "True"]
+    assert "Traceback" not in result.stderr
+    assert "leaked" not in result.stderr
+
+
+def test_tile_window_matches_full_fields(tmp_path):
+    # The forward correction step reads +/-5 cells around each point.
+    from netCDF4 import Dataset
+    from advtraj.compute_trajectories import (Tile_Decomposition,
+                                              load_traj_step_data)
+    args = _create_cloud_file(tmp_path)
+    with pytest.raises(ValueError):
+        Tile_Decomposition(20, 20, (2, 2), halo=0)
+    with pytest.raises(ValueError):
+        Tile_Decomposition(20, 20, (2, 2), halo=2)
+
+    dataset = Dataset(args[0][0])
+    try:
+        data, time = load_traj_step_data(dataset, 3, args[4], args[5])
+        tiles = Tile_Decomposition(20, 20, (2, 2), halo=6)
+        try:
+            tiles.load_step_data(dataset, 3, args[4], args[5])
+            for ix, iy in ((0, 0), (9, 10), (19, 5), (15, 19)):
+                xr = np.arange(ix - 5, ix + 6)
+                yr = np.arange(iy - 5, iy + 6)
+                zr = np.arange(10, 21)
+                for l in (0, 2, len(data) - 1):
+                    expected = data[l][np.ix_(xr % 20, yr % 20, zr)]
+                    window = tiles.window(l, np.ix_(xr, yr, zr))
+                    assert np.array_equal(window, expected)
+        finally:
+            tiles.close()
+
+        # Worker errors are raised in the caller, and close still works.
+        tiles = Tile_Decomposition(20, 20, (2, 2), halo=1, forward=False)
+        try:
+            tiles.load_step_data(dataset, 3, args[4], args[5])
+            with pytest.raises(IndexError):
+                tiles.window(0, np.ix_(np.arange(-5, 6), np.arange(-5, 6),
+                                        np.arange(11)))
+        finally:
+            tiles.close()
+    finally:
+        dataset.close()
+
+
+def test_resume_from_checkpoint_matches_uninterrupted(tmp_path, monkeypatch):
+    import advtraj.compute_trajectories as ct
+    args = _create_cloud_file(tmp_path)
+    checkpoint = str(tmp_path / "run.ckpt")
+    expected = compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+
+    step = ct.back_trajectory_step
+    calls = []
+
+    def failing_step(*a, **kw):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError("node failure")
+        return step(*a, **kw)
+
+    monkeypatch.setattr(ct, "back_trajectory_step", failing_step)
+    with pytest.raises(RuntimeError):
+        compute_trajectories(*args, kwargs={'thresh': 1.0e-5},
+                             checkpoint_file=checkpoint,
+                             checkpoint_interval=2)
+    monkeypatch.setattr(ct, "back_trajectory_step", step)
+    resumed = compute_trajectories(*args, kwargs={'thresh': 1.0e-5},
+                                   checkpoint_file=checkpoint,
+                                   checkpoint_interval=2)
+    assert len(calls) == 3
+    assert not os.path.exists(checkpoint)
+    for e, r in zip(expected, resumed):
+        assert np.array_equal(np.asarray(e), np.asarray(r))
+
+
+def test_batch_runs_jobs_once(tmp_path):
+    import json
+    import socket
+    from advtraj.batch import batch_jobs, read_config, run_batch
+    args = _create_cloud_file(tmp_path)
+    nz = len(args[5])
+    xr.Dataset({
+        'rhon': (('t', 'z'), np.ones((1, nz))),
+        'prefn': (('t', 'z'), np.full((1, nz), 1.0e5)),
+        'thref': (('t', 'z'), np.full((1, nz), 300.)),
+    }).to_netcdf(str(tmp_path / "diagnostics_ts_900.nc"))
+    config_file = str(tmp_path / "batch.json")
+    with open(config_file, "w") as f:
+        json.dump({
+            "output_dir": str(tmp_path / "out"),
+            "runs": [{
+                "name": "cloud",
+                "files": args[0][0],
+                "ref_prof_file": str(tmp_path / "diagnostics_ts_*.nc"),
+                "first_ref_time": 300., "last_ref_time": 420.,
+                "job_length": 120.,
+                "back_len": 120., "forward_len": 0.,
+                "deltax": 25., "deltay": 25., "deltaz": 25.,
+                "kwargs": {"thresh": 1.0e-5},
+                "variables": {"w": "w", "th": "th",
+                              "q_vapour": "qv",
+                              "q_cloud_liquid_mass": "qcl"},
+            }],
+        }, f)
+    config = read_config(config_file)
+    jobs = batch_jobs(config)
+    assert [(j["first_ref_time"], j["last_ref_time"]) for j in jobs] == \
+        [(300., 360.), (420., 420.)]
+
+    # Second job is claimed by a live process on this host.
+    os.makedirs(os.path.dirname(jobs[1]["lock"]))
+    with open(jobs[1]["lock"], "w") as f:
+        f.write("{} {}\n".format(socket.gethostname(), os.getppid()))
+    assert run_batch(config) == [(jobs[0]["job"], "completed"),
+                                 (jobs[1]["job"], "locked")]
+    assert os.path.exists(jobs[0]["output"])
+    assert not os.path.exists(jobs[0]["lock"])
+    os.remove(jobs[1]["lock"])
+    assert run_batch(config) == [(jobs[0]["job"], "done"),
+                                 (jobs[1]["job"], "completed")]
+
+
+def test_batch_stale_lock_taken_over_once(tmp_path, monkeypatch):
+    import socket
+    import subprocess
+    import sys
+    import advtraj.batch as batch
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    lock = str(tmp_path / "locks" / "job.lock")
+    os.makedirs(os.path.dirname(lock))
+    with open(lock, "w") as f:
+        f.write("{} {}\n".format(socket.gethostname(), dead.pid))
+    assert batch.acquire_lock(lock)
+    with open(lock) as f:
+        assert f.read().split() == [socket.gethostname(), str(os.getpid())]
+    assert os.listdir(os.path.dirname(lock)) == ["job.lock"]
+
+    # Another process found the old lock stale, but it has since been
+    # replaced by a live lock (this one), which is kept.
+    owner_dead = batch._lock_owner_dead
+    calls = []
+
+    def stale_when_first_read(name):
+        calls.append(name)
+        return len(calls) == 1 or owner_dead(name)
+
+    monkeypatch.setattr(batch, "_lock_owner_dead", stale_when_first_read)
+    assert not batch.acquire_lock(lock)
+    with open(lock) as f:
+        assert f.read().split() == [socket.gethostname(), str(os.getpid())]
+    assert os.listdir(os.path.dirname(lock)) == ["job.lock"]
+
+    # The lock was taken over and removed by another process.
+    monkeypatch.setattr(batch, "_lock_owner_dead", lambda name: True)
+    os.remove(lock)
+    assert batch._take_over_lock(lock)
+    assert not os.path.exists(lock)
+
+
+def test_batch_read_toml_config(tmp_path, monkeypatch):
+    import sys
+    from advtraj.batch import read_config
+    config_file = str(tmp_path / "batch.toml")
+    with open(config_file, "w") as f:
+        f.write('output_dir = "/tmp/out"\nworkers = 2\n\n'
+                '[[runs]]\nname = "cloud"\nback_len = 120.0\n'
+                'kwargs = { thresh = 1.0e-5 }\n')
+    if sys.version_info < (3, 11):
+        pytest.importorskip("tomli")
+    assert read_config(config_file) == {
+        "output_dir": "/tmp/out", "workers": 2,
+        "runs": [{"name": "cloud", "back_len": 120.0,
+                  "kwargs": {"thresh": 1.0e-5}}]}
+
+    # Without a TOML parser the error says what is needed.
+    monkeypatch.setitem(sys.modules, "tomllib", None)
+    monkeypatch.setitem(sys.modules, "tomli", None)
+    with pytest.raises(ImportError, match="tomli"):
+        read_config(config_file)
+
+
+def test_instrumentation_records_stages(tmp_path):
+    from advtraj.instrumentation import (enable_instrumentation,
+                                         disable_instrumentation,
+                                         read_instrumentation,
+                                         summarize_instrumentation)
+    args = _create_cloud_file(tmp_path)
+    expected = compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+    report = str(tmp_path / "report.jsonl")
+    enable_instrumentation(report)
+    try:
+        result = compute_trajectories(*args, kwargs={'thresh': 1.0e-5},
+                                      tiles=(2, 1), halo=2)
+    finally:
+        disable_instrumentation()
+    for e, r in zip(expected, result):
+        assert np.array_equal(np.asarray(e), np.asarray(r))
+
+    summary = summarize_instrumentation(report)
+    for name in ("load_traj_step_data", "tile_data_to_pos",
+                 "label_3D_cyclic"):
+        assert summary[name]["calls"] > 0
+        assert summary[name]["wall"] >= 0.0
+    assert summary["load_traj_step_data"]["bytes"] > 0
+    # Tile workers append their reads to the same report.
+    reads = [r for r in read_instrumentation(report)
+             if r["span"] == "load_traj_step_data"]
+    assert any(r["pid"] != os.getpid() for r in reads)
+
+
+def test_span_parents_after_exception(tmp_path):
+    from advtraj.instrumentation import (enable_instrumentation,
+                                         disable_instrumentation,
+                                         read_instrumentation,
+                                         span, start_span)
+    report = str(tmp_path / "report.jsonl")
+    enable_instrumentation(report)
+    try:
+        with span("outer"):
+            with pytest.raises(RuntimeError):
+                with span("failing"):
+                    raise RuntimeError("failed")
+            # A span started but never stopped is dropped with its parent.
+            start_span("abandoned")
+        with span("after"):
+            pass
+    finally:
+        disable_instrumentation()
+    parents = dict((r["span"], r["parent"])
+                   for r in read_instrumentation(report))
+    assert parents == {"failing": "outer", "outer": None, "after": None}
+
+
+def test_span_parents_per_thread(tmp_path):
+    import threading
+    from advtraj.instrumentation import (enable_instrumentation,
+                                         disable_instrumentation,
+                                         read_instrumentation,
+                                         span)
+    report = str(tmp_path / "report.jsonl")
+    barrier = threading.Barrier(2)
+
+    def job(name):
+        barrier.wait()
+        with span(name):
+            for i in range(50):
+                with span(name + "_step"):
+                    pass
+
+    enable_instrumentation(report)
+    try:
+        threads = [threading.Thread(target=job, args=(name,))
+                   for name in ("a", "b")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        disable_instrumentation()
+    records = read_instrumentation(report)
+    assert len(records) == 102
+    for r in records:
+        expected = r["span"][0] if r["span"].endswith("_step") else None
+        assert r["parent"] == expected
+
+
+def test_logging_levels_and_rate_limited_progress(tmp_path):
+    import io
+    import json
+    from advtraj.traj_logging import configure_logging, reset_logging
+    args = _create_cloud_file(tmp_path)
+    out = io.StringIO()
+    configure_logging("INFO", stream=out, progress_interval=3600.0)
+    try:
+        compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+    finally:
+        reset_logging()
+    text = out.getvalue()
+    assert "Computing backward trajectories." in text
+    assert text.count("Processing data at time") == 1
+    assert "Time index" not in text
+
+    # One solver record per forward step, whatever the level.
+    (tmp_path / "forward").mkdir()
+    forward_args = _create_forward_file(tmp_path / "forward")
+    out, stats = io.StringIO(), io.StringIO()
+    configure_logging("INFO", stream=out, progress_interval=3600.0,
+                      solver_stats=stats)
+    try:
+        traj = compute_trajectories(*forward_args, kwargs={'thresh': 1.0e-5})
+    finally:
+        reset_logging()
+    records = [json.loads(line) for line in stats.getvalue().splitlines()]
+    assert [r["time"] for r in records] == [420., 480.]
+    for record in records:
+        assert record["logger"] == "advtraj.solver.stats"
+        assert 0 < record["niter"] <= 31
+        assert 0.0 <= record["err"] <= 1.0e-4
+        assert record["points"] == np.shape(traj[0])[1]
+        assert record["corrected"] == 0
+        assert record["converged"] is True
+    assert "Computing forward trajectories." in out.getvalue()
+    assert "niter" not in out.getvalue()
+
+    out = io.StringIO()
+    configure_logging("DEBUG", stream=out, progress_interval=0)
+    try:
+        compute_trajectories(*args, kwargs={'thresh': 1.0e-5})
+    finally:
+        reset_logging()
+    assert out.getvalue().count("Processing data at time") == 4
+    assert "Time index" in out.getvalue()
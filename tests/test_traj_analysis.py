@@ -0,0 +1,755 @@
+import numpy as np
+import pytest
+
+from advtraj.compute_trajectories import (Trajectory_Family,
+                                          Trajectories,
+                                          Traj_Box_Accumulator,
+                                          Box_Index,
+                                          Voxel_Cache,
+                                          Union_Find,
+                                          Family_Links,
+                                          Dataset_Pool,
+                                          Point_Parallel,
+                                          Traj_Config,
+                                          data_to_pos,
+                                          box_overlap_with_wrap,
+                                          compute_traj_boxes,
+                                          grouped_sum,
+                                          in_cloud,
+                                          set_cloud_class,
+                                          cloud_class_key,
+                                          cloud_class_schemes,
+                                          cloud_mask_qcl,
+                                          register_cloud_class_scheme,
+                                          Cloud_Class_Scheme,
+                                          Cloud_Properties,
+                                          cloud_properties,
+                                          compute_derived_variables,
+                                          derived_variables,
+                                          derived_variable_functions,
+                                          register_derived_variable,
+                                          )
+from advtraj.trajectory_io import (Lazy_Array,
+                                   Mapped_Trajectories,
+                                   save_mapped_trajectories,
+                                   close_files,
+                                   load_trajectories,
+                                   save_trajectories,
+                                   load_trajectory_family,
+                                   save_trajectory_family,
+                                   )
+from advtraj.cloud_statistics import (Cloud_Statistics,
+                                      Heat_Map,
+                                      member_cloud_statistics,
+                                      family_cloud_statistics,
+                                      aggregate_cloud_statistics,
+                                      load_cloud_statistics,
+                                      )
+
+
+def _create_synthetic_trajectories(nobjects=5, npts_per_obj=20, nt=7,
+                                   nx=32, ny=32, nz=20, seed=1):
+    """
+    Build a Trajectories object directly from random data, bypassing the
+    netCDF-reading constructor.
+    """
+    rng = np.random.default_rng(seed)
+    npoints = nobjects * npts_per_obj
+    labels = rng.permutation(np.repeat(np.arange(nobjects), npts_per_obj))
+
+    centres = rng.uniform(0, [nx, ny, nz / 2], size=(nobjects, 3))
+    drift = rng.uniform(-0.5, 0.5, size=(nobjects, 3))
+    times = np.arange(nt)
+    trajectory = (centres[labels][np.newaxis, ...]
+                  + drift[labels][np.newaxis, ...] * times[:, None, None]
+                  + rng.normal(0.0, 1.5, size=(nt, npoints, 3)))
+    trajectory[..., 2] = np.clip(trajectory[..., 2], 0, nz - 1)
+
+    variable_list = {"u": "u", "v": "v", "w": "w", "th": "th",
+                     "q_vapour": "q_v", "q_cloud_liquid_mass": "q_cl"}
+    data = np.zeros((nt, npoints, len(variable_list)))
+    data[..., 0:3] = rng.normal(0.0, 1.0, size=(nt, npoints, 3))
+    data[..., 3] = 300.0 + trajectory[..., 2] * 0.1
+    data[..., 4] = 0.015 - trajectory[..., 2] * 1.0E-4
+    qcl = rng.uniform(-2.0E-5, 4.0E-5, size=(nt, npoints))
+    data[..., 5] = np.maximum(qcl, 0.0)
+
+    traj = Trajectories.__new__(Trajectories)
+    traj.trajectory = trajectory
+    traj.data = data
+    traj.traj_error = np.zeros_like(trajectory)
+    traj.times = times * 60.0
+    traj.ref = nt // 2
+    traj.end = nt - 1
+    traj.ntimes = nt
+    traj.npoints = npoints
+    traj.labels = labels
+    traj.nobjects = nobjects
+    traj.variable_list = variable_list
+    traj.nx, traj.ny, traj.nz = nx, ny, nz
+    traj.xcoord = np.arange(nx, dtype=float)
+    traj.ycoord = np.arange(ny, dtype=float)
+    traj.zcoord = np.arange(nz, dtype=float)
+    traj.deltax = traj.deltay = 100.0
+    traj.deltaz = 40.0
+    traj.piref = np.linspace(1.0, 0.9, nz)
+    traj.thref = np.linspace(300.0, 310.0, nz)
+    traj.rhoref = np.linspace(1.2, 1.0, nz)
+    traj.in_obj_func = in_cloud
+    traj.ref_func_kwargs = {"thresh": 1.0E-5}
+    return traj
+
+
+def _create_synthetic_family(nmembers=4, back=3, forward=2, seed=2,
+                             linked=False):
+    """
+    Build a Trajectory_Family whose members are windows onto the same
+    set of synthetic trajectories, with reference times one step apart.
+    If linked, max_at_ref of member m holds the objects in cloud at its
+    reference time other than object m, so consecutive members share
+    objects and linked chains have different lengths.
+    """
+    nt_total = nmembers + back + forward
+    history = _create_synthetic_trajectories(nobjects=8, npts_per_obj=15,
+                                             nt=nt_total, seed=seed)
+    family = Trajectory_Family.__new__(Trajectory_Family)
+    family.family = list([])
+    for m in range(nmembers):
+        window = slice(m, m + back + forward + 1)
+        traj = _create_synthetic_trajectories(nobjects=8, npts_per_obj=15,
+                                              nt=back + forward + 1,
+                                              seed=seed)
+        traj.trajectory = history.trajectory[window].copy()
+        traj.data = history.data[window].copy()
+        traj.times = history.times[window]
+        traj.ref = back
+        traj.data_mean, traj.in_obj_data_mean, traj.objvar_mean, \
+            traj.num_in_obj, traj.centroid, traj.in_obj_centroid, \
+            traj.bounding_box, traj.in_obj_box = \
+            compute_traj_boxes(traj, in_cloud, kwargs=traj.ref_func_kwargs)
+        max_objvar = (traj.objvar_mean == np.max(traj.objvar_mean, axis=0))
+        when_max_objvar = np.where(max_objvar)
+        traj.max_at_ref = when_max_objvar[1][when_max_objvar[0] == traj.ref]
+        if linked:
+            objs = np.flatnonzero(traj.num_in_obj[traj.ref] > 0)
+            traj.max_at_ref = objs[objs != m]
+        family.family.append(traj)
+    return family
+
+
+def _create_cloud_family(nmembers=3, back=3, forward=2, seed=3):
+    """
+    Build a Trajectory_Family of rising clouds: points rise from below
+    level 15 (the cloud base) and are cloudy above it until the last
+    time, with the most liquid water at the reference time. Clouds have
+    cloud base area, depth and entrainment within default_bins.
+    """
+    family = _create_synthetic_family(nmembers=nmembers, back=back,
+                                      forward=forward, seed=seed)
+    rng = np.random.default_rng(seed)
+    nz = 40
+    for traj in family.family:
+        times = np.arange(traj.ntimes)[:, np.newaxis]
+        z0 = rng.uniform(8.0, 14.0, traj.npoints)
+        rise = rng.uniform(1.5, 3.5, traj.npoints)
+        traj.trajectory[..., 2] = z0 + rise * times
+        cloudy = np.logical_and(traj.trajectory[..., 2] >= 15.0,
+                                times < traj.ntimes - 1)
+        traj.data[..., 2] = 1.5
+        traj.data[..., 5] = cloudy * np.where(times == traj.ref,
+                                              2.0E-4, 1.0E-4)
+        traj.nz = nz
+        traj.zcoord = np.arange(nz, dtype=float)
+        traj.piref = np.linspace(1.0, 0.85, nz)
+        traj.pref = traj.piref * 1.0E5
+        traj.thref = np.linspace(300.0, 312.0, nz)
+        traj.rhoref = np.linspace(1.2, 0.9, nz)
+        traj.files, traj.ref_func, traj.deltat = ["f.nc"], None, 60
+        traj.data_mean, traj.in_obj_data_mean, traj.objvar_mean, \
+            traj.num_in_obj, traj.centroid, traj.in_obj_centroid, \
+            traj.bounding_box, traj.in_obj_box = \
+            compute_traj_boxes(traj, in_cloud, kwargs=traj.ref_func_kwargs)
+        traj.max_at_ref = np.flatnonzero(traj.num_in_obj[traj.ref] > 0)
+    return family
+
+
+def _reference_traj_boxes(traj, in_obj_func, kwargs):
+    nt, nobj, nv = traj.ntimes, traj.nobjects, np.shape(traj.data)[2]
+    data_mean = np.zeros((nt, nobj, nv))
+    in_obj_data_mean = np.zeros((nt, nobj, nv))
+    objvar_mean = np.zeros((nt, nobj))
+    num_in_obj = np.zeros((nt, nobj), dtype=int)
+    centroid = np.zeros((nt, nobj, 3))
+    in_obj_centroid = np.zeros((nt, nobj, 3))
+    box = np.zeros((nt, nobj, 2, 3))
+    in_obj_box = np.zeros((nt, nobj, 2, 3))
+    in_obj_mask, objvar = in_obj_func(traj, **kwargs)
+    for iobj in range(nobj):
+        sel = traj.labels == iobj
+        data = traj.data[:, sel, :]
+        obj = traj.trajectory[:, sel, :]
+        data_mean[:, iobj, :] = np.mean(data, axis=1)
+        centroid[:, iobj, :] = np.mean(obj, axis=1)
+        box[:, iobj, 0, :] = np.amin(obj, axis=1)
+        box[:, iobj, 1, :] = np.amax(obj, axis=1)
+        for it in range(nt):
+            mask = in_obj_mask[it, sel]
+            num_in_obj[it, iobj] = np.count_nonzero(mask)
+            if num_in_obj[it, iobj] > 0:
+                in_obj_data_mean[it, iobj, :] = np.mean(data[it, mask, :],
+                                                        axis=0)
+                objvar_mean[it, iobj] = np.mean(objvar[it, sel][mask])
+                in_obj_centroid[it, iobj, :] = np.mean(obj[it, mask, :],
+                                                       axis=0)
+                in_obj_box[it, iobj, 0, :] = np.amin(obj[it, mask, :], axis=0)
+                in_obj_box[it, iobj, 1, :] = np.amax(obj[it, mask, :], axis=0)
+    return data_mean, in_obj_data_mean, objvar_mean, num_in_obj, \
+        centroid, in_obj_centroid, box, in_obj_box
+
+
+def test_compute_traj_boxes_matches_reference():
+    traj = _create_synthetic_trajectories()
+    kwargs = traj.ref_func_kwargs
+    result = compute_traj_boxes(traj, in_cloud, kwargs=kwargs)
+    expected = _reference_traj_boxes(traj, in_cloud, kwargs)
+    for r, e in zip(result, expected):
+        assert np.shape(r) == np.shape(e)
+        np.testing.assert_allclose(r, e, rtol=1.0E-12, atol=1.0E-15)
+    np.testing.assert_array_equal(result[3], expected[3])
+
+
+def test_traj_box_accumulator_matches_compute_traj_boxes():
+    traj = _create_synthetic_trajectories()
+    kwargs = traj.ref_func_kwargs
+    expected = compute_traj_boxes(traj, in_cloud, kwargs=kwargs)
+
+    acc = Traj_Box_Accumulator(in_cloud, traj.variable_list, kwargs=kwargs)
+    acc.set_objects(traj.labels, traj.nobjects, traj.nx, traj.ny)
+    # Feed levels in the order compute_trajectories produces them.
+    acc.add_level(traj.trajectory[traj.ref], traj.data[traj.ref])
+    for it in range(traj.ref - 1, -1, -1):
+        acc.add_level(traj.trajectory[it], traj.data[it], at_start=True)
+    for it in range(traj.ref + 1, traj.ntimes):
+        acc.add_level(traj.trajectory[it], traj.data[it], at_start=False)
+
+    for r, e in zip(acc.boxes(), expected):
+        np.testing.assert_allclose(r, e, rtol=1.0E-12, atol=1.0E-15)
+
+
+def test_box_index_matches_brute_force_with_wrap():
+    rng = np.random.default_rng(3)
+    nx, ny = 40, 30
+    nboxes, nquery = 200, 50
+
+    def random_boxes(n):
+        lo = rng.uniform([-nx / 4, -ny / 4, 0], [nx, ny, 10], size=(n, 3))
+        width = rng.uniform(0, [8, 6, 5], size=(n, 3))
+        return np.stack([lo, lo + width], axis=1)
+
+    boxes = random_boxes(nboxes)
+    queries = random_boxes(nquery)
+    valid = rng.uniform(size=nboxes) > 0.2
+
+    index = Box_Index(boxes, nx, ny, valid=valid, wrap=True)
+    result = index.query(queries)
+
+    for q, found in zip(queries, result):
+        expected = set()
+        for kx in (-2, -1, 0, 1, 2):
+            for ky in (-2, -1, 0, 1, 2):
+                lo = q[0, :2] + [kx * nx, ky * ny]
+                hi = q[1, :2] + [kx * nx, ky * ny]
+                hit = np.all((boxes[:, 0, :2] <= hi) &
+                             (boxes[:, 1, :2] >= lo), axis=1)
+                expected.update(np.where(hit & valid)[0])
+        assert list(found) == sorted(expected)
+
+
+def test_matching_object_list_matches_brute_force():
+    tfm = _create_synthetic_family()
+    master_ref = len(tfm.family) - 1
+    traj = tfm.family[master_ref]
+    mol = tfm.matching_object_list()["matching_objects"]
+    for t_off, matching_objects in enumerate(mol):
+        match_traj = tfm.family[master_ref - (t_off + 1)]
+        for it_back, matching_at_time in enumerate(matching_objects):
+            ref_time = traj.ref - it_back
+            match_time = match_traj.ref + (t_off + 1) - it_back
+            for iobj, found in enumerate(matching_at_time):
+                expected = np.array([], dtype=int)
+                if traj.num_in_obj[ref_time, iobj] > 0 and \
+                        0 <= match_time < match_traj.ntimes:
+                    expected = box_overlap_with_wrap(
+                        traj.in_obj_box[ref_time, iobj],
+                        match_traj.in_obj_box[match_time],
+                        traj.nx, traj.ny)
+                    active = match_traj.num_in_obj[match_time, expected] > 0
+                    expected = expected[active]
+                np.testing.assert_array_equal(found, expected)
+
+
+def _reference_voxels(traj, tr_time, obj):
+    obj_ptrs = traj.labels == obj
+    mask, _ = traj.in_obj_func(traj, tr_time, obj_ptrs,
+                               **traj.ref_func_kwargs)
+    tr = (traj.trajectory[tr_time, obj_ptrs, ...] + 0.5).astype(int)[mask, :]
+    return np.unique(tr[:, 0] + traj.nx * (tr[:, 1] + traj.ny * tr[:, 2]))
+
+
+def test_refine_object_overlap_uses_cached_voxels():
+    tfm = _create_synthetic_family()
+    master_ref = len(tfm.family) - 1
+    traj = tfm.family[master_ref]
+    t_off, time = 0, 1
+    match_traj = tfm.family[master_ref - 1]
+    for obj in range(traj.nobjects):
+        for mobj in range(match_traj.nobjects):
+            a = _reference_voxels(traj, traj.ref - time, obj)
+            b = _reference_voxels(match_traj, match_traj.ref - time + 1, mobj)
+            max_size = max(np.size(a), np.size(b))
+            expected = 0 if max_size == 0 else \
+                np.size(np.intersect1d(a, b)) / max_size
+            assert tfm.refine_object_overlap(t_off, time, obj, mobj) == \
+                expected
+    cache = tfm.voxel_cache()
+    assert len(cache) == traj.nobjects + match_traj.nobjects
+    assert cache.misses == len(cache)
+
+
+def test_voxel_cache_evicts_least_recently_used():
+    cache = Voxel_Cache(max_bytes=3 * 80)
+    for key in range(3):
+        cache.put(key, np.arange(10))
+    cache.get(0)
+    cache.put(3, np.arange(10))
+    assert 1 not in cache
+    assert all(k in cache for k in (0, 2, 3))
+    assert cache.nbytes == 3 * 80
+
+
+def test_overlap_matrix_matches_refine_object_overlap():
+    tfm = _create_synthetic_family()
+    master_ref = len(tfm.family) - 1
+    traj = tfm.family[master_ref]
+    for t_off in range(2):
+        match_traj = tfm.family[master_ref - (t_off + 1)]
+        for time in range(traj.ref + 1):
+            if match_traj.ref - time + t_off + 1 >= match_traj.ntimes:
+                continue
+            overlap = tfm.overlap_matrix(t_off, time).toarray()
+            assert overlap.shape == (traj.nobjects, match_traj.nobjects)
+            for obj in range(traj.nobjects):
+                for mobj in range(match_traj.nobjects):
+                    assert overlap[obj, mobj] == \
+                        tfm.refine_object_overlap(t_off, time, obj, mobj)
+
+
+def test_union_find_and_super_object_components():
+    uf = Union_Find(6)
+    uf.union_all([0, 1, 4], [1, 2, 5])
+    comp = uf.components()
+    assert comp[0] == comp[1] == comp[2]
+    assert comp[4] == comp[5]
+    assert len(set(comp[[0, 3, 4]])) == 3
+    assert uf.add(2) == 6 and len(uf) == 8
+
+    tfm = _create_synthetic_family(nmembers=4, back=3, forward=2, seed=3,
+                                   linked=True)
+    graph = tfm.super_object_graph(overlap_thresh=0.1)
+    nodes, edges = graph["nodes"], graph["edges"]
+    assert len(edges) > 0
+    # Every edge links consecutive sets and joins one component.
+    for i, j, pct in edges:
+        assert nodes[i, 0] == nodes[j, 0] + 1
+        assert graph["component"][i] == graph["component"][j]
+        assert pct > 10
+    super_objects, len_sup = \
+        tfm.find_super_object_components(overlap_thresh=0.1)
+    assert sum(len(s) for s in super_objects) == len(nodes)
+    assert len(super_objects) == len(len_sup)
+    # Objects dropped from max_at_ref split lineages into several lengths.
+    assert len(set(len_sup.tolist())) > 1 and np.max(len_sup) == 4
+    for s in super_objects:
+        assert len(set(s[:, 0].tolist())) == len(s) > 0
+    # Each chain from find_super_objects lies within a single component.
+    chains, len_chains = tfm.find_super_objects(overlap_thresh=0.1)
+    assert np.max(len_chains) > 1
+    where = {tuple(n): c for n, c in zip(nodes.tolist(), graph["component"])}
+    for chain in chains:
+        assert len({where[tuple(n[:2])] for n in chain.tolist()}) == 1
+
+
+def test_family_append_maintains_links():
+    ref = _create_synthetic_family(nmembers=4, back=3, forward=2, seed=3,
+                                   linked=True)
+    tfm = Trajectory_Family.__new__(Trajectory_Family)
+    tfm.family = list([])
+    tfm.links = Family_Links(overlap_thresh=0.1)
+    for member, traj in enumerate(ref.family):
+        tfm.append(traj)
+        assert tfm.links.nmembers == member + 1
+        graph = tfm.super_object_graph(overlap_thresh=0.1)
+        assert (len(graph["edges"]) > 0) == (member > 0)
+        expected = ref.super_object_graph(master_ref=member,
+                                          overlap_thresh=0.1)
+        for key in ("nodes", "edges"):
+            assert np.array_equal(graph[key], expected[key])
+        got, len_got = tfm.find_super_objects(overlap_thresh=0.1)
+        exp, len_exp = ref.find_super_objects(master_ref=member,
+                                              overlap_thresh=0.1)
+        assert np.array_equal(len_got, len_exp)
+        assert all(np.array_equal(a, b) for a, b in zip(got, exp))
+    assert np.max(len_got) == len(ref.family)
+
+
+def test_set_cloud_class_version_1():
+    traj = _create_synthetic_trajectories(nobjects=1, npts_per_obj=3, nt=7)
+    traj.ref = 3
+    traj.piref = np.zeros(traj.nz)
+    cloud = np.array([[1, 1, 1, 1, 1, 1, 1],
+                      [0, 0, 1, 1, 1, 0, 0],
+                      [1, 0, 0, 1, 1, 1, 1]], dtype=bool).T
+    traj.data[..., traj.var("q_cloud_liquid_mass")] = \
+        np.where(cloud, 2.0E-5, 0.0)
+    traj.trajectory[..., 2] = 3.0
+    traj.trajectory[0, 1, 2] = 1.0
+    traj_cl = set_cloud_class(traj, thresh=1.0E-5)
+    assert np.array_equal(traj_cl["class"].T,
+                          [[6, 6, 6, 6, 6, 6, 6],
+                           [1, 1, 7, 6, 6, 9, 10],
+                           [6, 9, 10, 8, 6, 6, 6]])
+    assert traj_cl["cloud_trigger_time"][0] == 0
+    assert traj_cl["cloud_dissipate_time"][0] == traj.ntimes
+    assert traj_cl["min_cloud_base"][0] == (3.0 - 0.5) * traj.deltaz
+
+
+def test_cloud_class_schemes():
+    traj = _create_synthetic_trajectories(nobjects=3, npts_per_obj=10, nt=7)
+    traj.data[..., traj.var("w")] = 1.0
+    v1 = set_cloud_class(traj, thresh=1.0E-5, version=1)
+    v2 = set_cloud_class(traj, thresh=1.0E-5, version=2)
+    assert np.array_equal(v1["class"], v2["class"])
+    assert cloud_class_key(v1)[6] == ["CLOUD", "black"]
+
+    # Scheme that does not distinguish main and previous cloud.
+    back = {("cont", None, None): "CLOUD", ("new", None, None): "NEW"}
+    forward = {("cont", None, None): "CLOUD"}
+    register_cloud_class_scheme(Cloud_Class_Scheme(
+        99, [("Not set", "lightgray"), ("CLOUD", "black"), ("NEW", "red")],
+        back, forward, cloud_mask_qcl))
+    try:
+        v99 = set_cloud_class(traj, thresh=1.0E-5, version=99)
+    finally:
+        cloud_class_schemes.pop(99)
+    cloud = np.isin(v1["class"], [3, 6, 11])
+    assert np.array_equal(v99["class"] == 1, cloud)
+    # New cloud only has a class up to the reference time.
+    back = slice(0, traj.ref + 1)
+    assert np.array_equal(v99["class"][back] == 2,
+                          np.isin(v1["class"][back], [7, 8]))
+    assert not np.any(v99["class"][traj.ref + 1:] == 2)
+
+    with pytest.raises(ValueError):
+        set_cloud_class(traj, thresh=1.0E-5, version=98)
+
+
+def test_grouped_sum_matches_sum_per_group():
+    rng = np.random.default_rng(4)
+    values = rng.normal(size=(200, 5)) * 1.0E3
+    group = rng.integers(0, 12, size=200)
+    sums, counts = grouped_sum(values, group, 14)
+    for g in range(14):
+        assert counts[g] == np.sum(group == g)
+        assert np.array_equal(sums[g], np.sum(values[group == g], axis=0))
+
+
+def test_cloud_properties_lazy_selection():
+    traj = _create_synthetic_trajectories(nobjects=4, npts_per_obj=15, nt=7)
+    traj.piref = np.linspace(1.0, 0.9, traj.nz)
+    traj_cl = set_cloud_class(traj, thresh=1.0E-5)
+    full = cloud_properties(traj, traj_cl)
+    assert list(full.keys()) == Cloud_Properties.all_outputs
+
+    objects = [1, 3]
+    lazy = cloud_properties(traj, traj_cl, lazy=True, objects=objects,
+                            outputs=["cloud", "entrainment",
+                                     "cloud_base_variables"],
+                            variables=["w", "MSE"])
+    assert isinstance(lazy, Cloud_Properties)
+    assert len(lazy._cache) == 0
+    assert "overall_mean" not in lazy
+    with pytest.raises(KeyError):
+        lazy["overall_mean"]
+
+    cols = [traj.var("w"), len(traj.variable_list) + 3,
+            len(traj.variable_list) + 4, len(traj.variable_list) + 5,
+            len(traj.variable_list) + 6, len(traj.variable_list) + 7]
+    assert lazy.column("MSE") == 1 and lazy.column("npts") == 5
+    assert np.array_equal(lazy["cloud"][:, objects, :],
+                          full["cloud"][:, objects, :][:, :, cols])
+    assert np.array_equal(lazy["entrainment"][:, objects, :],
+                          full["entrainment"][:, objects, :])
+    assert np.array_equal(lazy["cloud_base_variables"][objects, :],
+                          full["cloud_base_variables"][objects, :][:, cols[:-1]])
+    assert not np.any(lazy["cloud"][:, [0, 2], :])
+
+
+def test_derived_variables_cached_and_registrable():
+    traj = _create_synthetic_trajectories(nobjects=3, npts_per_obj=10, nt=5)
+    traj.piref = np.linspace(1.0, 0.9, traj.nz)
+    qt = traj.variable("q_total")
+    assert traj.variable("q_total") is qt
+    assert np.array_equal(qt, traj.data[..., traj.var("q_vapour")] +
+                          traj.data[..., traj.var("q_cloud_liquid_mass")])
+
+    pts = np.where(traj.labels == 1)[0]
+    names, out = compute_derived_variables(traj, points=pts)
+    assert list(names) == list(derived_variables)
+    assert np.array_equal(out[..., 0], qt[:, pts])
+
+    register_derived_variable("w_sq", r"$w^2$",
+                              lambda tr: tr.variable("w") ** 2)
+    try:
+        props = cloud_properties(traj, set_cloud_class(traj, thresh=1.0E-5),
+                                 lazy=True, variables=["w", "w_sq"])
+        assert props.column("w_sq") == 1
+        assert np.array_equal(traj.variable("w_sq"),
+                              traj.data[..., traj.var("w")] ** 2)
+    finally:
+        derived_variables.pop("w_sq")
+        derived_variable_functions.pop("w_sq")
+
+
+def test_trajectory_family_io_round_trip(tmp_path):
+    ref = _create_synthetic_family(nmembers=3, back=3, forward=2, seed=3)
+    for traj in ref.family:
+        traj.files, traj.ref_func, traj.deltat = ["f.nc"], None, 60
+        traj.pref = traj.piref * 1.0E5
+    ref.links = Family_Links(overlap_thresh=0.1)
+    for member in range(len(ref.family)):
+        ref.links.add_member(ref, member)
+    filename = str(tmp_path / "family.nc")
+    save_trajectory_family(ref, filename, chunk_points=16)
+
+    tfm = load_trajectory_family(filename)
+    try:
+        for traj, got in zip(ref.family, tfm.family):
+            assert isinstance(got.trajectory, Lazy_Array)
+            order = got.point_index
+            assert np.array_equal(got.labels, traj.labels[order])
+            assert np.array_equal(got.max_at_ref, traj.max_at_ref)
+            assert np.array_equal(got.in_obj_box, traj.in_obj_box)
+            assert got.in_obj_func is in_cloud
+            start, end = got.object_start[2], got.object_start[3]
+            obj, dat = got.trajectory[:, start:end], got.data[:, start:end]
+            assert np.array_equal(obj, traj.select_object(2)[0])
+            assert np.array_equal(dat, traj.select_object(2)[1])
+            assert np.array_equal(np.asarray(got.data), traj.data[:, order])
+        for key in ("nodes", "edges"):
+            assert np.array_equal(tfm.links.graph()[key],
+                                  ref.links.graph()[key])
+    finally:
+        close_files()
+
+
+def test_mapped_trajectories_object_blocks(tmp_path):
+    traj = _create_synthetic_trajectories(nobjects=6, npts_per_obj=12, nt=5)
+    traj.files, traj.ref_func, traj.deltat = ["f.nc"], None, 60
+    traj.pref = traj.piref * 1.0E5
+    traj.data_mean, traj.in_obj_data_mean, traj.objvar_mean, \
+        traj.num_in_obj, traj.centroid, traj.in_obj_centroid, \
+        traj.bounding_box, traj.in_obj_box = \
+        compute_traj_boxes(traj, in_cloud, kwargs=traj.ref_func_kwargs)
+    traj.max_at_ref = np.arange(traj.nobjects)
+    save_mapped_trajectories(traj, str(tmp_path), max_points=10)
+
+    mapped = Mapped_Trajectories(str(tmp_path))
+    try:
+        assert isinstance(mapped.data, np.memmap) or \
+            isinstance(mapped.data.base, np.memmap)
+        order = mapped.point_index
+        assert np.array_equal(mapped.trajectory, traj.trajectory[:, order])
+        assert np.array_equal(mapped.data, traj.data[:, order])
+        assert np.array_equal(mapped.select_object(4)[1],
+                              traj.select_object(4)[1])
+
+        full = cloud_properties(traj, set_cloud_class(traj, thresh=1.0E-5))
+        nblocks = 0
+        for objects, block in mapped.object_blocks(max_points=30):
+            nblocks += 1
+            assert block.npoints <= 30
+            props = cloud_properties(block,
+                                     set_cloud_class(block, thresh=1.0E-5),
+                                     objects=objects)
+            for key in ("cloud", "entrainment"):
+                assert np.array_equal(props[key][:, objects],
+                                      full[key][:, objects])
+        assert nblocks == 3
+    finally:
+        close_files()
+
+
+def test_position_encoding_error_and_size(tmp_path):
+    traj = _create_synthetic_family(nmembers=1, seed=5).family[0]
+    traj.files, traj.ref_func, traj.deltat = ["f.nc"], None, 60
+    traj.pref = traj.piref * 1.0E5
+    resolution = 1.0 / 64
+    save_trajectories(traj, str(tmp_path / "raw.nc"))
+    save_trajectories(traj, str(tmp_path / "enc.nc"),
+                      position_resolution=resolution)
+    got = load_trajectories(str(tmp_path / "enc.nc"))
+    try:
+        order = got.point_index
+        err = np.abs(got.trajectory[...] - traj.trajectory[:, order])
+        assert np.max(err) <= resolution / 2 * (1 + 1.0E-9)
+        start, end = got.object_start[3], got.object_start[4]
+        assert np.array_equal(got.trajectory[:, start:end, :],
+                              got.trajectory[...][:, start:end, :])
+        assert np.array_equal(got.trajectory[2, start:end, 1],
+                              got.trajectory[...][2, start:end, 1])
+        assert np.array_equal(got.trajectory[..., 2],
+                              got.trajectory[...][..., 2])
+    finally:
+        close_files()
+    raw = (tmp_path / "raw.nc").stat().st_size
+    enc = (tmp_path / "enc.nc").stat().st_size
+    assert enc < raw
+
+
+def test_dataset_pool_reuses_and_closes_files(tmp_path):
+    from netCDF4 import Dataset
+    names = []
+    for i in range(3):
+        names.append(str(tmp_path / "f_{}.nc".format(i)))
+        Dataset(names[-1], "w").close()
+    pool = Dataset_Pool(max_open=2)
+    first = pool.open(names[0])
+    assert pool.open(names[0]) is first
+    pool.open(names[1])
+    pool.open(names[2])
+    assert len(pool) == 2 and not first.isopen()
+    assert (pool.hits, pool.misses) == (1, 3)
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_point_parallel_matches_data_to_pos():
+    rng = np.random.default_rng(6)
+    data = [rng.normal(size=(16, 12, 10)) for i in range(3)]
+    coords = [np.arange(n, dtype=float) for n in (16, 12, 10)]
+    pos = rng.uniform(0, [16, 12, 9], size=(500, 3))
+    expected = data_to_pos(data, pos, *coords)
+    parallel = Point_Parallel(3, min_points=10)
+    try:
+        got = parallel.data_to_pos(data, pos, *coords)
+        again = parallel.data_to_pos(data, pos[::-1], *coords)
+    finally:
+        parallel.close()
+    for e, g, a in zip(expected, got, again):
+        assert np.array_equal(e, g)
+        assert np.array_equal(e[::-1], a)
+
+
+def test_traj_config_settings_are_per_call():
+    from concurrent.futures import ThreadPoolExecutor
+    from scipy import ndimage
+    rng = np.random.default_rng(7)
+    data = [rng.normal(size=(8, 8, 6))]
+    coords = [np.arange(n, dtype=float) for n in (8, 8, 6)]
+    pos = rng.uniform(0, [8, 8, 5], size=(50, 3))
+    cubic = Traj_Config(use_bilin=False, interp_order=3)
+    with pytest.raises(AttributeError):
+        cubic.use_bilin = True
+    with ThreadPoolExecutor(2) as pool:
+        lin = pool.submit(data_to_pos, data, pos, *coords)
+        cub = pool.submit(data_to_pos, data, pos, *coords, config=cubic)
+        assert np.array_equal(lin.result()[0],
+                              data_to_pos(data, pos, *coords)[0])
+        assert np.array_equal(cub.result()[0],
+                              ndimage.map_coordinates(data[0], pos.T,
+                                                      mode='wrap', order=3))
+    boxes = np.array([[[0, 0, 0], [1, 1, 1]], [[7, 0, 0], [9, 1, 1]]])
+    assert list(box_overlap_with_wrap(boxes[0], boxes, 8, 8)) == [0, 1]
+    assert list(box_overlap_with_wrap(
+        boxes[0], boxes, 8, 8, config=Traj_Config(cyclic_xy=False))) == [0]
+
+
+def test_cloud_statistics_merge_and_resume(tmp_path):
+    ref = _create_cloud_family(nmembers=3, back=3, forward=2, seed=3)
+    expected = Cloud_Statistics()
+    for traj in ref.family:
+        member = Cloud_Statistics()
+        member.add(member_cloud_statistics(traj))
+        expected.merge(member)
+    assert expected["n"].sum[0] == 3
+    assert np.sum(expected["lifetime"].counts) == expected["n"].sum[1]
+    # Every binned accumulator has samples within its bins.
+    for name, acc in expected.accumulators.items():
+        state = acc.state()
+        assert np.sum(state.get("counts", state.get("count"))) > 0, name
+        if "sum" in state:
+            assert np.any(state["sum"] != 0), name
+    filename = str(tmp_path / "family.nc")
+    save_trajectory_family(ref, filename)
+
+    partial = str(tmp_path / "partial.npz")
+    got = family_cloud_statistics(filename, partial_file=partial)
+    saved = load_cloud_statistics(partial)
+    for stats in (got, saved):
+        for name, acc in expected.accumulators.items():
+            for key, value in acc.state().items():
+                assert np.allclose(stats[name].state()[key], value)
+
+    # Partial results are reused only if saved with the same settings.
+    Cloud_Statistics().save(partial)
+    got = family_cloud_statistics(filename, partial_file=partial)
+    assert got["n"].sum[0] == 0
+    for kwargs in ({"version": 2},
+                   {"bins": {"lifetime": np.arange(0, 75, 5)}}):
+        Cloud_Statistics().save(partial)
+        got = family_cloud_statistics(filename, partial_file=partial,
+                                      **kwargs)
+        assert got["n"].sum[0] == 3
+        saved = load_cloud_statistics(partial)
+        assert saved.version == kwargs.get("version", 1)
+        assert len(saved["lifetime"].bins[0]) == len(got.bins["lifetime"])
+    # Files saved without format information are recomputed.
+    with np.load(partial) as f:
+        old = dict((k, f[k]) for k in f.files if not k.startswith("meta/"))
+    np.savez(partial, **old)
+    got = family_cloud_statistics(filename, partial_file=partial)
+    assert got["n"].sum[0] == 3
+
+    total = aggregate_cloud_statistics([filename, filename], nproc=2)
+    for name, acc in expected.accumulators.items():
+        for key, value in acc.state().items():
+            if "bins" in key:
+                continue
+            assert np.allclose(total[name].state()[key], 2 * value), \
+                (name, key)
+
+
+def test_heat_map_streaming_matches_all_samples():
+    rng = np.random.default_rng(4)
+    x = rng.uniform(-50.0, 550.0, 1000)
+    z = rng.uniform(0.0, 1000.0, 1000)
+    xbins, zbins = np.arange(0, 550, 50), np.arange(0, 950, 50)
+    hmap = Heat_Map(xbins, zbins)
+    for part in np.array_split(np.arange(1000), 3):
+        chunk = Heat_Map(xbins, zbins)
+        chunk.add(x[part], z[part])
+        hmap.merge(chunk)
+    hist = np.histogram2d(x, z, [xbins, zbins])[0]
+    assert np.array_equal(hmap.counts, hist)
+
+    inside = (x >= 0) & (x <= 500) & (z >= 0) & (z <= 900)
+    zp, mean, std = hmap.profile()
+    iz = np.minimum(np.digitize(z[inside], zbins) - 1, len(zp) - 1)
+    for k in range(len(zp)):
+        assert np.isclose(mean[k], np.mean(x[inside][iz == k]))
+        assert np.isclose(std[k], np.std(x[inside][iz == k]))
+
+    copy = Heat_Map.from_state(hmap.state())
+    assert np.array_equal(copy.sumsq, hmap.sumsq)
+    with pytest.raises(ValueError):
+        hmap.merge(Heat_Map(xbins, zbins[1:]))